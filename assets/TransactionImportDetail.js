@@ -15,7 +15,9 @@ import Icon from '@mui/material/Icon';
 import Button from '@mui/material/Button';
 
 import { TransactionImportResult } from './TransactionImportResult';
-import { getTransactionImportResult, deleteTransactionImportResult } from './api_utils';
+import {
+    getTransactionImportResult, deleteTransactionImportResult, isImportPending,
+} from './api_utils';
 
 import { DeleteDialog } from './forms/DeleteDialog.js';
 
@@ -31,7 +33,9 @@ export function TransactionImportDetail() {
     const queryClient = useQueryClient();
     // Queries
     const { status, data, error } = useQuery(['imports', importId],
-        () => getTransactionImportResult(importId)
+        () => getTransactionImportResult(importId),
+        // Queued imports are polled until they're done.
+        { refetchInterval: result => (result && isImportPending(result)) ? 2000 : false }
     );
 
     const mutation = useMutation(deleteTransactionImportResult, {
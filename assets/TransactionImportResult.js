@@ -8,14 +8,48 @@ import AccordionSummary from '@mui/material/AccordionSummary';
 import AccordionDetails from '@mui/material/AccordionDetails';
 import Icon from '@mui/material/Icon';
 import Alert from '@mui/material/Alert';
+import LinearProgress from '@mui/material/LinearProgress';
 import format from 'date-fns/format';
 import { filter } from 'lodash';
 import { TransactionImportRecordReferencingTransaction } from './TransactionImportRecord';
+import { isImportPending } from './api_utils';
+
+
+function ImportProgress(props) {
+    const stepsDone = props.importResult.steps_done;
+    const stepsTotal = props.importResult.steps_total;
+    if (!stepsTotal) {
+        return <LinearProgress />;
+    }
+    return (
+        <div>
+            <LinearProgress variant="determinate" value={100 * stepsDone / stepsTotal} />
+            <p>{stepsDone} of {stepsTotal} steps done.</p>
+        </div>
+    );
+}
+
+ImportProgress.propTypes = {
+    importResult: PropTypes.shape({
+        steps_done: PropTypes.number,
+        steps_total: PropTypes.number,
+    })
+};
 
 
 export function TransactionImportResult(props) {
     const status = props.importResult.status;
     const integration = props.importResult.integration;
+    if (isImportPending(props.importResult)) {
+        const summary = status === "Queued" ? `Import from ${integration} is queued` :
+            `Import from ${integration} is running`;
+        return (
+            <div>
+                <Alert severity="info">{summary}</Alert>
+                <ImportProgress importResult={props.importResult} />
+            </div>
+        );
+    }
     const severity = status === "Success" ? "success" : (
         status == "Partial success" ? "warning" : "error");
 
@@ -90,9 +124,12 @@ export function TransactionImportResult(props) {
 
 TransactionImportResult.propTypes = {
     importResult: PropTypes.shape({
-        records: PropTypes.array.isRequired,
-        event_records: PropTypes.array.isRequired,
+        // Not included while the import is queued or running.
+        records: PropTypes.array,
+        event_records: PropTypes.array,
         status: PropTypes.string.isRequired,
+        steps_done: PropTypes.number,
+        steps_total: PropTypes.number,
         integration: PropTypes.string.isRequired,
         created_at: PropTypes.string.isRequired,
     })
@@ -102,7 +102,9 @@ async function submitDataNonJSON(url = '', data = {}, method = 'POST') {
     if (response.ok) {
         let data = await response.json();
         return {
-            ok: true, data: data
+            ok: true, data: data,
+            // Queued uploads are polled at their location until imported.
+            location: response.status == 202 ? response.headers.get("Location") : null,
         };
     }
     if (response.status == 400) {
@@ -283,6 +285,22 @@ export function getTransactionImportResult(importId) {
     return fetchDetailResult(url);
 }
 
+// Large uploads are imported by a worker, their status is one of these
+// until the import finishes.
+export function isImportPending(importResult) {
+    return importResult.status == "Queued" || importResult.status == "Running";
+}
+
+export async function waitForTransactionImport(url, onProgress, interval = 2000) {
+    let importResult;
+    do {
+        await new Promise(resolve => setTimeout(resolve, interval));
+        importResult = await fetchDetailResult(url);
+        onProgress(importResult);
+    } while (isImportPending(importResult));
+    return importResult;
+}
+
 export function getTransactionImportResults() {
     return fetchAllResults(baseUrl + '/transaction-imports/?limit=50');
 }
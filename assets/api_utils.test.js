@@ -1,7 +1,7 @@
 // The import below is necessary for async/await to work.
 // eslint-disable-next-line no-unused-vars
 import regeneratorRuntime from "regenerator-runtime";
-import { APIClient, APIClientError } from './api_utils.js';
+import { APIClient, APIClientError, waitForTransactionImport } from './api_utils.js';
 
 
 // GET /api/positions/?limit=50
@@ -556,4 +556,27 @@ describe("API Client", () => {
             "failed at fetching data, non successful response");
         await expect(apiClient.getPositions()).rejects.toEqual(expectedError);
     });
+
+    it("polls queued imports until they finish", async () => {
+        expect.hasAssertions();
+        const responses = [
+            { status: "Queued", steps_done: 0, steps_total: null },
+            { status: "Running", steps_done: 3, steps_total: 6 },
+            { status: "Success", steps_done: 6, steps_total: 6, records: [] },
+        ];
+        // eslint-disable-next-line no-undef
+        global.fetch = jest.fn(() => Promise.resolve({
+            ok: true,
+            json: () => Promise.resolve(responses.shift())
+        }));
+        const onProgress = jest.fn();
+
+        let got = await waitForTransactionImport("./my-api/transaction-imports/1/", onProgress, 0);
+        expect(got.status).toEqual("Success");
+        expect(onProgress.mock.calls.map(call => call[0].status)).toEqual(
+            ["Queued", "Running", "Success"]);
+
+        // eslint-disable-next-line no-undef
+        global.fetch.mockRestore();
+    });
 });
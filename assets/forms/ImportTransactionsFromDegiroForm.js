@@ -10,6 +10,7 @@ import { FormikCheckboxField, FormikSelectField } from './muiformik.js';
 import { Snackbar } from '../components/Snackbar.js';
 import { useStyles } from './styles.js';
 import { TransactionImportResult  } from '../TransactionImportResult.js';
+import { isImportPending, waitForTransactionImport } from '../api_utils.js';
 import SubmitSpinnerButton from '../components/SubmitSpinnerButton.js';
 
 import FormHelperText from '@mui/material/FormHelperText';
@@ -83,16 +84,28 @@ export default function ImportTransactionsFromDegiroForm(props) {
                     result = apiToErrors(result);
                     actions.setSubmitting(false);
                     if (result.ok) {
+                        actions.resetForm();
+                        if (isImportPending(result.data)) {
+                            snackbarSetSeverity("info");
+                            snackbarSetMessage(`Import queued, see Import Result for the progress.`);
+                            snackbarSetOpen(true);
+                            setImportResult(result);
+                            const finished = await waitForTransactionImport(
+                                result.location, running => setImportResult({ ok: true, data: running }));
+                            result = { ok: true, data: finished };
+                        }
                         if (result.data.status == "Success") {
                             snackbarSetSeverity("success");
                             const numTransactions = result.data.records.length;
                             snackbarSetMessage(`Successfully uploaded ${numTransactions} transactions!`);
+                        } else if (result.data.status == "Failure") {
+                            snackbarSetSeverity("error");
+                            snackbarSetMessage(`Import failed, see Import Result for more details.`);
                         } else {
                             snackbarSetSeverity("warning");
                             snackbarSetMessage(`Partial import success, see Import Result for more details.`);
                         }
                         snackbarSetOpen(true);
-                        actions.resetForm();
                     } else {
                         if (result.errors) {
                             console.log(result);
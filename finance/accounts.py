@@ -1,13 +1,27 @@
 import datetime
 import decimal
-from typing import Optional, Tuple, Union
+from typing import Dict, List, NamedTuple, Optional, Sequence, Tuple, Union
 from collections import defaultdict
 from django.contrib.auth.models import User
-from django.db import transaction
-from django.db.models import Count
+from django.db import connection, transaction
+from django.db.models import Case, Count, DecimalField, F, Value, When
 
+from django.utils import timezone
 from django.utils.dateparse import parse_datetime
-from finance import models, prices, gains, stock_exchanges, assets
+from finance import (
+    models,
+    exchange_rates,
+    fingerprints,
+    prices,
+    gains,
+    resolution,
+    history_cache,
+    ledger,
+    snapshots,
+    stock_exchanges,
+    assets,
+    tasks,
+)
 
 
 class CantDeleteNonEmptyAccount(ValueError):
@@ -22,22 +36,165 @@ class CantModifyTransactionWithEvent(ValueError):
     pass
 
 
+class DuplicateTransaction(ValueError):
+    pass
+
+
+class TransactionRecord(NamedTuple):
+    """A transaction to add in bulk, with what is needed to find its position.
+
+    The position is found by the isin and the exchange of the asset, like in
+    `AccountRepository.add_transaction`, or by the symbol of a crypto asset.
+    """
+
+    executed_at: datetime.datetime
+    quantity: decimal.Decimal
+    price: decimal.Decimal
+    transaction_costs: Optional[decimal.Decimal]
+    local_value: decimal.Decimal
+    value_in_account_currency: decimal.Decimal
+    total_in_account_currency: decimal.Decimal
+    order_id: Optional[str] = None
+    isin: Optional[str] = None
+    exchange: Optional[models.Exchange] = None
+    asset_defaults: Optional[dict] = None
+    import_all_assets: bool = False
+    symbol: Optional[str] = None
+
+
+class TransactionResult(NamedTuple):
+    transaction: Optional[models.Transaction]
+    created: bool
+    # Why the transaction couldn't be added, e.g. SoldBeforeBought.
+    error: Optional[Exception] = None
+
+
+_INSERT_BATCH_SIZE = 1000
+
+
+def _insert_new_transactions(
+    new_transactions: Sequence[models.Transaction],
+) -> List[models.Transaction]:
+    """Inserts transactions that aren't recorded yet, returns the inserted ones.
+
+    The database skips transactions with a fingerprint already recorded in
+    the position, e.g. added at the same time by another import.
+    """
+    meta = models.Transaction._meta
+    fields = [field for field in meta.concrete_fields if not field.primary_key]
+    row = "(" + ", ".join(["%s"] * len(fields)) + ")"
+    by_fingerprint = {
+        (new_transaction.position_id, new_transaction.fingerprint): new_transaction
+        for new_transaction in new_transactions
+    }
+    inserted = []
+    with connection.cursor() as cursor:
+        for start in range(0, len(new_transactions), _INSERT_BATCH_SIZE):
+            batch = new_transactions[start : start + _INSERT_BATCH_SIZE]
+            params = [
+                field.get_db_prep_save(
+                    field.pre_save(new_transaction, True), connection
+                )
+                for new_transaction in batch
+                for field in fields
+            ]
+            cursor.execute(
+                f"INSERT INTO {meta.db_table} "
+                f"({', '.join(field.column for field in fields)}) "
+                f"VALUES {', '.join([row] * len(batch))} "
+                "ON CONFLICT (position_id, fingerprint) DO NOTHING "
+                "RETURNING id, position_id, fingerprint",
+                params,
+            )
+            for id, position_id, fingerprint in cursor.fetchall():
+                new_transaction = by_fingerprint[(position_id, fingerprint)]
+                new_transaction.pk = id
+                inserted.append(new_transaction)
+    return inserted
+
+
+def _lock_accounts(account_ids: Sequence[int]) -> None:
+    """Locks rows of the accounts until the end of the transaction.
+
+    Every change of an account takes the lock first, so changes of the same
+    account are applied one after another and changes of different accounts
+    in parallel. Rows are locked in the order of ids to avoid deadlocks.
+    """
+    list(
+        models.Account.objects.select_for_update()
+        .filter(pk__in=account_ids)
+        .order_by("pk")
+        .values_list("pk", flat=True)
+    )
+
+
+def _change_quantities(changes: Dict[int, decimal.Decimal]) -> None:
+    """Adds the changes to quantities of positions by id, in one update.
+
+    Quantities are changed by the database, not written from what was read.
+    """
+    changes = {
+        position_id: change for position_id, change in changes.items() if change
+    }
+    if not changes:
+        return
+    models.Position.objects.filter(pk__in=changes.keys()).update(
+        quantity=F("quantity")
+        + Case(
+            *[
+                When(pk=position_id, then=Value(change))
+                for position_id, change in changes.items()
+            ],
+            output_field=DecimalField(max_digits=20, decimal_places=10),
+        ),
+        last_modified=timezone.now(),
+    )
+
+
 class AccountRepository:
-    def __init__(self, recompute_lots=True, batch_related_changes=False):
+    def __init__(
+        self, recompute_lots=True, batch_related_changes=False, defer_lots=False
+    ):
         self.recompute_lots = recompute_lots
         self.batch_related_changes = batch_related_changes
+        # Lots are recomputed in the background, transactions are still
+        # checked for selling more than owned.
+        self.defer_lots = defer_lots
         self.updated_positions = set()
         self.position_to_quantity_change = defaultdict(int)
-        self.account_to_quantity_change = defaultdict(int)
+        # Accounts with balances to sync from the ledger after batched changes.
+        self.accounts_to_sync = set()
+
+    def _balance_changed(self, account: models.Account) -> None:
+        """Syncs the balance from the ledger, or after the batch of changes."""
+        if self.batch_related_changes:
+            self.accounts_to_sync.add(account)
+        else:
+            ledger.sync_balance(account)
+
+    def sync_balances(self) -> None:
+        """Syncs balances of accounts changed by the batch, once per account."""
+        for account in self.accounts_to_sync:
+            ledger.sync_balance(account)
+        self.accounts_to_sync.clear()
 
     def get(self, user: User, id: int) -> models.Account:
         return models.Account.objects.get(user=user, id=id)
 
     def create(
-        self, nickname: str, currency: models.Currency, description: str, user: User
+        self,
+        nickname: str,
+        currency: models.Currency,
+        description: str,
+        user: User,
+        cost_basis_method: models.CostBasisMethod = models.CostBasisMethod.FIFO,
     ) -> models.Account:
         return models.Account.objects.create(
-            user=user, nickname=nickname, description=description, currency=currency
+            user=user,
+            nickname=nickname,
+            description=description,
+            currency=currency,
+            cost_basis_method=cost_basis_method,
         )
 
     def delete(self, account):
@@ -53,26 +210,70 @@ class AccountRepository:
 
         account.delete()
 
+    @transaction.atomic
     def update(self, serializer):
         account = serializer.instance
-        if serializer.validated_data["currency"] == account.currency:
-            serializer.save()
-            return
-        if (
-            account.positions.annotate(transactions_count=Count("transactions"))
-            .filter(transactions_count__gt=0)
-            .count()
-            > 0
-        ):
-            raise CantUpdateNonEmptyAccount()
-        if account.events.count() > 0:
-            raise CantUpdateNonEmptyAccount()
+        _lock_accounts([account.pk])
+        # The whole account is saved, with the balance as it's now.
+        account.refresh_from_db(fields=["balance"])
+        cost_basis_method = account.cost_basis_method
+        if serializer.validated_data["currency"] != account.currency:
+            if (
+                account.positions.annotate(transactions_count=Count("transactions"))
+                .filter(transactions_count__gt=0)
+                .count()
+                > 0
+            ):
+                raise CantUpdateNonEmptyAccount()
+            if account.events.count() > 0:
+                raise CantUpdateNonEmptyAccount()
 
         serializer.save()
+        if account.cost_basis_method != cost_basis_method:
+            # Lots of all positions are sold in a different order now.
+            position_ids = list(account.positions.values_list("id", flat=True))
+            gains.mark_pending_many(dict.fromkeys(position_ids))
+            transaction.on_commit(lambda: tasks.schedule_update_lots(position_ids))
+
+    def _invalidate_snapshots(self, from_dates: Dict[int, datetime.date]):
+        """Truncates daily snapshots and extends them again after commit."""
+        snapshots.invalidate(from_dates)
+        position_ids = list(from_dates.keys())
+        transaction.on_commit(lambda: tasks.update_snapshots.delay(position_ids))
+
+    def _update_lots(self, position, since: Optional[datetime.datetime]):
+        self._check_and_update_lots_since({position: since})
+
+    def _check_and_update_lots_since(
+        self, since: Dict[models.Position, Optional[datetime.datetime]]
+    ):
+        if self.defer_lots:
+            gains.check_quantities_many(since)
+        self._update_lots_since(since)
+
+    def _update_lots_since(
+        self, since: Dict[models.Position, Optional[datetime.datetime]]
+    ):
+        """Updates lots of positions from the time, quantities are checked already."""
+        if self.defer_lots:
+            gains.mark_pending_many(
+                {
+                    position.pk: position_since
+                    for position, position_since in since.items()
+                }
+            )
+            position_ids = [position.pk for position in since]
+            transaction.on_commit(lambda: tasks.schedule_update_lots(position_ids))
+        elif self.recompute_lots:
+            for position, position_since in since.items():
+                gains.update_lots(position, since=position_since)
 
     def update_lots(self):
-        for position in self.updated_positions:
-            gains.update_lots(position)
+        if not self.defer_lots:
+            for position in self.updated_positions:
+                gains.update_lots(position)
+        elif self.updated_positions:
+            self._check_and_update_lots_since(dict.fromkeys(self.updated_positions))
 
     @transaction.atomic
     def _add_transaction(
@@ -89,10 +290,7 @@ class AccountRepository:
         order_id,
         custom_asset=False,
     ) -> Tuple[models.Transaction, bool]:
-        position.quantity_history.cache_clear()
-        position.value_history.cache_clear()
-
-        transaction, created = models.Transaction.objects.get_or_create(
+        new_transaction = models.Transaction(
             executed_at=executed_at,
             position=position,
             quantity=quantity,
@@ -103,17 +301,31 @@ class AccountRepository:
             total_in_account_currency=total_in_account_currency,
             order_id=order_id,
         )
+        transaction, created = models.Transaction.objects.get_or_create(
+            position=position,
+            fingerprint=fingerprints.fingerprint(
+                models.Transaction, fingerprints.TRANSACTION_FIELDS, new_transaction
+            ),
+            defaults={
+                field: getattr(new_transaction, field)
+                for field in fingerprints.TRANSACTION_FIELDS
+            },
+        )
         if created:
+            _change_quantities({position.pk: quantity})
             position.quantity += quantity
-            position.save()
-            account.balance += total_in_account_currency
-            account.save()
+            ledger.record([ledger.transaction_entry(transaction)])
+            self._balance_changed(account)
             if custom_asset:
                 models.PriceHistory.objects.create(
                     asset=position.asset, value=price, date=executed_at.date()
                 )
-            if self.recompute_lots:
-                gains.update_lots(position, transaction)
+                prices.update_latest_quote(position.asset_id)
+                history_cache.invalidate_asset(position.asset_id)
+                snapshots.invalidate_asset(position.asset_id, executed_at.date())
+            history_cache.invalidate_position(position.pk)
+            self._invalidate_snapshots({position.pk: executed_at.date()})
+            self._update_lots(position, executed_at)
             self.updated_positions.add(position)
 
         return transaction, created
@@ -135,6 +347,7 @@ class AccountRepository:
         asset_defaults,
         import_all_assets,
     ) -> Tuple[models.Transaction, bool]:
+        _lock_accounts([account.pk])
         position = self._get_or_create_position(
             account, isin, exchange, asset_defaults, import_all_assets
         )
@@ -164,6 +377,176 @@ class AccountRepository:
             order_id,
         )
 
+    @transaction.atomic
+    def add_transactions_bulk(
+        self,
+        account: models.Account,
+        records: Sequence[TransactionRecord],
+        resolver: Optional[resolution.ImportResolver] = None,
+    ) -> List[TransactionResult]:
+        """Adds many transactions at once, returns a result per record.
+
+        Each position is found once and transactions already recorded are
+        found by their fingerprints in one query. The others are inserted
+        together and positions, the account and lots are updated once.
+        Records that can't be added, e.g. selling more than owned, have the
+        error in their result and the rest is still added.
+        Positions are found with the resolver of the import if it's passed.
+        """
+        _lock_accounts([account.pk])
+        results: List[Optional[TransactionResult]] = [None] * len(records)
+        resolved = {}
+        record_positions = {}
+        positions = {}
+        for i, record in enumerate(records):
+            key = (record.symbol,) if record.symbol else (record.isin, record.exchange)
+            if key not in resolved:
+                try:
+                    with transaction.atomic():
+                        resolved[key] = self._get_or_create_position_for_record(
+                            account, record, resolver
+                        )
+                except Exception as e:
+                    resolved[key] = e
+            if isinstance(resolved[key], Exception):
+                results[i] = TransactionResult(None, False, resolved[key])
+                continue
+            position, custom_asset = resolved[key]
+            position = positions.setdefault(position.pk, position)
+            record_positions[i] = (position, custom_asset)
+
+        fingerprint_of = {
+            i: fingerprints.fingerprint(
+                models.Transaction, fingerprints.TRANSACTION_FIELDS, records[i]
+            )
+            for i in record_positions
+        }
+        known = {
+            (known_transaction.position_id, known_transaction.fingerprint): (
+                known_transaction
+            )
+            for known_transaction in models.Transaction.objects.filter(
+                position__in=positions.keys(),
+                fingerprint__in=set(fingerprint_of.values()),
+            )
+        }
+        quantities = defaultdict(list)
+        for position_id, executed_at, quantity in (
+            models.Transaction.objects.filter(position__in=positions.keys())
+            .order_by("executed_at", "id")
+            .values_list("position_id", "executed_at", "quantity")
+        ):
+            quantities[position_id].append((executed_at, quantity))
+        checkers = {
+            position_id: gains.QuantityChecker(position, quantities[position_id])
+            for position_id, position in positions.items()
+        }
+
+        new_transactions = []
+        # Added in the execution order, so that quantities can be checked.
+        for i in sorted(record_positions, key=lambda i: records[i].executed_at):
+            record = records[i]
+            position, custom_asset = record_positions[i]
+            key = (position.pk, fingerprint_of[i])
+            if key in known:
+                results[i] = TransactionResult(known[key], False)
+                continue
+            try:
+                checkers[position.pk].add(record.executed_at, record.quantity)
+            except gains.SoldBeforeBought as e:
+                results[i] = TransactionResult(None, False, e)
+                continue
+            new_transaction = models.Transaction(
+                position=position,
+                fingerprint=fingerprint_of[i],
+                **{
+                    field: getattr(record, field)
+                    for field in fingerprints.TRANSACTION_FIELDS
+                },
+            )
+            known[key] = new_transaction
+            new_transactions.append((new_transaction, custom_asset))
+            results[i] = TransactionResult(new_transaction, True)
+
+        inserted = _insert_new_transactions(
+            [new_transaction for new_transaction, _ in new_transactions]
+        )
+        if len(inserted) < len(new_transactions):
+            # Some were recorded by someone else since they were looked up.
+            recorded = {
+                (recorded_transaction.position_id, recorded_transaction.fingerprint): (
+                    recorded_transaction
+                )
+                for recorded_transaction in models.Transaction.objects.filter(
+                    position__in=positions.keys(),
+                    fingerprint__in=[
+                        new_transaction.fingerprint
+                        for new_transaction, _ in new_transactions
+                        if new_transaction.pk is None
+                    ],
+                )
+            }
+            for i, result in enumerate(results):
+                skipped = result and result.transaction
+                if skipped and skipped.pk is None:
+                    key = (skipped.position_id, skipped.fingerprint)
+                    results[i] = TransactionResult(recorded[key], False)
+            new_transactions = [
+                (new_transaction, custom_asset)
+                for new_transaction, custom_asset in new_transactions
+                if new_transaction.pk is not None
+            ]
+        self._apply_added_transactions(account, new_transactions)
+        return results
+
+    def _apply_added_transactions(self, account, new_transactions):
+        """Updates everything depending on transactions inserted in bulk."""
+        if not new_transactions:
+            return
+        quantity_changes = defaultdict(decimal.Decimal)
+        since = {}
+        asset_since = {}
+        price_history = []
+        for new_transaction, custom_asset in new_transactions:
+            position = new_transaction.position
+            executed_at = new_transaction.executed_at
+            quantity_changes[position] += new_transaction.quantity
+            since[position] = min(since.get(position, executed_at), executed_at)
+            if custom_asset:
+                price_history.append(
+                    models.PriceHistory(
+                        asset=position.asset,
+                        value=new_transaction.price,
+                        date=executed_at.date(),
+                    )
+                )
+                asset_since[position.asset_id] = min(
+                    asset_since.get(position.asset_id, executed_at.date()),
+                    executed_at.date(),
+                )
+
+        _change_quantities(
+            {position.pk: change for position, change in quantity_changes.items()}
+        )
+        for position, quantity_change in quantity_changes.items():
+            position.quantity += quantity_change
+        ledger.record(
+            ledger.transaction_entry(new_transaction)
+            for new_transaction, _ in new_transactions
+        )
+        self._balance_changed(account)
+        models.PriceHistory.objects.bulk_create(price_history)
+        for asset_id, from_date in asset_since.items():
+            prices.update_latest_quote(asset_id)
+            history_cache.invalidate_asset(asset_id)
+            snapshots.invalidate_asset(asset_id, from_date)
+        history_cache.invalidate_positions([position.pk for position in since])
+        self._invalidate_snapshots(
+            {position.pk: executed_at.date() for position, executed_at in since.items()}
+        )
+        self._update_lots_since(since)
+        self.updated_positions.update(since)
+
     @transaction.atomic
     def add_transaction_known_asset(
         self,
@@ -178,7 +561,7 @@ class AccountRepository:
         total_in_account_currency,
         order_id=None,
     ) -> models.Transaction:
-
+        _lock_accounts([account.pk])
         position = self._get_or_create_position_for_asset(account, asset_id)
 
         transaction, _ = self._add_transaction(
@@ -212,7 +595,7 @@ class AccountRepository:
         total_in_account_currency: decimal.Decimal,
         order_id: Optional[str] = None,
     ) -> models.Transaction:
-
+        _lock_accounts([account.pk])
         exchange_entity = stock_exchanges.ExchangeRepository().get_by_name(exchange)
         tracked = False
         if asset_type == models.AssetType.CRYPTO:
@@ -258,18 +641,12 @@ class AccountRepository:
         total_in_account_currency: decimal.Decimal,
         transaction_costs: Optional[decimal.Decimal] = None,
         order_id: Optional[str] = None,
+        resolver: Optional[resolution.ImportResolver] = None,
     ):
-
-        na_exchange = stock_exchanges.ExchangeRepository().get_by_name(
-            stock_exchanges.OTHER_OR_NA_EXCHANGE_NAME
-        )
-        asset_repository = assets.AssetRepository(exchange=na_exchange)
-        user = account.user
-        asset = asset_repository.add_crypto(
-            symbol=symbol,
-            user=user,
+        _lock_accounts([account.pk])
+        position, asset = self._get_or_create_crypto_position(
+            account, symbol, resolver
         )
-        position = self._get_or_create_position_for_asset(account, asset.pk)
 
         return self._add_transaction(
             account,
@@ -304,8 +681,9 @@ class AccountRepository:
         if event_type == models.EventType.WITHDRAWAL:
             assert amount < 0
 
-        event, created = models.AccountEvent.objects.get_or_create(
-            account=account,
+        _lock_accounts([account.pk])
+        event, created = self._get_or_create_event(
+            account,
             amount=amount,
             executed_at=executed_at,
             event_type=event_type,
@@ -321,7 +699,7 @@ class AccountRepository:
                 position_currency = position.asset.currency
                 account_currency = account.currency
                 if position_currency != account_currency:
-                    exchange_rate = prices.get_closest_exchange_rate(
+                    exchange_rate = exchange_rates.get_closest(
                         date=executed_at.date(),
                         from_currency=position_currency,
                         to_currency=account_currency,
@@ -333,41 +711,30 @@ class AccountRepository:
                         )
                     balance_change *= exchange_rate.value
 
-            account.balance += balance_change
-        account.save()
+            ledger.record([ledger.event_entry(event, balance_change)])
+            self._balance_changed(account)
         return event, created
 
+    def _get_or_create_event(
+        self, account: models.Account, **values
+    ) -> Tuple[models.AccountEvent, bool]:
+        event = models.AccountEvent(account=account, **values)
+        return models.AccountEvent.objects.get_or_create(
+            account=account,
+            fingerprint=fingerprints.fingerprint(
+                models.AccountEvent, fingerprints.EVENT_FIELDS, event
+            ),
+            defaults=values,
+        )
+
     @transaction.atomic
     def delete_event(self, event: models.AccountEvent) -> None:
         account = event.account
-        # This makes sense for all currently supported events,
-        # but might not in the future.
-
-        balance_change = event.amount
-        if event.withheld_taxes:
-            balance_change -= event.withheld_taxes
-
-        if event.event_type == models.EventType.DIVIDEND and event.position:
-            position_currency = event.position.asset.currency
-            account_currency = account.currency
-            if position_currency != account_currency:
-                exchange_rate = prices.get_closest_exchange_rate(
-                    date=event.executed_at.date(),
-                    from_currency=position_currency,
-                    to_currency=account_currency,
-                )
-                if exchange_rate is None:
-                    raise ValueError(
-                        f"Can't convert between currencies: "
-                        f"{position_currency} and {account_currency}"
-                    )
-                balance_change *= exchange_rate.value
-
-        if not self.batch_related_changes:
-            account.balance -= balance_change
-            account.save()
-        else:
-            self.account_to_quantity_change[account] -= balance_change
+        _lock_accounts([account.pk])
+        # The balance changes by what was recorded when the event was added,
+        # even if exchange rates changed since.
+        ledger.reverse(event_ids=[event.pk])
+        self._balance_changed(account)
         transaction = event.transaction
 
         event.delete()
@@ -400,6 +767,57 @@ class AccountRepository:
         else:
             return None
 
+    def _get_or_create_crypto_position(
+        self,
+        account: models.Account,
+        symbol: str,
+        resolver: Optional[resolution.ImportResolver] = None,
+    ) -> Tuple[models.Position, models.Asset]:
+        na_exchange = stock_exchanges.ExchangeRepository().get_by_name(
+            stock_exchanges.OTHER_OR_NA_EXCHANGE_NAME
+        )
+        asset_repository = assets.AssetRepository(exchange=na_exchange)
+        asset = asset_repository.add_crypto(
+            symbol=symbol,
+            user=account.user,
+            tracked=resolver.crypto_tracked(symbol) if resolver else None,
+        )
+        position = self._get_or_create_position_for_asset(account, asset.pk)
+        return position, asset
+
+    def _get_or_create_position_for_record(
+        self,
+        account: models.Account,
+        record: TransactionRecord,
+        resolver: Optional[resolution.ImportResolver] = None,
+    ) -> Tuple[models.Position, bool]:
+        """Position of the record and if its asset is a custom one."""
+        if record.symbol:
+            position, asset = self._get_or_create_crypto_position(
+                account, record.symbol, resolver
+            )
+            return position, not asset.tracked
+        if resolver:
+            position = resolver.position(
+                record.isin,
+                record.exchange,
+                record.asset_defaults,
+                record.import_all_assets,
+            )
+        else:
+            position = self._get_or_create_position(
+                account,
+                record.isin,
+                record.exchange,
+                record.asset_defaults,
+                record.import_all_assets,
+            )
+        if not position:
+            raise ValueError(
+                f"Failed to create a position from a transaction record, isin: {record.isin}, exchange ref: {record.exchange}"
+            )
+        return position, False
+
     def _get_or_create_position_for_asset(self, account: models.Account, asset_id: int):
         positions = models.Position.objects.filter(account=account, asset__pk=asset_id)
         if positions:
@@ -419,29 +837,30 @@ class AccountRepository:
 
         position = transaction.position
         account = position.account
+        _lock_accounts([account.pk])
+        try:
+            # Quantity could have been corrected by someone else in the meantime.
+            transaction.refresh_from_db()
+        except models.Transaction.DoesNotExist:
+            # Deleted by someone else in the meantime.
+            return
         # This assumes no splits and merges support.
         if not self.batch_related_changes:
+            _change_quantities({position.pk: -transaction.quantity})
             position.quantity -= transaction.quantity
-            position.save()
         else:
             self.position_to_quantity_change[
                 transaction.position
             ] -= transaction.quantity
 
-        if not self.batch_related_changes:
-            account.balance -= transaction.total_in_account_currency
-            account.save()
-        else:
-            self.account_to_quantity_change[
-                position.account
-            ] -= transaction.total_in_account_currency
+        ledger.reverse(transaction_ids=[transaction.pk])
+        self._balance_changed(account)
 
         transaction.delete()
-        if self.recompute_lots:
-            gains.update_lots(position)
+        self._update_lots(position, transaction.executed_at)
         self.updated_positions.add(position)
-        position.quantity_history.cache_clear()
-        position.value_history.cache_clear()
+        history_cache.invalidate_position(position.pk)
+        self._invalidate_snapshots({position.pk: transaction.executed_at.date()})
 
     @transaction.atomic
     def correct_transaction(self, transaction, update) -> None:
@@ -464,23 +883,42 @@ class AccountRepository:
                 )
         position = transaction.position
         account = position.account
-
-        position.quantity -= transaction.quantity
-        account.balance -= transaction.total_in_account_currency
+        _lock_accounts([account.pk])
+        # Corrected from what is recorded, it might have changed in the meantime.
+        transaction.refresh_from_db()
+        previous_quantity = transaction.quantity
+        previous_executed_at = transaction.executed_at
 
         for attr, value in update.items():
             setattr(transaction, attr, value)
+        if (
+            models.Transaction.objects.filter(
+                position=position,
+                fingerprint=fingerprints.fingerprint(
+                    models.Transaction, fingerprints.TRANSACTION_FIELDS, transaction
+                ),
+            )
+            .exclude(pk=transaction.pk)
+            .exists()
+        ):
+            raise DuplicateTransaction(
+                "Another transaction with the same values is already recorded."
+            )
 
-        position.quantity += transaction.quantity
-        account.balance += transaction.total_in_account_currency
-        position.save()
-        account.save()
+        _change_quantities({position.pk: transaction.quantity - previous_quantity})
+        position.quantity += transaction.quantity - previous_quantity
         transaction.save()
-        if self.recompute_lots:
-            gains.update_lots(position)
+        ledger.reverse(transaction_ids=[transaction.pk])
+        ledger.record([ledger.transaction_entry(transaction)])
+        self._balance_changed(account)
+        self._update_lots(
+            position, min(previous_executed_at, transaction.executed_at)
+        )
         self.updated_positions.add(position)
-        position.quantity_history.cache_clear()
-        position.value_history.cache_clear()
+        history_cache.invalidate_position(position.pk)
+        self._invalidate_snapshots(
+            {position.pk: min(previous_executed_at, transaction.executed_at).date()}
+        )
 
     @transaction.atomic
     def add_crypto_income_event(
@@ -493,8 +931,9 @@ class AccountRepository:
         local_value: decimal.Decimal,
         value_in_account_currency: decimal.Decimal,
         event_type: models.EventType,
+        resolver: Optional[resolution.ImportResolver] = None,
     ) -> Tuple[models.AccountEvent, bool]:
-
+        _lock_accounts([account.pk])
         (transaction, _,) = self.add_transaction_crypto_asset(
             account,
             symbol,
@@ -505,12 +944,13 @@ class AccountRepository:
             local_value,
             value_in_account_currency,
             value_in_account_currency,
+            resolver=resolver,
         )
 
         position = transaction.position
 
-        event, created = models.AccountEvent.objects.get_or_create(
-            account=account,
+        event, created = self._get_or_create_event(
+            account,
             amount=-value_in_account_currency,
             executed_at=executed_at,
             event_type=event_type,
@@ -520,13 +960,14 @@ class AccountRepository:
         )
 
         if created:
-            account.balance += -value_in_account_currency
-        account.save()
+            ledger.record([ledger.event_entry(event, -value_in_account_currency)])
+            self._balance_changed(account)
 
         return event, created
 
     @transaction.atomic
     def delete_transaction_import(self, transaction_import: models.TransactionImport):
+        _lock_accounts([transaction_import.account_id])
 
         for event_record in (
             transaction_import.event_records.order_by("-transaction__executed_at")
@@ -537,9 +978,9 @@ class AccountRepository:
             self.delete_event(event_record.event)
 
         position_ids_to_updates = defaultdict(int)
+        position_ids_to_first_date = {}
         events_to_delete = []
         transactions_to_delete = []
-        account_total_change = 0
 
         for event_record in (
             transaction_import.event_records.order_by("-transaction__executed_at")
@@ -553,13 +994,19 @@ class AccountRepository:
                 "transaction__id",
                 "transaction__position__id",
                 "transaction__quantity",
+                "transaction__executed_at",
             )
         ):
             events_to_delete.append(event_record["event__id"])
             transactions_to_delete.append(event_record["transaction__id"])
-            position_ids_to_updates[
-                event_record["transaction__position__id"]
-            ] -= event_record["transaction__quantity"]
+            position_id = event_record["transaction__position__id"]
+            position_ids_to_updates[position_id] -= event_record[
+                "transaction__quantity"
+            ]
+            first_date = event_record["transaction__executed_at"].date()
+            position_ids_to_first_date[position_id] = min(
+                first_date, position_ids_to_first_date.get(position_id, first_date)
+            )
 
         for transaction_record in (
             transaction_import.records.annotate(
@@ -572,28 +1019,30 @@ class AccountRepository:
                 "transaction__id",
                 "transaction__position__id",
                 "transaction__quantity",
-                "transaction__total_in_account_currency",
+                "transaction__executed_at",
             )
         ):
             transactions_to_delete.append(transaction_record["transaction__id"])
-            position_ids_to_updates[
-                transaction_record["transaction__position__id"]
-            ] -= transaction_record["transaction__quantity"]
-            account_total_change -= transaction_record[
-                "transaction__total_in_account_currency"
+            position_id = transaction_record["transaction__position__id"]
+            position_ids_to_updates[position_id] -= transaction_record[
+                "transaction__quantity"
             ]
+            first_date = transaction_record["transaction__executed_at"].date()
+            position_ids_to_first_date[position_id] = min(
+                first_date, position_ids_to_first_date.get(position_id, first_date)
+            )
 
-        transaction_import.account.balance += account_total_change
-        transaction_import.account.save()
+        ledger.reverse(transactions_to_delete, events_to_delete)
+        self.accounts_to_sync.add(transaction_import.account)
+        # Events of the import can only be in its account, already locked.
+        self.sync_balances()
         transaction_import.delete()
         models.Transaction.objects.filter(id__in=transactions_to_delete).delete()
         models.AccountEvent.objects.filter(id__in=events_to_delete).delete()
 
-        positions = models.Position.objects.filter(
-            id__in=position_ids_to_updates.keys()
+        _change_quantities(position_ids_to_updates)
+        self.updated_positions.update(
+            models.Position.objects.filter(id__in=position_ids_to_updates.keys())
         )
-        updated_positions = []
-        for position in positions:
-            position.quantity += position_ids_to_updates[position.id]
-            updated_positions.append(position)
-        models.Position.objects.bulk_update(updated_positions, ["quantity"])
+        history_cache.invalidate_positions(list(position_ids_to_updates.keys()))
+        self._invalidate_snapshots(position_ids_to_first_date)
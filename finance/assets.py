@@ -1,3 +1,5 @@
+from typing import Optional
+
 from finance import models, prices, tasks
 from django.contrib.auth.models import User
 
@@ -28,10 +30,11 @@ class AssetRepository:
         asset.full_clean()
         return asset
 
-    def add_crypto(self, symbol : str, user: User) -> models.Asset:
+    def add_crypto(self, symbol : str, user: User, tracked: Optional[bool] = None) -> models.Asset:
         # The exchange here should be Other / NA exchange as crypto assets are not tied to
         # particular exchanges.
-        tracked = prices.are_crypto_prices_available(symbol)
+        if tracked is None:
+            tracked = prices.are_crypto_prices_available(symbol)
         asset, _ = models.Asset.objects.get_or_create(
             symbol=symbol,
             name=symbol,
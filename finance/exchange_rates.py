@@ -0,0 +1,302 @@
+"""Process-wide store of currency exchange rates.
+
+All recorded rates are loaded into memory once, into per-pair arrays
+indexed by day, so looking up the rate closest to a date doesn't need a
+query. Pairs that aren't recorded are derived from the inverse pair or by
+triangulating through USD or EUR.
+
+The store reloads when the version key is bumped, e.g. by the job that
+collects exchange rates or when a rate is saved, or when rates were added in
+the meantime. That's checked at most once per request, task or
+CHECK_INTERVAL, lookups in between are served from memory without a query
+or a lock.
+"""
+import datetime
+import decimal
+import itertools
+import threading
+import time
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
+import numpy as np
+from django.core.cache import cache
+from django.core.signals import request_started
+from django.db.models import Max
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from finance import models
+
+
+_VERSION_KEY = "exchange-rates:version"
+# Seconds between checks whether rates changed in long running processes.
+CHECK_INTERVAL = 60
+
+
+class ExchangeRate(NamedTuple):
+    date: datetime.date
+    from_currency: "models.Currency"
+    to_currency: "models.Currency"
+    value: decimal.Decimal
+
+
+class _RateSeries:
+    """Rates of a single pair, looked up by the offset from the first date."""
+
+    def __init__(self, ordinals: np.ndarray, values: np.ndarray):
+        """Ordinals of dates are sorted from the earliest one."""
+        self.ordinals = ordinals
+        self.values = values
+        self.start = int(ordinals[0])
+        # Index of the latest rate on or before every day between the first
+        # and the last rate.
+        days = np.arange(self.start, int(ordinals[-1]) + 1)
+        self.index = np.searchsorted(ordinals, days, side="right") - 1
+
+    def locate(self, ordinals: np.ndarray) -> np.ndarray:
+        """Indices of rates closest to the dates.
+
+        That's the latest rate on or before the date, or the first one if
+        the date is earlier than all rates.
+        """
+        offsets = np.clip(ordinals - self.start, 0, len(self.index) - 1)
+        return self.index[offsets]
+
+    def closest(self, date: datetime.date) -> Tuple[datetime.date, decimal.Decimal]:
+        i = self.locate(np.array([date.toordinal()]))[0]
+        return datetime.date.fromordinal(int(self.ordinals[i])), self.values[i]
+
+    def latest(self) -> Tuple[datetime.date, decimal.Decimal]:
+        return datetime.date.fromordinal(int(self.ordinals[-1])), self.values[-1]
+
+    def between(
+        self, from_date: datetime.date, to_date: datetime.date
+    ) -> List[Tuple[datetime.date, decimal.Decimal]]:
+        """Rates between the dates, inclusive, from the latest one."""
+        first = np.searchsorted(self.ordinals, from_date.toordinal(), side="left")
+        last = np.searchsorted(self.ordinals, to_date.toordinal(), side="right")
+        return [
+            (datetime.date.fromordinal(int(ordinal)), value)
+            for ordinal, value in zip(
+                self.ordinals[first:last][::-1], self.values[first:last][::-1]
+            )
+        ]
+
+    def inverse(self) -> "_RateSeries":
+        return _RateSeries(self.ordinals, decimal.Decimal(1) / self.values)
+
+    def combine(self, other: "_RateSeries") -> "_RateSeries":
+        """Series of products of both rates at dates of either of them."""
+        ordinals = np.union1d(self.ordinals, other.ordinals)
+        values = (
+            self.values[self.locate(ordinals)] * other.values[other.locate(ordinals)]
+        )
+        return _RateSeries(ordinals, values)
+
+
+Pair = Tuple["models.Currency", "models.Currency"]
+
+
+class _Rates:
+    """Rates loaded at once, replaced as a whole when the store reloads."""
+
+    def __init__(self, recorded: Dict[Pair, _RateSeries]):
+        self.recorded = recorded
+        self.derived: Dict[Pair, Optional[_RateSeries]] = {}
+
+    def _direct(self, pair: Pair) -> Optional[_RateSeries]:
+        series = self.recorded.get(pair)
+        if series is not None:
+            return series
+        inverse = self.recorded.get((pair[1], pair[0]))
+        if inverse is not None:
+            return inverse.inverse()
+        return None
+
+    def series(self, pair: Pair) -> Optional[_RateSeries]:
+        if pair in self.derived:
+            return self.derived[pair]
+        if pair[0] == pair[1]:
+            # Rates of a currency to itself aren't recorded.
+            return None
+        series = self._direct(pair)
+        if series is None:
+            from_currency, to_currency = pair
+            for through in (models.Currency.USD, models.Currency.EUR):
+                if through in pair:
+                    continue
+                first = self._direct((from_currency, through))
+                second = self._direct((through, to_currency))
+                if first is not None and second is not None:
+                    series = first.combine(second)
+                    break
+        # Deriving the same pair twice by concurrent lookups is harmless.
+        self.derived[pair] = series
+        return series
+
+
+class ExchangeRateStore:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._token: Optional[Tuple[int, Optional[int]]] = None
+        self._rates = _Rates({})
+        self._checked_at: Optional[float] = None
+
+    def _current_token(self) -> Tuple[int, Optional[int]]:
+        version = cache.get(_VERSION_KEY)
+        if version is None:
+            cache.add(_VERSION_KEY, time.time_ns(), timeout=None)
+            version = cache.get(_VERSION_KEY)
+        # Also catches rates added without bumping the version, that's a
+        # single primary key index lookup.
+        last_id = models.CurrencyExchangeRate.objects.aggregate(last_id=Max("id"))
+        return version, last_id["last_id"]
+
+    def _load(self) -> _Rates:
+        records: Dict[Pair, list] = {}
+        for from_currency, to_currency, date, value in (
+            models.CurrencyExchangeRate.objects.order_by("date").values_list(
+                "from_currency", "to_currency", "date", "value"
+            )
+        ):
+            records.setdefault((from_currency, to_currency), []).append(
+                (date.toordinal(), value)
+            )
+
+        recorded = {}
+        for pair, pair_records in records.items():
+            # Keep the first recorded rate if there are a few for one date.
+            ordinals, first = np.unique(
+                np.array([ordinal for ordinal, _ in pair_records], dtype=np.int64),
+                return_index=True,
+            )
+            values = np.empty(len(pair_records), dtype=object)
+            values[:] = [value for _, value in pair_records]
+            recorded[pair] = _RateSeries(ordinals, values[first])
+        return _Rates(recorded)
+
+    def _is_fresh(self) -> bool:
+        checked_at = self._checked_at
+        return (
+            checked_at is not None and time.monotonic() - checked_at < CHECK_INTERVAL
+        )
+
+    def _current(self) -> _Rates:
+        """Rates to serve lookups from, reloaded first if they changed."""
+        if not self._is_fresh():
+            with self._lock:
+                if not self._is_fresh():
+                    token = self._current_token()
+                    if token != self._token:
+                        self._rates = self._load()
+                        self._token = token
+                    self._checked_at = time.monotonic()
+        return self._rates
+
+    def expire(self) -> None:
+        """Makes the next lookup check whether rates changed."""
+        self._checked_at = None
+
+    def get_closest(
+        self,
+        date: datetime.date,
+        from_currency: "models.Currency",
+        to_currency: "models.Currency",
+    ) -> Optional[ExchangeRate]:
+        """Rate on the date or the closest one before, or after if there's none."""
+        if isinstance(date, str):
+            # Same as for queries, ISO formatted dates are fine.
+            date = datetime.date.fromisoformat(date)
+        series = self._current().series((from_currency, to_currency))
+        if series is None:
+            return None
+        rate_date, value = series.closest(date)
+        return ExchangeRate(rate_date, from_currency, to_currency, value)
+
+    def get_latest(
+        self, from_currency: "models.Currency", to_currency: "models.Currency"
+    ) -> Optional[ExchangeRate]:
+        series = self._current().series((from_currency, to_currency))
+        if series is None:
+            return None
+        date, value = series.latest()
+        return ExchangeRate(date, from_currency, to_currency, value)
+
+    def get_all_latest(self) -> List[ExchangeRate]:
+        """Latest rates of all pairs of currencies, recorded or derived."""
+        rates = self._current()
+        latest = []
+        for pair in itertools.permutations(models.Currency, 2):
+            series = rates.series(pair)
+            if series is not None:
+                date, value = series.latest()
+                latest.append(ExchangeRate(date, pair[0], pair[1], value))
+        return latest
+
+    def get_between(
+        self,
+        from_date: datetime.date,
+        to_date: datetime.date,
+        from_currency: "models.Currency",
+        to_currency: "models.Currency",
+    ) -> List[Tuple[datetime.date, decimal.Decimal]]:
+        """Rates between the dates, inclusive, from the latest one."""
+        series = self._current().series((from_currency, to_currency))
+        if series is None:
+            return []
+        return series.between(from_date, to_date)
+
+
+_store = ExchangeRateStore()
+
+
+def get_closest(
+    date: datetime.date,
+    from_currency: "models.Currency",
+    to_currency: "models.Currency",
+) -> Optional[ExchangeRate]:
+    return _store.get_closest(date, from_currency, to_currency)
+
+
+def get_latest(
+    from_currency: "models.Currency", to_currency: "models.Currency"
+) -> Optional[ExchangeRate]:
+    return _store.get_latest(from_currency, to_currency)
+
+
+def get_all_latest() -> List[ExchangeRate]:
+    return _store.get_all_latest()
+
+
+def get_between(
+    from_date: datetime.date,
+    to_date: datetime.date,
+    from_currency: "models.Currency",
+    to_currency: "models.Currency",
+) -> List[Tuple[datetime.date, decimal.Decimal]]:
+    return _store.get_between(from_date, to_date, from_currency, to_currency)
+
+
+def expire() -> None:
+    """Makes the store of this process check whether rates changed."""
+    _store.expire()
+
+
+def invalidate() -> None:
+    """Makes stores of all processes reload the rates."""
+    try:
+        cache.incr(_VERSION_KEY)
+    except ValueError:
+        cache.add(_VERSION_KEY, time.time_ns(), timeout=None)
+    _store.expire()
+
+
+@receiver(request_started)
+def _expire_on_request(sender, **kwargs) -> None:
+    _store.expire()
+
+
+@receiver(post_save, sender="finance.CurrencyExchangeRate")
+@receiver(post_delete, sender="finance.CurrencyExchangeRate")
+def _invalidate_on_change(sender, **kwargs) -> None:
+    invalidate()
@@ -0,0 +1,64 @@
+"""Fingerprints identifying transactions and events with the same values.
+
+A fingerprint is a hash of the values as they are stored by the database,
+so the same transaction imported twice gets the same fingerprint, whether
+the values come from a file, a form or the database.
+"""
+import datetime
+import decimal
+import hashlib
+import json
+from typing import Any, Sequence
+
+from django.db import models
+from django.utils import timezone
+
+# Fields identifying a transaction within its position.
+TRANSACTION_FIELDS = (
+    "executed_at",
+    "quantity",
+    "price",
+    "transaction_costs",
+    "local_value",
+    "value_in_account_currency",
+    "total_in_account_currency",
+    "order_id",
+)
+
+# Fields identifying an event within its account.
+EVENT_FIELDS = (
+    "executed_at",
+    "event_type",
+    "amount",
+    "withheld_taxes",
+    "position_id",
+    "transaction_id",
+)
+
+
+def _canonical(field: models.Field, value: Any):
+    if value is None:
+        return None
+    value = field.to_python(value)
+    if isinstance(field, models.DecimalField):
+        # Rounded like PostgreSQL does, half away from zero, which has no -0.
+        value = value.quantize(
+            decimal.Decimal(1).scaleb(-field.decimal_places),
+            rounding=decimal.ROUND_HALF_UP,
+            context=decimal.Context(prec=field.max_digits + field.decimal_places),
+        )
+        return format(value if value else abs(value), "f")
+    if isinstance(value, datetime.datetime):
+        if timezone.is_naive(value):
+            value = timezone.make_aware(value)
+        return value.astimezone(datetime.timezone.utc).isoformat()
+    return value
+
+
+def fingerprint(model, fields: Sequence[str], values) -> str:
+    """Fingerprint of the fields of the model, read from the values object."""
+    canonical = [
+        _canonical(model._meta.get_field(field), getattr(values, field))
+        for field in fields
+    ]
+    return hashlib.sha256(json.dumps(canonical).encode()).hexdigest()
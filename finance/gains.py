@@ -1,6 +1,13 @@
+import bisect
+import datetime
+import decimal
+import heapq
+import itertools
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+
 from finance import models
-from django.db import transaction
-from django.db.models import Sum
+from django.db import connection, transaction
+from django.db.models import Q, Sum
 
 
 class SoldBeforeBought(ValueError):
@@ -9,124 +16,468 @@ class SoldBeforeBought(ValueError):
 
 EPSILON = 0.00000000000001
 
+# Lot values are stored with this many decimal places.
+_PLACES = decimal.Decimal(1).scaleb(-10)
 
-@transaction.atomic
-def update_lots(position, transaction=None):
-    """Updates lots of stocks unit bought or sold at the same price.
 
-    If the transactions are added out of order,
-    we recreate the lots for simplicity.
+def _stored(value: decimal.Decimal) -> decimal.Decimal:
+    """Value as it would be read back from the database."""
+    return value.quantize(_PLACES, context=decimal.Context(prec=20))
+
+
+def _cost_basis(buy_transaction, quantity) -> decimal.Decimal:
+    """Cost basis of a part of the bought quantity."""
+    if quantity == buy_transaction.quantity:
+        return buy_transaction.total_in_account_currency
+    return (
+        buy_transaction.total_in_account_currency
+        * quantity
+        / buy_transaction.quantity
+    )
+
+
+def _open_lot(position, buy_transaction, quantity) -> "models.Lot":
+    return models.Lot(
+        quantity=quantity,
+        buy_date=buy_transaction.executed_at.date(),
+        buy_price=buy_transaction.price,
+        cost_basis_account_currency=_stored(_cost_basis(buy_transaction, quantity)),
+        position=position,
+        buy_transaction=buy_transaction,
+    )
+
+
+# Microseconds since the epoch, so that later dates can be ordered first.
+_EPOCH = datetime.datetime(1970, 1, 1, tzinfo=datetime.timezone.utc)
+
+
+def _timestamp(executed_at: datetime.datetime) -> int:
+    return (executed_at - _EPOCH) // datetime.timedelta(microseconds=1)
+
+
+def _sell_order(method: "models.CostBasisMethod", lot: "models.Lot") -> tuple:
+    """Lots with the lowest key are sold first."""
+    buy = lot.buy_transaction
+    if method == models.CostBasisMethod.LIFO:
+        return (-_timestamp(buy.executed_at), -buy.pk)
+    if method == models.CostBasisMethod.HIFO:
+        return (-lot.buy_price, _timestamp(buy.executed_at), buy.pk)
+    # Average cost still sells the oldest lots first, only their cost
+    # basis is averaged.
+    return (_timestamp(buy.executed_at), buy.pk)
+
+
+class LotMatcher:
+    """Matches sells with open lots in memory, in the order of the method.
+
+    Open lots are kept in a heap ordered by the cost basis method, so
+    each lot sold is O(log n). Lots are unsaved model instances, including
+    open lots passed in to continue from. Except for the average cost,
+    values of a lot only depend on its transactions and quantity, so the
+    result doesn't depend on where matching started.
     """
-    # We can either recreate all the lots or just add new ones
-    # and update the sold ones.
-    if (
-        transaction is None
-        # There is just one transaction, it shouldn't matter.
-        or position.transactions.count() == 1
-        # It's a complicated case where the transaction is earlier than
-        # other transactions.
-        or transaction.executed_at
-        < position.transactions.exclude(id=transaction.id)
-        .order_by("-executed_at")
-        .first()
-        .executed_at
+
+    def __init__(
+        self,
+        position,
+        open_lots: Iterable["models.Lot"] = (),
+        method: "models.CostBasisMethod" = models.CostBasisMethod.FIFO,
     ):
-        transactions = position.transactions.order_by("executed_at")
-        position.lots.all().delete()
-    else:
-        # This is the easy case, we will only consider the latest transaction.
-        if transaction.position != position:
-            raise ValueError("Transaction has to be for passed position")
-        transactions = [transaction]
+        self.position = position
+        self.method = method
+        # All lots in the order they were created, split lots keep the
+        # place of the original one and their remainder is added.
+        self.lots: List["models.Lot"] = []
+        self._open: List[Tuple[tuple, int, "models.Lot"]] = []
+        self._pushed = itertools.count()
+        # Quantity and cost basis of all open lots for the average cost.
+        self._pool_quantity = decimal.Decimal(0)
+        self._pool_cost = decimal.Decimal(0)
+        # Realized gain of sells matched by this matcher.
+        self.realized_gain = decimal.Decimal(0)
+        for lot in open_lots:
+            self._push(lot)
 
-    for transaction in transactions:
-        date = transaction.executed_at.date()
+    @property
+    def cost_basis(self) -> decimal.Decimal:
+        return sum(
+            (lot.cost_basis_account_currency for _, _, lot in self._open),
+            decimal.Decimal(0),
+        )
+
+    def _push(self, lot: "models.Lot") -> None:
+        self.lots.append(lot)
+        heapq.heappush(
+            self._open, (_sell_order(self.method, lot), next(self._pushed), lot)
+        )
+        self._pool_quantity += lot.quantity
+        self._pool_cost += _cost_basis(lot.buy_transaction, lot.quantity)
+
+    def add(self, transaction: "models.Transaction") -> None:
         if transaction.quantity > 0:
-            models.Lot.objects.create(
-                quantity=transaction.quantity,
-                buy_date=date,
-                buy_price=transaction.price,
-                cost_basis_account_currency=transaction.total_in_account_currency,
-                position=position,
-                buy_transaction=transaction,
-            )
+            self._push(_open_lot(self.position, transaction, transaction.quantity))
         else:
-            lots = models.Lot.objects.filter(
-                position=position, sell_date=None
-            ).order_by("buy_date")
-            outstanding_quantity = -transaction.quantity
-            for lot in lots:
-                if abs(outstanding_quantity) < EPSILON:
-                    break
-                if outstanding_quantity >= lot.quantity:
-                    # Sell the lot in full.
-                    lot.sell_date = date
-                    lot.sell_transaction = transaction
-                    lot.sell_price = transaction.price
-                    # This is proportional to how much was sold within this lot.
-                    lot.sell_basis_account_currency = -(
-                        transaction.total_in_account_currency
-                        * lot.quantity
-                        / transaction.quantity
-                    )
-                    # Sell is positive, and buy is negative, so adding is fine.
-                    lot.realized_gain_account_currency = (
-                        lot.sell_basis_account_currency
-                        + lot.cost_basis_account_currency
-                    )
-                    lot.save()
-                    outstanding_quantity -= lot.quantity
-                else:
-                    # Split the lot in two and sell the first one.
-                    remaining_quantity = lot.quantity - outstanding_quantity
-                    models.Lot.objects.create(
-                        quantity=remaining_quantity,
-                        buy_date=lot.buy_date,
-                        buy_price=lot.buy_price,
-                        cost_basis_account_currency=lot.cost_basis_account_currency
-                        * remaining_quantity
-                        / lot.quantity,
-                        position=lot.position,
-                        buy_transaction=lot.buy_transaction,
-                    )
-
-                    lot.cost_basis_account_currency = (
-                        lot.cost_basis_account_currency
-                        * outstanding_quantity
-                        / lot.quantity
-                    )
-                    lot.quantity = outstanding_quantity
-                    lot.sell_date = date
-                    lot.sell_transaction = transaction
-                    lot.sell_price = transaction.price
-                    # This is proportional to how much was sold within this lot.
-                    # Since the transaction.quantity is negative, multiply by -1.
-                    lot.sell_basis_account_currency = (
-                        transaction.total_in_account_currency
-                        * lot.quantity
-                        / (-transaction.quantity)
-                    )
-                    # Sell is positive, and buy is negative, so adding is fine.
-                    lot.realized_gain_account_currency = (
-                        lot.sell_basis_account_currency
-                        + lot.cost_basis_account_currency
-                    )
-                    lot.save()
-                    outstanding_quantity -= outstanding_quantity
-
-            if abs(outstanding_quantity) > EPSILON:
-                raise SoldBeforeBought(
-                    f"Invalid transactions for position: {position}, selling more than owned (potentially transactions added with wrong dates)."
+            self._sell(transaction)
+
+    def _sold_cost_basis(self, lot: "models.Lot") -> decimal.Decimal:
+        if self.method != models.CostBasisMethod.AVERAGE:
+            return _cost_basis(lot.buy_transaction, lot.quantity)
+        return self._pool_cost * lot.quantity / self._pool_quantity
+
+    def _sell(self, transaction):
+        date = transaction.executed_at.date()
+        outstanding_quantity = -transaction.quantity
+        while self._open and abs(outstanding_quantity) >= EPSILON:
+            key, pushed, lot = self._open[0]
+            if outstanding_quantity >= lot.quantity:
+                # Sell the lot in full.
+                heapq.heappop(self._open)
+                outstanding_quantity -= lot.quantity
+            else:
+                # Split the lot in two and sell the first one, the remainder
+                # takes its place in the heap.
+                remainder = _open_lot(
+                    lot.position,
+                    lot.buy_transaction,
+                    lot.quantity - outstanding_quantity,
                 )
-    _update_position_fields(position)
-
-def _update_position_fields(position):
-    realized_gain = position.lots.aggregate(
-        realized_gain=Sum("realized_gain_account_currency")
-    )["realized_gain"]
-    position.realized_gain = realized_gain or 0
-    cost_basis = position.lots.filter(sell_transaction=None).aggregate(
-        cost_basis=Sum("cost_basis_account_currency")
-    )["cost_basis"]
-    position.cost_basis = cost_basis or 0
-    position.save()
+                self.lots.append(remainder)
+                self._open[0] = (key, pushed, remainder)
+                lot.quantity = outstanding_quantity
+                outstanding_quantity = 0
+
+            cost_basis = self._sold_cost_basis(lot)
+            self._pool_quantity -= lot.quantity
+            self._pool_cost -= cost_basis
+            # This is proportional to how much was sold within this lot,
+            # since the transaction.quantity is negative, multiply by -1.
+            sell_basis = -(
+                transaction.total_in_account_currency
+                * lot.quantity
+                / transaction.quantity
+            )
+            # Sell is positive, and buy is negative, so adding is fine.
+            realized_gain = sell_basis + cost_basis
+
+            lot.cost_basis_account_currency = _stored(cost_basis)
+            lot.sell_date = date
+            lot.sell_transaction = transaction
+            lot.sell_price = transaction.price
+            lot.sell_basis_account_currency = _stored(sell_basis)
+            lot.realized_gain_account_currency = _stored(realized_gain)
+            self.realized_gain += lot.realized_gain_account_currency
+
+        if abs(outstanding_quantity) > EPSILON:
+            raise SoldBeforeBought(
+                f"Invalid transactions for position: {self.position}, selling more than owned (potentially transactions added with wrong dates)."
+            )
+
+    def finish(self) -> None:
+        """Spreads the average cost over open lots, after the last transaction."""
+        if self.method != models.CostBasisMethod.AVERAGE:
+            return
+        for _, _, lot in self._open:
+            lot.cost_basis_account_currency = _stored(
+                self._pool_cost * lot.quantity / self._pool_quantity
+            )
+
+
+def match_lots(
+    position,
+    transactions: Iterable["models.Transaction"],
+    open_lots: Iterable["models.Lot"] = (),
+    method: "models.CostBasisMethod" = models.CostBasisMethod.FIFO,
+) -> LotMatcher:
+    """Lots of the position resulting from transactions in execution order."""
+    matcher = LotMatcher(position, open_lots, method)
+    for transaction in transactions:
+        matcher.add(transaction)
+    matcher.finish()
+    return matcher
+
+
+def compare(
+    position,
+    method: "models.CostBasisMethod",
+    transactions: Optional[Iterable["models.Transaction"]] = None,
+) -> LotMatcher:
+    """Lots of the position with another cost basis method, without saving them.
+
+    Transactions have to be in execution order, they are queried if they
+    aren't passed.
+    """
+    if transactions is None:
+        transactions = position.transactions.order_by("executed_at", "id")
+    return match_lots(position, transactions, method=method)
+
+
+def _rewound_lots(since: datetime.datetime) -> Q:
+    """Lots that have to be matched again for transactions since the time.
+
+    These are lots bought or sold on or after the time, lots still open,
+    and lots which lost their sell transaction, as it was deleted.
+    """
+    return (
+        Q(sell_transaction=None)
+        | Q(sell_transaction__executed_at__gte=since)
+        | Q(buy_transaction__executed_at__gte=since)
+    )
+
+
+def _open_lots_at(position, since: datetime.datetime) -> List["models.Lot"]:
+    """Lots open right before the time, oldest first.
+
+    Parts of a lot bought earlier but sold or split since then are merged
+    back together.
+    """
+    quantities: Dict[int, decimal.Decimal] = {}
+    buy_transactions = {}
+    for lot in (
+        position.lots.filter(_rewound_lots(since))
+        .filter(buy_transaction__executed_at__lt=since)
+        .select_related("buy_transaction")
+        .order_by("buy_transaction__executed_at", "buy_transaction_id")
+    ):
+        quantities.setdefault(lot.buy_transaction_id, decimal.Decimal(0))
+        quantities[lot.buy_transaction_id] += lot.quantity
+        buy_transactions[lot.buy_transaction_id] = lot.buy_transaction
+    return [
+        _open_lot(position, buy_transactions[id], quantity)
+        for id, quantity in quantities.items()
+    ]
+
+
+_LOT_FIELDS = (
+    "quantity",
+    "buy_date",
+    "buy_price",
+    "cost_basis_account_currency",
+    "sell_date",
+    "sell_price",
+    "sell_basis_account_currency",
+    "realized_gain_account_currency",
+    "sell_transaction",
+)
+
+
+def _lot_values(lot: "models.Lot") -> tuple:
+    return tuple(
+        getattr(lot, models.Lot._meta.get_field(field).attname)
+        for field in _LOT_FIELDS
+    )
+
+
+def _save_lots(old_lots: List["models.Lot"], new_lots: List["models.Lot"]) -> None:
+    """Replaces old lots with new ones, keeping ids of lots of the same buy.
+
+    New lots take the ids of old lots of their buy transaction in order, only
+    lots which changed are updated. Only surplus lots are deleted or created.
+    """
+    old_by_buy: Dict[int, List["models.Lot"]] = {}
+    for lot in sorted(old_lots, key=lambda lot: lot.pk, reverse=True):
+        old_by_buy.setdefault(lot.buy_transaction_id, []).append(lot)
+
+    changed = []
+    created = []
+    for lot in new_lots:
+        old = old_by_buy.get(lot.buy_transaction_id)
+        if not old:
+            created.append(lot)
+            continue
+        old_lot = old.pop()
+        lot.pk = old_lot.pk
+        if _lot_values(lot) != _lot_values(old_lot):
+            changed.append(lot)
+
+    removed = [lot.pk for old in old_by_buy.values() for lot in old]
+    if removed:
+        models.Lot.objects.filter(pk__in=removed).delete()
+    if changed:
+        models.Lot.objects.bulk_update(changed, _LOT_FIELDS)
+    if created:
+        models.Lot.objects.bulk_create(created)
+
+
+@transaction.atomic
+def update_lots(position, since: Optional[datetime.datetime] = None):
+    """Updates lots of stocks unit bought or sold at the same price.
+
+    Only transactions executed on or after `since` are matched again,
+    starting from lots open at that time, e.g. the earliest transaction
+    added, deleted or corrected. All lots are matched again if it's not
+    passed. Lots are sold in the order of the cost basis method of the
+    account, lots that didn't change keep their ids.
+    """
+    method = position.account.cost_basis_method
+    if method == models.CostBasisMethod.AVERAGE:
+        # The average cost depends on all earlier transactions.
+        since = None
+    transactions = position.transactions.order_by("executed_at", "id")
+    if since is None:
+        old_lots = list(position.lots.all())
+        matcher = match_lots(position, transactions, method=method)
+        realized_gain = matcher.realized_gain
+    else:
+        open_lots = _open_lots_at(position, since)
+        matcher = match_lots(
+            position,
+            transactions.filter(executed_at__gte=since),
+            open_lots,
+            method=method,
+        )
+        kept_realized_gain = (
+            position.lots.exclude(_rewound_lots(since))
+            .aggregate(total=Sum("realized_gain_account_currency"))
+            .get("total")
+        )
+        old_lots = list(position.lots.filter(_rewound_lots(since)))
+        realized_gain = (kept_realized_gain or 0) + matcher.realized_gain
+
+    _save_lots(old_lots, matcher.lots)
+    position.realized_gain = realized_gain
+    position.cost_basis = matcher.cost_basis
+    # The quantity is changed by AccountRepository at the same time.
+    position.save(update_fields=["realized_gain", "cost_basis", "last_modified"])
+
+
+# Running sum of quantities of every transaction of the positions, in the
+# execution order. Transactions since the checked time of their position
+# after which more is sold than owned are returned.
+_OVERSOLD_POSITIONS_SQL = """
+SELECT DISTINCT owned.position_id
+FROM (
+    SELECT
+        t.position_id,
+        t.executed_at,
+        SUM(t.quantity) OVER (
+            PARTITION BY t.position_id ORDER BY t.executed_at, t.id
+        ) AS quantity
+    FROM {transaction_table} t
+    WHERE t.position_id = ANY(%(position_ids)s)
+) owned
+JOIN unnest(%(position_ids)s::bigint[], %(since)s::timestamptz[])
+    AS checked(position_id, since) ON checked.position_id = owned.position_id
+WHERE owned.quantity < %(lowest)s
+    AND (checked.since IS NULL OR owned.executed_at >= checked.since)
+"""
+
+
+def check_quantities_many(
+    since: Dict["models.Position", Optional[datetime.datetime]]
+) -> None:
+    """Raises SoldBeforeBought if lots of any of the positions can't be matched.
+
+    That's the case if more is sold than owned at any point since the time
+    of the position, the same check as matching lots does, without computing
+    them. All positions are checked with a single query.
+    """
+    if not since:
+        return
+    positions = {position.pk: position for position in since}
+    with connection.cursor() as cursor:
+        cursor.execute(
+            _OVERSOLD_POSITIONS_SQL.format(
+                transaction_table=models.Transaction._meta.db_table
+            ),
+            {
+                "position_ids": list(positions.keys()),
+                "since": list(since.values()),
+                "lowest": decimal.Decimal(-EPSILON),
+            },
+        )
+        oversold = cursor.fetchone()
+    if oversold is not None:
+        raise SoldBeforeBought(
+            f"Invalid transactions for position: {positions[oversold[0]]}, selling more than owned (potentially transactions added with wrong dates)."
+        )
+
+
+def check_quantities(position, since: Optional[datetime.datetime] = None):
+    """Raises SoldBeforeBought if lots of the position can't be matched."""
+    check_quantities_many({position: since})
+
+
+class QuantityChecker:
+    """Checks transactions to add against existing ones, without saving them.
+
+    Transactions have to be added in execution order, after the existing
+    transactions executed at the same time. Existing transactions executed
+    later still have to be covered after each one is added.
+    """
+
+    def __init__(
+        self,
+        position,
+        quantities: Sequence[Tuple[datetime.datetime, decimal.Decimal]],
+    ):
+        """Quantities are the execution times and quantities of existing ones."""
+        self.position = position
+        self._times = [executed_at for executed_at, _ in quantities]
+        # Quantity owned after each existing transaction.
+        self._owned = list(itertools.accumulate(quantity for _, quantity in quantities))
+        # Lowest quantity owned from each existing transaction on.
+        self._lowest = list(itertools.accumulate(reversed(self._owned), min))[::-1]
+        self._added = decimal.Decimal(0)
+
+    def add(self, executed_at: datetime.datetime, quantity: decimal.Decimal) -> None:
+        """Raises SoldBeforeBought if more would be sold than owned at any point."""
+        index = bisect.bisect_right(self._times, executed_at)
+        lowest = self._owned[index - 1] if index else decimal.Decimal(0)
+        if index < len(self._lowest):
+            lowest = min(lowest, self._lowest[index])
+        if lowest + self._added + quantity < -EPSILON:
+            raise SoldBeforeBought(
+                f"Invalid transactions for position: {self.position}, selling more than owned (potentially transactions added with wrong dates)."
+            )
+        self._added += quantity
+
+
+# Queued positions keep the earliest time, or none if all lots are to be
+# recomputed.
+_MARK_PENDING_SQL = """
+INSERT INTO {pending_table} (position_id, since)
+SELECT * FROM unnest(%(position_ids)s::bigint[], %(since)s::timestamptz[])
+ON CONFLICT (position_id) DO UPDATE SET since = CASE
+    WHEN {pending_table}.since IS NULL OR EXCLUDED.since IS NULL THEN NULL
+    ELSE LEAST({pending_table}.since, EXCLUDED.since)
+END
+"""
+
+
+def mark_pending_many(since: Dict[int, Optional[datetime.datetime]]) -> None:
+    """Queues recomputing lots of positions for transactions since their times.
+
+    Requests for the same position are merged into one, from the earliest
+    time of them. All positions are queued with a single query.
+    """
+    if not since:
+        return
+    with connection.cursor() as cursor:
+        cursor.execute(
+            _MARK_PENDING_SQL.format(pending_table=models.PendingLots._meta.db_table),
+            {"position_ids": list(since.keys()), "since": list(since.values())},
+        )
+
+
+def mark_pending(position_id: int, since: Optional[datetime.datetime] = None):
+    """Queues recomputing lots for transactions executed since the time."""
+    mark_pending_many({position_id: since})
+
+
+@transaction.atomic
+def update_pending_lots(position_id: int) -> bool:
+    """Recomputes queued lots of the position, returns False if there were none."""
+    # Locked in the same order as by AccountRepository, the position is
+    # changed before its lots are queued.
+    list(models.Position.objects.select_for_update().filter(pk=position_id))
+    pending = (
+        models.PendingLots.objects.select_for_update()
+        .select_related("position")
+        .filter(position_id=position_id)
+        .first()
+    )
+    if pending is None:
+        return False
+    update_lots(pending.position, since=pending.since)
+    pending.delete()
+    return True
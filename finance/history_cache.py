@@ -0,0 +1,171 @@
+"""Shared cache of position histories.
+
+Histories are stored in the Django cache under keys built from the
+position id, a per-position version and the requested date range.
+Changing a position bumps its version, so stale entries are never read
+again and simply expire.
+"""
+import datetime
+import time
+from typing import Callable, Dict, List, Optional, Sequence
+
+from django.core.cache import cache
+from django.db import transaction
+
+from finance import models
+
+
+QUANTITY = "quantity"
+VALUE = "value"
+VALUE_ACCOUNT_CURRENCY = "value_account_currency"
+
+# Histories are recomputed at least daily, new prices arrive every night.
+HISTORY_TIMEOUT = 60 * 60 * 24
+
+_EXCHANGE_RATES_VERSION_KEY = "history:exchange-rates-version"
+
+
+def _version_key(position_id: int) -> str:
+    return f"history:position-version:{position_id}"
+
+
+def _new_version() -> int:
+    # Versions start from the current time, so that if a version key was
+    # evicted, entries cached with a previous version can't be read again.
+    return time.time_ns()
+
+
+def _get_versions(keys: Sequence[str]) -> Dict[str, int]:
+    versions = cache.get_many(keys)
+    for key in keys:
+        if key not in versions:
+            cache.add(key, _new_version(), timeout=None)
+            versions[key] = cache.get(key)
+    return versions
+
+
+def _bump(key: str) -> None:
+    try:
+        cache.incr(key)
+    except ValueError:
+        cache.add(key, _new_version(), timeout=None)
+
+
+def _history_key(
+    position_id: int,
+    version: int,
+    kind: str,
+    from_date: datetime.date,
+    to_date: datetime.date,
+    output_period: datetime.timedelta,
+    exchange_rates_version: Optional[int],
+) -> str:
+    key = (
+        f"history:{position_id}:{version}:{kind}:"
+        f"{from_date.isoformat()}:{to_date.isoformat()}:{output_period.days}"
+    )
+    if exchange_rates_version is not None:
+        key += f":{exchange_rates_version}"
+    return key
+
+
+def get_many_or_compute(
+    position_ids: Sequence[int],
+    kind: str,
+    from_date: datetime.date,
+    to_date: datetime.date,
+    output_period: datetime.timedelta,
+    compute: Callable[[List[int]], Dict[int, list]],
+) -> Dict[int, list]:
+    """Returns cached histories, computing the missing ones with a single call."""
+    version_keys = [_version_key(position_id) for position_id in position_ids]
+    if kind == VALUE_ACCOUNT_CURRENCY:
+        version_keys.append(_EXCHANGE_RATES_VERSION_KEY)
+    versions = _get_versions(version_keys)
+    exchange_rates_version = versions.get(_EXCHANGE_RATES_VERSION_KEY)
+
+    history_keys = {
+        position_id: _history_key(
+            position_id,
+            versions[_version_key(position_id)],
+            kind,
+            from_date,
+            to_date,
+            output_period,
+            exchange_rates_version,
+        )
+        for position_id in position_ids
+    }
+    cached = cache.get_many(history_keys.values())
+    histories = {}
+    missing = []
+    for position_id, key in history_keys.items():
+        if key in cached:
+            histories[position_id] = cached[key]
+        else:
+            missing.append(position_id)
+
+    if missing:
+        computed = compute(missing)
+        cache.set_many(
+            {history_keys[position_id]: computed[position_id] for position_id in missing},
+            timeout=HISTORY_TIMEOUT,
+        )
+        histories.update(computed)
+    return histories
+
+
+def get_or_compute(
+    position_id: Optional[int],
+    kind: str,
+    from_date: datetime.date,
+    to_date: datetime.date,
+    output_period: datetime.timedelta,
+    compute: Callable[[], list],
+) -> list:
+    if position_id is None:
+        # Not saved yet, nothing to key the history with.
+        return compute()
+    return get_many_or_compute(
+        [position_id],
+        kind,
+        from_date,
+        to_date,
+        output_period,
+        lambda _: {position_id: compute()},
+    )[position_id]
+
+
+def _invalidate(keys: Sequence[str]) -> None:
+    for key in keys:
+        _bump(key)
+
+    # Bump again once the change is committed, histories computed by other
+    # processes in the meantime could still see the old data.
+    def bump_after_commit():
+        for key in keys:
+            _bump(key)
+
+    transaction.on_commit(bump_after_commit)
+
+
+def invalidate_positions(position_ids: Sequence[int]) -> None:
+    _invalidate([_version_key(position_id) for position_id in position_ids])
+
+
+def invalidate_position(position_id: int) -> None:
+    invalidate_positions([position_id])
+
+
+def invalidate_asset(asset_id: int) -> None:
+    invalidate_positions(
+        list(
+            models.Position.objects.filter(asset_id=asset_id).values_list(
+                "id", flat=True
+            )
+        )
+    )
+
+
+def invalidate_exchange_rates() -> None:
+    _invalidate([_EXCHANGE_RATES_VERSION_KEY])
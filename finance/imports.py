@@ -0,0 +1,99 @@
+"""Imports of uploaded transaction files by workers.
+
+Files too large to be imported within the request are stored in a queued
+`TransactionImport` and imported by `tasks.run_import`. The status and the
+progress of the import are stored while it's running, so clients poll the
+import until it's done. Imports whose task was lost are queued again by
+`tasks.requeue_stale_imports`.
+"""
+import io
+
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from finance import models, tasks
+from finance.integrations import binance_parser, degiro_parser
+
+
+def queue(
+    account: models.Account,
+    integration: models.IntegrationType,
+    transaction_file,
+    import_all_assets: bool = True,
+) -> models.TransactionImport:
+    transaction_import = models.TransactionImport.objects.create(
+        account=account,
+        integration=integration,
+        status=models.ImportStatus.QUEUED,
+        upload=transaction_file.read(),
+        import_all_assets=import_all_assets,
+    )
+    transaction.on_commit(lambda: tasks.run_import.delay(transaction_import.pk))
+    return transaction_import
+
+
+def _stale(now) -> Q:
+    """Imports queued or running for longer than IMPORT_TIMEOUT."""
+    cutoff = now - models.IMPORT_TIMEOUT
+    return Q(status=models.ImportStatus.QUEUED, created_at__lt=cutoff) | Q(
+        status=models.ImportStatus.RUNNING, started_at__lt=cutoff
+    )
+
+
+def requeue_stale() -> int:
+    """Queues again imports whose task was lost, returns how many."""
+    stale_ids = list(
+        models.TransactionImport.objects.filter(_stale(timezone.now())).values_list(
+            "pk", flat=True
+        )
+    )
+    for transaction_import_id in stale_ids:
+        tasks.run_import.delay(transaction_import_id)
+    return len(stale_ids)
+
+
+def run(transaction_import_id: int) -> None:
+    """Imports the upload of the queued import, failures are stored in it.
+
+    Does nothing if the import isn't queued, e.g. if the task was delivered
+    again after it was already run. Imports running for longer than
+    IMPORT_TIMEOUT are run again, the worker running them likely crashed and
+    nothing of the import was written.
+    """
+    now = timezone.now()
+    started = models.TransactionImport.objects.filter(
+        Q(status=models.ImportStatus.QUEUED) | _stale(now),
+        pk=transaction_import_id,
+    ).update(status=models.ImportStatus.RUNNING, started_at=now)
+    if not started:
+        return
+    transaction_import = models.TransactionImport.objects.select_related(
+        "account"
+    ).get(pk=transaction_import_id)
+    upload = io.BytesIO(transaction_import.upload)
+    try:
+        if transaction_import.integration == models.IntegrationType.DEGIRO:
+            degiro_parser.import_transactions_from_file(
+                transaction_import.account,
+                upload,
+                import_all_assets=transaction_import.import_all_assets,
+                transaction_import=transaction_import,
+            )
+        else:
+            binance_parser.import_transactions_from_file(
+                transaction_import.account,
+                upload,
+                transaction_import=transaction_import,
+            )
+    except (
+        degiro_parser.CurrencyMismatch,
+        degiro_parser.InvalidFormat,
+        binance_parser.InvalidFormat,
+    ):
+        # Stored as the issue of the import, like errors of the request.
+        pass
+    finally:
+        models.TransactionImport.objects.filter(pk=transaction_import_id).update(
+            upload=None
+        )
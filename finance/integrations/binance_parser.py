@@ -1,6 +1,6 @@
 import decimal
 import datetime
-from typing import Tuple
+from typing import Optional, Tuple
 
 
 import pandas as pd
@@ -9,10 +9,14 @@ from django.utils.dateparse import parse_datetime
 from django.utils import timezone
 from collections import defaultdict
 
-from finance import accounts, tasks, models
+from finance import accounts, resolution, tasks, models
 from finance.gains import SoldBeforeBought
 from finance.integrations.degiro_parser import CurrencyMismatch
-from finance import prices
+from finance.integrations import schemas
+from finance import exchange_rates, prices
+
+import logging
+logger = logging.getLogger(__name__)
 
 
 BINANCE_SUPPORTED_OPERATIONS = [
@@ -41,17 +45,6 @@ class InvalidFormat(ValueError):
     pass
 
 
-REQUIRED_TRANSACTION_COLUMNS = (
-    "User_ID",
-    "UTC_Time",
-    "Account",
-    "Operation",
-    "Coin",
-    "Change",
-    "Remark",
-)
-
-
 SUPPORTED_FIAT = (
     "EUR",
     "USD",
@@ -59,107 +52,179 @@ SUPPORTED_FIAT = (
 )
 
 # TODO: consider renaming to import history?
-def import_transactions_from_file(account, filename_or_file):
-    try:
-        transaction_import, assets = _import_history_from_file(account, filename_or_file)
-        for asset in assets:
-            if asset.tracked:
-                tasks.collect_prices.delay(asset.pk)
-        return transaction_import
-    except Exception as e:
-        models.TransactionImport.objects.create(
+def import_transactions_from_file(account, filename_or_file, transaction_import=None):
+    """Imports the file, into the queued import if it's run by a worker."""
+    if transaction_import is None:
+        transaction_import = models.TransactionImport.objects.create(
             integration=models.IntegrationType.BINANCE_CSV,
-            status=models.ImportStatus.FAILURE,
+            status=models.ImportStatus.RUNNING,
             account=account,
         )
+    try:
+        assets = _import_history_from_file(
+            account, filename_or_file, transaction_import
+        )
+    except Exception as e:
+        transaction_import.fail(e)
         raise e
+    for asset in assets:
+        if asset.tracked:
+            tasks.collect_prices.delay(asset.pk)
+    return transaction_import
 
 
-@transaction.atomic()
-def _import_history_from_file(account, filename_or_file):
-    failed_records = []
-    successful_records = []
+def _import_history_from_file(account, filename_or_file, transaction_import):
+    """Imports in two phases, resolving the records and then writing them.
 
+    Crypto assets and prices are looked up at the remote API while
+    resolving, outside of transactions, and the import is written in one
+    transaction.
+    """
     try:
-        transactions_data = pd.read_csv(filename_or_file)
-        for column in REQUIRED_TRANSACTION_COLUMNS:
-            if column not in transactions_data.columns:
-                raise InvalidFormat(f"Column: '{column}' missing in the csv file")
-
-        sorted_data = transactions_data.sort_values(by="UTC_Time")
-
-        # Import transfer records.
-        transfer_records = sorted_data[
-            sorted_data["Operation"].isin(("Deposit", "Withdrawal"))
-        ]
-        transfers_successful_records = import_fiat_transfers(account, transfer_records)
-
-        # Import income records.
-        income_records = sorted_data[
-            sorted_data["Operation"].isin(CRYPTO_INCOME_OPERATIONS)
-        ]
-        (income_successful_records, income_failed_records) = import_income_transactions(
-            account, income_records
+        transactions_data = schemas.read_csv(
+            filename_or_file, models.IntegrationType.BINANCE_CSV
         )
-
-        # Import rest of transactions. Transactions are imported last in case some of the
-        # crypto interest is also being sold.
-        transaction_half_records = sorted_data[
-            sorted_data["Operation"] == "Transaction Related"
-        ]
-        if (len(transaction_half_records) % 2 == 1):
-            raise InvalidFormat("Expected even number of Transaction Related records")
-
-        transaction_half_record_pairs = []
-        current_pair = []
-        for i, half_record in enumerate(transaction_half_records.iloc):
-            if i % 2 == 0:
-                current_pair.append(half_record)
-            else:
-                current_pair.append(half_record)
-                transaction_half_record_pairs.append(current_pair)
-                # If the dates are too much apart then, there is probably a problem somewhere!
-                # If they are the part of the same transaction, make sure than they are less than 30 seconds apart.
-                first_date = datetime.datetime.fromisoformat(current_pair[0]['UTC_Time'])
-                second_date = datetime.datetime.fromisoformat(half_record['UTC_Time'])
-                if abs(first_date - second_date) > datetime.timedelta(seconds=30):
-                    raise InvalidFormat("Transaction records likely mismatched, times more than 30 seconds apart")
-                current_pair = []
-
-        for half_records in transaction_half_record_pairs:
-
-            try:
-                fiat_record, token_record = pairs_to_fiat_and_token(half_records)
-                transaction, created, raw_record = import_transaction(
-                    account, fiat_record, token_record
-                )
-                successful_records.append(
-                    {
-                        "record": raw_record,
-                        "transaction": transaction,
-                        "created": created,
-                    }
-                )
-            except SoldBeforeBought as e:
-                failed_records.append(
-                    {
-                        "record": _to_raw_record(half_records),
-                        "issue": str(e),
-                        "issue_type": models.ImportIssueType.SOLD_BEFORE_BOUGHT,
-                    }
-                )
-            except Exception as e:
-                print(e)
-                failed_records.append(
-                    {
-                        "record": _to_raw_record(half_records),
-                        "issue": str(e),
-                        "issue_type": models.ImportIssueType.UNKNOWN_FAILURE,
-                    }
-                )
-
+    except schemas.UnknownLayout as e:
+        raise InvalidFormat(e.args[0])
     except pd.errors.ParserError as e:
         raise InvalidFormat("Failed to parse csv", e)
+    transaction_import.start(steps_total=len(transactions_data))
+
+    sorted_data = transactions_data.sort_values(by="UTC_Time")
+    transfer_records = sorted_data[
+        sorted_data["Operation"].isin(("Deposit", "Withdrawal"))
+    ]
+    income_records = sorted_data[
+        sorted_data["Operation"].isin(CRYPTO_INCOME_OPERATIONS)
+    ]
+    transaction_half_records = sorted_data[
+        sorted_data["Operation"] == "Transaction Related"
+    ]
+    # Rows of other operations aren't written.
+    transaction_import.advance(
+        len(sorted_data)
+        - len(transfer_records)
+        - len(income_records)
+        - len(transaction_half_records)
+    )
+    if (len(transaction_half_records) % 2 == 1):
+        raise InvalidFormat("Expected even number of Transaction Related records")
+
+    transaction_half_record_pairs = []
+    current_pair = []
+    for i, half_record in enumerate(transaction_half_records.iloc):
+        if i % 2 == 0:
+            current_pair.append(half_record)
+        else:
+            current_pair.append(half_record)
+            transaction_half_record_pairs.append(current_pair)
+            # If the dates are too much apart then, there is probably a problem somewhere!
+            # If they are the part of the same transaction, make sure than they are less than 30 seconds apart.
+            first_date = datetime.datetime.fromisoformat(current_pair[0]['UTC_Time'])
+            second_date = datetime.datetime.fromisoformat(half_record['UTC_Time'])
+            if abs(first_date - second_date) > datetime.timedelta(seconds=30):
+                raise InvalidFormat("Transaction records likely mismatched, times more than 30 seconds apart")
+            current_pair = []
+
+    failed_records = []
+    parsed_records = []
+    for half_records in transaction_half_record_pairs:
+        try:
+            fiat_record, token_record = pairs_to_fiat_and_token(half_records)
+            parsed_records.append(
+                parse_transaction(account, fiat_record, token_record)
+            )
+        except Exception as e:
+            logger.error(e)
+            failed_records.append(
+                {
+                    "record": _to_raw_record(half_records),
+                    "issue": str(e),
+                    "issue_type": models.ImportIssueType.UNKNOWN_FAILURE,
+                }
+            )
+
+    resolver = resolution.ImportResolver(account)
+    income_keys = [
+        (_income_symbol(record), _parse_utc_datetime(record["UTC_Time"]).date())
+        for record in income_records.iloc
+    ]
+    resolver.fetch_remote(
+        crypto_symbols={record.symbol for record, _ in parsed_records}
+        | {symbol for symbol, _ in income_keys},
+        crypto_prices=income_keys,
+        transaction_import=transaction_import,
+    )
+    # Both half records of transactions that failed to parse aren't written.
+    transaction_import.advance(2 * len(failed_records))
+    return _write_import(
+        account,
+        transfer_records,
+        income_records,
+        parsed_records,
+        failed_records,
+        resolver,
+        transaction_import,
+    )
+
+
+@transaction.atomic()
+def _write_import(
+    account,
+    transfer_records,
+    income_records,
+    parsed_records,
+    failed_records,
+    resolver,
+    transaction_import,
+):
+    failed_records = list(failed_records)
+    successful_records = []
+
+    # Import transfer records.
+    transfers_successful_records = import_fiat_transfers(account, transfer_records)
+    transaction_import.advance(len(transfer_records))
+
+    # Import income records.
+    (income_successful_records, income_failed_records) = import_income_transactions(
+        account, income_records, resolver, transaction_import
+    )
+
+    # Import rest of transactions. Transactions are imported last in case some of the
+    # crypto interest is also being sold.
+    account_repository = accounts.AccountRepository(
+        defer_lots=True, batch_related_changes=True
+    )
+    results = []
+    for start in range(0, len(parsed_records), models.IMPORT_WRITE_BATCH_SIZE):
+        batch = parsed_records[start : start + models.IMPORT_WRITE_BATCH_SIZE]
+        results.extend(
+            account_repository.add_transactions_bulk(
+                account, [record for record, _ in batch], resolver=resolver
+            )
+        )
+        # Every transaction is written from a pair of half records.
+        transaction_import.advance(2 * len(batch))
+    account_repository.sync_balances()
+    for (_, raw_record), result in zip(parsed_records, results):
+        if result.error is None:
+            successful_records.append(
+                {
+                    "record": raw_record,
+                    "transaction": result.transaction,
+                    "created": result.created,
+                }
+            )
+        else:
+            failed_records.append(
+                {
+                    "record": raw_record,
+                    "issue": str(result.error),
+                    "issue_type": models.ImportIssueType.SOLD_BEFORE_BOUGHT
+                    if isinstance(result.error, SoldBeforeBought)
+                    else models.ImportIssueType.UNKNOWN_FAILURE,
+                }
+            )
 
     status = models.ImportStatus.SUCCESS
     if failed_records or income_failed_records:
@@ -168,11 +233,7 @@ def _import_history_from_file(account, filename_or_file):
         else:
             status = models.ImportStatus.FAILURE
 
-    transaction_import = models.TransactionImport.objects.create(
-        integration=models.IntegrationType.BINANCE_CSV,
-        status=status,
-        account=account,
-    )
+    transaction_import.finish(status)
     assets = []
     for entry in failed_records:
         models.TransactionImportRecord.objects.create(
@@ -222,7 +283,7 @@ def _import_history_from_file(account, filename_or_file):
         )
         assets.append(entry["transaction"].position.asset)
 
-    return transaction_import, assets
+    return assets
 
 
 def to_decimal(pd_f, precision=10) -> decimal.Decimal:
@@ -245,7 +306,8 @@ def _parse_utc_datetime(datetime_raw):
 
 
 def import_fiat_transfers(account, records):
-    account_repository = accounts.AccountRepository()
+    # The balance is synced once all transfers are recorded.
+    account_repository = accounts.AccountRepository(batch_related_changes=True)
     successful_records = []
 
     for record in records.iloc:
@@ -261,7 +323,7 @@ def import_fiat_transfers(account, records):
         if fiat_currency != models.Currency(account.currency).label:
             from_currency = models.currency_enum_from_string(fiat_currency)
             to_currency = account.currency
-            exchange_rate = prices.get_closest_exchange_rate(
+            exchange_rate = exchange_rates.get_closest(
                 executed_at.date(), from_currency, to_currency
             )
             if exchange_rate is None:
@@ -286,14 +348,15 @@ def import_fiat_transfers(account, records):
                 "created": created,
             }
         )
+    account_repository.sync_balances()
     return successful_records
 
 
-def import_transaction(
+def parse_transaction(
     account: models.Account,
     fiat_record: pd.Series,
     token_record: pd.Series,
-) -> Tuple[models.Transaction, bool]:
+) -> Tuple[accounts.TransactionRecord, str]:
     raw_record = _to_raw_record((fiat_record, token_record))
     executed_at = _parse_utc_datetime(fiat_record["UTC_Time"])
     symbol = token_record["Coin"]
@@ -304,7 +367,7 @@ def import_transaction(
 
     if fiat_currency != models.Currency(account.currency).label:
         to_currency = account.currency
-        exchange_rate = prices.get_closest_exchange_rate(
+        exchange_rate = exchange_rates.get_closest(
             executed_at.date(), from_currency, to_currency
         )
         if exchange_rate is None:
@@ -318,7 +381,7 @@ def import_transaction(
         fiat_value_usd = raw_fiat_value
     else:
         to_currency = models.Currency.USD
-        exchange_rate = prices.get_closest_exchange_rate(
+        exchange_rate = exchange_rates.get_closest(
             executed_at.date(), from_currency, to_currency
         )
         if exchange_rate is None:
@@ -333,15 +396,15 @@ def import_transaction(
         price = decimal.Decimal(-fiat_value_usd / quantity)
 
     return (
-        *accounts.AccountRepository().add_transaction_crypto_asset(
-            account,
-            symbol,
-            executed_at,
-            quantity,
-            price,
-            fiat_value_usd,
-            fiat_value,
-            fiat_value,
+        accounts.TransactionRecord(
+            symbol=symbol,
+            executed_at=executed_at,
+            quantity=quantity,
+            price=price,
+            transaction_costs=None,
+            local_value=fiat_value_usd,
+            value_in_account_currency=fiat_value,
+            total_in_account_currency=fiat_value,
         ),
         raw_record,
     )
@@ -367,16 +430,33 @@ def pairs_to_fiat_and_token(half_records):
     return fiat_record, token_record
 
 
+def _income_symbol(record) -> str:
+    if record["Operation"] == "ETH 2.0 Staking Rewards":
+        # In binance, ETH is exchanged for BETH, but it's actually ETH.
+        return "ETH"
+    return record["Coin"]
+
+
 @transaction.atomic
-def import_income_transactions(account: models.Account, records: pd.DataFrame):
+def import_income_transactions(
+    account: models.Account,
+    records: pd.DataFrame,
+    resolver: Optional[resolution.ImportResolver] = None,
+    transaction_import: Optional[models.TransactionImport] = None,
+):
     successful_records = []
     failed_records = []
+    resolver = resolver or resolution.ImportResolver(account)
+    # The balance is synced once all income is recorded.
+    account_repository = accounts.AccountRepository(
+        defer_lots=True, batch_related_changes=True
+    )
 
     for record in records.iloc:
         raw_record = record.to_csv()
         executed_at = _parse_utc_datetime(record["UTC_Time"])
         executed_at_date = executed_at.date()
-        symbol = record["Coin"]
+        symbol = _income_symbol(record)
         quantity = to_decimal(record["Change"])
 
         if record["Operation"] == "POS savings interest":
@@ -385,20 +465,18 @@ def import_income_transactions(account: models.Account, records: pd.DataFrame):
             event_type = models.EventType.SAVINGS_INTEREST
         elif record["Operation"] == "ETH 2.0 Staking Rewards":
             event_type = models.EventType.STAKING_INTEREST
-            # In binance, ETH is exchanged for BETH, but it's actually ETH.
-            symbol = "ETH"
         else:
             raise InvalidFormat(f"Unsupported Operation: '{record['Operation']}'")
 
         try:
-            price = prices.get_crypto_usd_price_at_date(symbol, date=executed_at_date)
+            price = resolver.crypto_usd_price(symbol, executed_at_date)
 
             fiat_value_usd = -quantity * price
             fiat_value = convert_usd_to_account_currency(
                 fiat_value_usd, account, executed_at_date
             )
 
-            event, created = accounts.AccountRepository().add_crypto_income_event(
+            event, created = account_repository.add_crypto_income_event(
                 account,
                 symbol,
                 executed_at,
@@ -407,6 +485,7 @@ def import_income_transactions(account: models.Account, records: pd.DataFrame):
                 fiat_value_usd,
                 fiat_value,
                 event_type,
+                resolver=resolver,
             )
             successful_records.append(
                 {
@@ -432,6 +511,9 @@ def import_income_transactions(account: models.Account, records: pd.DataFrame):
                     "issue_type": models.ImportIssueType.UNKNOWN_FAILURE,
                 }
             )
+        if transaction_import is not None:
+            transaction_import.advance()
+    account_repository.sync_balances()
     return successful_records, failed_records
 
 
@@ -443,7 +525,7 @@ def convert_usd_to_account_currency(
 
     from_currency = models.Currency.USD
     to_currency = account.currency
-    exchange_rate = prices.get_closest_exchange_rate(date, from_currency, to_currency)
+    exchange_rate = exchange_rates.get_closest(date, from_currency, to_currency)
     if exchange_rate is None:
         raise CurrencyMismatch(
             "Couldn't convert USD to account currency, missing exchange rate"
@@ -1,13 +1,14 @@
 import datetime
 import decimal
-from typing import Tuple
+import itertools
+from typing import List, NamedTuple, Optional
 
-import re
 import pandas as pd
 from django.db import transaction
 
-from finance import accounts, models, stock_exchanges
+from finance import accounts, models, resolution
 from finance.gains import SoldBeforeBought
+from finance.integrations import schemas
 
 import logging
 logger = logging.getLogger(__name__)
@@ -20,181 +21,291 @@ class InvalidFormat(ValueError):
     pass
 
 
-REQUIRED_TRANSACTION_COLUMNS = (
-    "Date",
-    "Time",
-    "ISIN",
-    "Local value",
-    "Total",
-    "Value",
-    "Transaction costs",
-    "Order ID",
-    "Quantity",
-    "Price",
-    "Value currency",
-    "Local value currency",
-    "Venue",
-    "Reference",
-    "Product",
-)
-
-
-_DATE_FORMAT = "%Y-%m-%d %H:%M%z"
-
-
-def import_transaction(
-    account: models.Account, transaction_record: pd.Series, import_all_assets,
-) -> Tuple[models.Transaction, bool]:
-    executed_at = transaction_record["Datetime"]
-    isin = transaction_record["ISIN"]
-    local_value = transaction_record["Local value"]
-    total_in_account_currency = transaction_record["Total"]
-    value_in_account_currency = transaction_record["Value"]
-    transaction_costs = transaction_record["Transaction costs"].astype(str)
-    order_id = transaction_record["Order ID"]
-    quantity = transaction_record["Quantity"]
-    price = transaction_record["Price"]
-    account_currency = transaction_record["Value currency"]
-    local_currency = transaction_record["Local value currency"]
-    product = transaction_record["Product"]
-
-
-    if models.currency_enum_from_string(account_currency) != account.currency:
+class DegiroRow(NamedTuple):
+    """A row of a Degiro export, normalized column-wise when it's read.
+
+    Numbers are exact decimals of the text in the file, None if they're
+    missing or aren't numbers.
+    """
+
+    raw_record: str
+    executed_at: Optional[datetime.datetime]
+    date: str
+    time: str
+    isin: str
+    product: str
+    reference: str
+    venue: str
+    quantity: Optional[decimal.Decimal]
+    price: Optional[decimal.Decimal]
+    local_value: Optional[decimal.Decimal]
+    value: Optional[decimal.Decimal]
+    total: Optional[decimal.Decimal]
+    transaction_costs: Optional[decimal.Decimal]
+    local_currency: str
+    value_currency: str
+    order_id: Optional[str]
+
+
+def parse_transaction(
+    account: models.Account,
+    transaction_record: DegiroRow,
+    import_all_assets,
+    resolver: resolution.ImportResolver,
+) -> accounts.TransactionRecord:
+    if transaction_record.executed_at is None:
+        raise ValueError(
+            f"Failed to parse the date and time: {transaction_record.date} {transaction_record.time}"
+        )
+    numbers = (
+        transaction_record.quantity,
+        transaction_record.price,
+        transaction_record.local_value,
+        transaction_record.value,
+        transaction_record.total,
+    )
+    if any(number is None for number in numbers):
+        raise ValueError("Failed to parse the quantity, price or values")
+
+    if (
+        models.currency_enum_from_string(transaction_record.value_currency)
+        != account.currency
+    ):
         raise CurrencyMismatch("Currency of import didn't match the account")
-    exchange_mic = transaction_record["Venue"]
-    exchange_ref = transaction_record["Reference"]
     try:
-        exchange = stock_exchanges.ExchangeRepository().get(exchange_mic, exchange_ref)
+        exchange = resolver.exchange(
+            transaction_record.venue, transaction_record.reference
+        )
     except Exception as e:
         logger.error(e)
         raise e
-    def to_decimal(pd_f):
-        return decimal.Decimal(pd_f.astype(str))
-
-    transaction_costs = decimal.Decimal(transaction_costs)
-    if transaction_costs.is_nan():
-        transaction_costs = None
-    return accounts.AccountRepository().add_transaction(
-        account,
-        isin=isin,
+
+    return accounts.TransactionRecord(
+        isin=transaction_record.isin,
         exchange=exchange,
-        executed_at=executed_at,
-        quantity=to_decimal(quantity),
-        price=to_decimal(price),
-        transaction_costs=transaction_costs,
-        local_value=to_decimal(local_value),
-        value_in_account_currency=to_decimal(value_in_account_currency),
-        total_in_account_currency=to_decimal(total_in_account_currency),
-        order_id=order_id,
-        asset_defaults={"local_currency": local_currency, "name": product},
+        executed_at=transaction_record.executed_at,
+        quantity=transaction_record.quantity,
+        price=transaction_record.price,
+        transaction_costs=transaction_record.transaction_costs,
+        local_value=transaction_record.local_value,
+        value_in_account_currency=transaction_record.value,
+        total_in_account_currency=transaction_record.total,
+        order_id=transaction_record.order_id,
+        asset_defaults={
+            "local_currency": transaction_record.local_currency,
+            "name": transaction_record.product,
+        },
         import_all_assets=import_all_assets,
     )
 
 
-def import_transactions_from_file(account, filename_or_file, import_all_assets):
-    try:
-        return _import_transactions_from_file(account, filename_or_file, import_all_assets)
-    except Exception as e:
-        models.TransactionImport.objects.create(
+def import_transactions_from_file(
+    account, filename_or_file, import_all_assets, transaction_import=None
+):
+    """Imports the file, into the queued import if it's run by a worker."""
+    if transaction_import is None:
+        transaction_import = models.TransactionImport.objects.create(
             integration=models.IntegrationType.DEGIRO,
-            status=models.ImportStatus.FAILURE,
+            status=models.ImportStatus.RUNNING,
             account=account,
         )
+    try:
+        return _import_transactions_from_file(
+            account, filename_or_file, import_all_assets, transaction_import
+        )
+    except Exception as e:
+        transaction_import.fail(e)
         raise e
 
 
-def _transform_to_datetime(transaction_record):
-    date = transaction_record["Date"]
-    try:
-        day, month, year = date.split("-")
-        time = transaction_record["Time"]
-        return datetime.datetime.strptime(f"{year}-{month}-{day} {time}Z", _DATE_FORMAT)
-    except:
-        try:
-            day, month, year_end_digits = date.split(".")
-            time = transaction_record["Time"]
-            return datetime.datetime.strptime(f"20{year_end_digits}-{month}-{day} {time}Z", _DATE_FORMAT)
-        except:
-            return None
+def _to_datetimes(dates: pd.Series, times: pd.Series) -> pd.Series:
+    """Times in UTC, of dates like 18-11-2021 or 18.11.21, NaT otherwise."""
+    times = " " + times.str.strip()
+    dates = dates.str.strip()
+    executed_at = pd.to_datetime(
+        dates + times, format="%d-%m-%Y %H:%M", errors="coerce", utc=True
+    )
+    short_dates = dates.str.replace(
+        r"^(\d{2})\.(\d{2})\.(\d{2})$", r"\1.\2.20\3", regex=True
+    )
+    return executed_at.fillna(
+        pd.to_datetime(
+            short_dates + times, format="%d.%m.%Y %H:%M", errors="coerce", utc=True
+        )
+    )
 
 
-@transaction.atomic()
-def _import_transactions_from_file(account, filename_or_file, import_all_assets):
-    failed_records = []
-    successful_records = []
+def _to_decimals(values: pd.Series) -> List[Optional[decimal.Decimal]]:
+    # Only text which is a number is converted, the rest is missing.
+    is_number = pd.to_numeric(values, errors="coerce").notna()
+    return [
+        decimal.Decimal(value) if number else None
+        for value, number in zip(values, is_number)
+    ]
+
+
+def _to_optional(values: pd.Series) -> List[Optional[str]]:
+    return values.astype(object).where(values.notna(), None).tolist()
+
+
+def _quoted(values: pd.Series) -> pd.Series:
+    """Values quoted like by the csv module, if they need to be."""
+    needs_quotes = values.str.contains('[,"\r\n]', regex=True)
+    return values.where(
+        ~needs_quotes, '"' + values.str.replace('"', '""', regex=False) + '"'
+    )
+
+
+def _to_raw_records(data: pd.DataFrame) -> pd.Series:
+    """Rows as csv lines of columns and values, built column by column."""
+    raw_records = "," + data.index.astype(str).to_series(index=data.index) + "\n"
+    for column in data.columns:
+        name = _quoted(pd.Series([column]))[0]
+        raw_records += (
+            f"{name}," + _quoted(data[column].fillna("").astype(str)) + "\n"
+        )
+    return raw_records
+
+
+def read_transactions(filename_or_file) -> List[DegiroRow]:
+    """Rows of the export sorted by the time they were executed at.
+
+    Columns are read as text and normalized at once, the rows aren't
+    visited by pandas one at a time.
+    """
     try:
-        transactions_data = pd.read_csv(filename_or_file)
-
-        # If data is in the same format, but the column names are different
-        # (e.g. different languages, test and try to map by changing headers).
-        data_in_reference_format = pd.read_csv("./finance/transactions_example_latest.csv")
-        data_column_list = list(transactions_data.columns)
-        reference_data_column_list = list(data_in_reference_format.columns)
-        if data_column_list != reference_data_column_list:
-            if len(data_column_list) == len(reference_data_column_list):
-                first_column_val = transactions_data[data_column_list[0]].iloc[0]
-                if re.match(r'[0-9]{2}-[0-9]{2}-[0-9]{4}', first_column_val) or re.match(r'[0-9]{2}\.[0-9]{2}\.[0-9]{2}', first_column_val):
-                    transactions_data.columns = data_in_reference_format.columns
-
-        transactions_data["Price currency"] = transactions_data["Unnamed: 8"]
-        transactions_data["Local value currency"] = transactions_data["Unnamed: 10"]
-        transactions_data["Value currency"] = transactions_data["Unnamed: 12"]
-        transactions_data["Transaction costs currency"] = transactions_data[
-            "Unnamed: 15"
-        ]
-        transactions_data["Transaction costs currency"] = transactions_data[
-            "Unnamed: 15"
-        ]
-        transactions_data["Total currency"] = transactions_data["Unnamed: 17"]
-
-        if "Transaction and/or third" in transactions_data.columns:
-            transactions_data["Transaction costs"] = transactions_data[
-                "Transaction and/or third"
-            ]
-        transactions_data_clean = transactions_data.drop(
-            ["Unnamed: 8", "Unnamed: 10", "Unnamed: 12", "Unnamed: 15", "Unnamed: 17"],
-            axis=1,
+        # Read as text, so that decimals are exact.
+        data = schemas.read_csv(
+            filename_or_file, models.IntegrationType.DEGIRO, dtype=str
         )
-        for column in REQUIRED_TRANSACTION_COLUMNS:
-            if column not in transactions_data_clean.columns:
-                raise InvalidFormat(f"Column: '{column}' missing in the csv file")
-
-        transactions_data_clean["Datetime"] = transactions_data_clean[
-            ["Date", "Time"]
-        ].apply(_transform_to_datetime, axis=1)
-        transactions_data_clean = transactions_data_clean.sort_values(by="Datetime")
+    except schemas.UnknownLayout as e:
+        raise InvalidFormat(e.args[0])
     except pd.errors.ParserError as e:
         raise InvalidFormat("Failed to parse csv", e)
-    except KeyError as e:
-        raise InvalidFormat("Failed to parse csv", e)
 
-    for x in range(0, len(transactions_data_clean)):
+    executed_at = _to_datetimes(data["Date"], data["Time"])
+    raw_records = _to_raw_records(data)
+    # Exports list the latest transactions first, also of the same minute.
+    order = executed_at[::-1].sort_values(kind="stable").index
+    data = data.loc[order]
+    text = data.fillna("")
+    rows = zip(
+        raw_records.loc[order],
+        [
+            None if pd.isna(timestamp) else timestamp.to_pydatetime()
+            for timestamp in executed_at.loc[order]
+        ],
+        text["Date"],
+        text["Time"],
+        text["ISIN"],
+        text["Product"],
+        text["Reference"],
+        text["Venue"],
+        _to_decimals(data["Quantity"]),
+        _to_decimals(data["Price"]),
+        _to_decimals(data["Local value"]),
+        _to_decimals(data["Value"]),
+        _to_decimals(data["Total"]),
+        _to_decimals(data["Transaction costs"]),
+        text["Local value currency"],
+        text["Value currency"],
+        _to_optional(data["Order ID"]),
+    )
+    return list(itertools.starmap(DegiroRow, rows))
+
+
+def _import_transactions_from_file(
+    account, filename_or_file, import_all_assets, transaction_import
+):
+    """Imports in two phases, resolving the records and then writing them.
+
+    Assets unknown locally are looked up at the remote API while resolving,
+    outside of transactions, and the import is written in one transaction.
+    The progress advances with every lookup and every batch of rows written.
+    """
+    transaction_records = read_transactions(filename_or_file)
+    transaction_import.start(steps_total=len(transaction_records))
+
+    resolver = resolution.ImportResolver(account)
+    resolver.fetch_remote(
+        asset_keys={
+            (record.isin, record.venue, record.reference)
+            for record in transaction_records
+        },
+        transaction_import=transaction_import,
+    )
+    failed_records = []
+    parsed_records = []
+    for transaction_record in transaction_records:
         try:
-            transaction_record = transactions_data_clean.iloc[x]
-            transaction, created = import_transaction(account, transaction_record, import_all_assets)
+            parsed_records.append(
+                (
+                    transaction_record,
+                    parse_transaction(
+                        account, transaction_record, import_all_assets, resolver
+                    ),
+                )
+            )
+        except CurrencyMismatch as e:
+            raise e
+        except Exception as e:
+            logger.warn(e)
+            failed_records.append(
+                {
+                    "record": transaction_record,
+                    "issue": str(e),
+                    "issue_type": models.ImportIssueType.UNKNOWN_FAILURE,
+                }
+            )
+    # Rows that failed to parse aren't written.
+    transaction_import.advance(len(failed_records))
+    return _write_import(
+        account, parsed_records, failed_records, resolver, transaction_import
+    )
+
+
+@transaction.atomic()
+def _write_import(
+    account, parsed_records, failed_records, resolver, transaction_import
+):
+    failed_records = list(failed_records)
+    successful_records = []
+    account_repository = accounts.AccountRepository(
+        defer_lots=True, batch_related_changes=True
+    )
+    results = []
+    for start in range(0, len(parsed_records), models.IMPORT_WRITE_BATCH_SIZE):
+        batch = parsed_records[start : start + models.IMPORT_WRITE_BATCH_SIZE]
+        results.extend(
+            account_repository.add_transactions_bulk(
+                account, [record for _, record in batch], resolver=resolver
+            )
+        )
+        transaction_import.advance(len(batch))
+    account_repository.sync_balances()
+    for (transaction_record, _), result in zip(parsed_records, results):
+        if result.error is None:
             successful_records.append(
                 {
                     "record": transaction_record,
-                    "transaction": transaction,
-                    "created": created,
+                    "transaction": result.transaction,
+                    "created": result.created,
                 }
             )
-        except CurrencyMismatch as e:
-            raise e
-        except SoldBeforeBought as e:
+        elif isinstance(result.error, SoldBeforeBought):
             failed_records.append(
                 {
                     "record": transaction_record,
-                    "issue": str(e),
+                    "issue": str(result.error),
                     "issue_type": models.ImportIssueType.SOLD_BEFORE_BOUGHT,
                 }
             )
-        except Exception as e:
-            logger.warn(e)
+        else:
+            logger.warn(result.error)
             failed_records.append(
                 {
                     "record": transaction_record,
-                    "issue": str(e),
+                    "issue": str(result.error),
                     "issue_type": models.ImportIssueType.UNKNOWN_FAILURE,
                 }
             )
@@ -206,26 +317,27 @@ def _import_transactions_from_file(account, filename_or_file, import_all_assets)
         else:
             status = models.ImportStatus.FAILURE
 
-    transaction_import = models.TransactionImport.objects.create(
-        integration=models.IntegrationType.DEGIRO,
-        status=status,
-        account=account,
+    transaction_import.finish(status)
+    models.TransactionImportRecord.objects.bulk_create(
+        [
+            models.TransactionImportRecord(
+                transaction_import=transaction_import,
+                raw_record=entry["record"].raw_record,
+                successful=False,
+                issue_type=entry["issue_type"],
+                raw_issue=entry["issue"],
+            )
+            for entry in failed_records
+        ]
+        + [
+            models.TransactionImportRecord(
+                transaction_import=transaction_import,
+                raw_record=entry["record"].raw_record,
+                successful=True,
+                transaction=entry["transaction"],
+                created_new=entry["created"],
+            )
+            for entry in successful_records
+        ]
     )
-    for entry in failed_records:
-        models.TransactionImportRecord.objects.create(
-            transaction_import=transaction_import,
-            raw_record=entry["record"].to_csv(),
-            successful=False,
-            issue_type=entry["issue_type"],
-            raw_issue=entry["issue"],
-        )
-
-    for entry in successful_records:
-        models.TransactionImportRecord.objects.create(
-            transaction_import=transaction_import,
-            raw_record=entry["record"].to_csv(),
-            successful=True,
-            transaction=entry["transaction"],
-            created_new=entry["created"],
-        )
-    return transaction_import
\ No newline at end of file
+    return transaction_import
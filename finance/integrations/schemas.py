@@ -0,0 +1,243 @@
+"""Layouts of CSV exports of brokers, matched by the header of the file.
+
+Exports are the same layout in every language they're exported in, only
+the header differs. Each header is mapped to the names of the columns used
+by the parsers, and the fingerprints of known layouts are computed when the
+module is imported. An upload is matched by a single lookup of its header,
+before the rest of the file is read, so files in unknown layouts fail
+without being parsed. Schemas with required columns match them by name
+instead, in any order and next to other columns.
+"""
+import csv
+import os
+from typing import Dict, List, NamedTuple, Optional, Sequence, Tuple
+
+import pandas as pd
+
+from finance import models
+
+
+class UnknownLayout(ValueError):
+    pass
+
+
+class Schema(NamedTuple):
+    name: str
+    integration: models.IntegrationType
+    # Names of the columns in the order of the file, as used by the parsers.
+    columns: Tuple[str, ...]
+    # Header lines of the file in the languages it's exported in.
+    headers: Tuple[str, ...]
+    # Columns matched by name, if the layout of the file isn't fixed. Other
+    # columns of the schema are read if the file has them.
+    required: Tuple[str, ...] = ()
+
+
+DEGIRO = Schema(
+    name="Degiro",
+    integration=models.IntegrationType.DEGIRO,
+    columns=(
+        "Date",
+        "Time",
+        "Product",
+        "ISIN",
+        "Reference",
+        "Venue",
+        "Quantity",
+        "Price",
+        "Price currency",
+        "Local value",
+        "Local value currency",
+        "Value",
+        "Value currency",
+        "Exchange rate",
+        "Transaction costs",
+        "Transaction costs currency",
+        "Total",
+        "Total currency",
+        "Order ID",
+    ),
+    headers=(
+        # English, the transaction costs column was renamed in 2021.
+        "Date,Time,Product,ISIN,Reference,Venue,Quantity,Price,,Local value,,Value,,"
+        "Exchange rate,Transaction costs,,Total,,Order ID",
+        "Date,Time,Product,ISIN,Reference,Venue,Quantity,Price,,Local value,,Value,,"
+        "Exchange rate,Transaction and/or third,,Total,,Order ID",
+        # Dutch.
+        "Datum,Tijd,Product,ISIN,Beurs,Uitvoeringsplaats,Aantal,Koers,,Lokale waarde,,"
+        "Waarde,,Wisselkoers,Transactiekosten en/of,,Totaal,,Order ID",
+        # German.
+        "Datum,Uhrzeit,Produkt,ISIN,Referenzbörse,Ausführungsort,Anzahl,Kurs,,"
+        "Wert in Lokalwährung,,Wert,,Wechselkurs,Transaktionskosten und/oder,,Gesamt,,"
+        "Order-ID",
+        # Polish.
+        "Data,Czas,Produkt,ISIN,Giełda referencyjna,Miejsce wykonania,Liczba,Kurs,,"
+        "Wartość lokalna,,Wartość,,Kurs wymiany,Koszty transakcyjne,,Razem,,"
+        "Identyfikator zlecenia",
+        # Spanish.
+        "Fecha,Hora,Producto,ISIN,Bolsa de,Centro de,Número,Precio,,Valor local,,"
+        "Valor,,Tipo de cambio,Costes de transacción,,Total,,ID Orden",
+        # French.
+        "Date,Heure,Produit,Code ISIN,Place boursière,Lieu d'exécution,Quantité,"
+        "Cours,,Montant devise locale,,Montant,,Taux de change,Frais de courtage,,"
+        "Montant négocié,,ID Ordre",
+        # Italian.
+        "Data,Ora,Prodotto,ISIN,Borsa di,Sede di,Quantità,Prezzo,,Valore locale,,"
+        "Valore,,Tasso di cambio,Costi di transazione,,Totale,,ID Ordine",
+    ),
+)
+
+BINANCE = Schema(
+    name="Binance",
+    integration=models.IntegrationType.BINANCE_CSV,
+    columns=(
+        "User_ID",
+        "UTC_Time",
+        "Account",
+        "Operation",
+        "Coin",
+        "Change",
+        "Remark",
+    ),
+    headers=("User_ID,UTC_Time,Account,Operation,Coin,Change,Remark",),
+    # Columns were added and reordered between exports.
+    required=("UTC_Time", "Operation", "Coin", "Change"),
+)
+
+SCHEMAS = (DEGIRO, BINANCE)
+
+
+def _normalized(name: str) -> str:
+    return " ".join(name.split()).casefold()
+
+
+def _parse_header(line: str) -> List[str]:
+    return next(csv.reader([line]), [])
+
+
+def _column_names(schemas: Sequence[Schema]) -> Dict[str, str]:
+    """Names of the columns by their normalized names in the headers.
+
+    Unnamed columns, e.g. currencies of the column before them, are matched
+    only by their position.
+    """
+    column_names = {"": ""}
+    for schema in schemas:
+        for header in map(_parse_header, schema.headers):
+            if len(header) != len(schema.columns):
+                raise ValueError(f"Header of {schema.name} doesn't match: {header}")
+            for name, column in zip(header, schema.columns):
+                if not name:
+                    continue
+                if column_names.setdefault(_normalized(name), column) != column:
+                    raise ValueError(f"Column {name} of {schema.name} is ambiguous")
+    return column_names
+
+
+def _fingerprint(
+    column_names: Dict[str, str], header: Sequence[str]
+) -> Tuple[Optional[str], ...]:
+    return tuple(column_names.get(_normalized(name)) for name in header)
+
+
+_COLUMN_NAMES = {
+    integration: _column_names(
+        [schema for schema in SCHEMAS if schema.integration == integration]
+    )
+    for integration in models.IntegrationType
+}
+_SCHEMAS: Dict[Tuple[models.IntegrationType, Tuple[Optional[str], ...]], Schema] = {}
+for _schema in SCHEMAS:
+    for _header in map(_parse_header, _schema.headers):
+        _SCHEMAS[
+            (
+                _schema.integration,
+                _fingerprint(_COLUMN_NAMES[_schema.integration], _header),
+            )
+        ] = _schema
+
+
+def match(header: Sequence[str], integration: models.IntegrationType) -> Schema:
+    """Schema of the header, raises UnknownLayout if it isn't known.
+
+    Columns can be named in any of the languages of the schema.
+    """
+    column_names = _COLUMN_NAMES[integration]
+    fingerprint = _fingerprint(column_names, header)
+    schema = _SCHEMAS.get((integration, fingerprint))
+    if schema is not None:
+        return schema
+
+    known = [column for column in fingerprint if column]
+    for schema in SCHEMAS:
+        if (
+            schema.integration == integration
+            and schema.required
+            and set(schema.required).issubset(known)
+            and len(set(known)) == len(known)
+        ):
+            return schema
+
+    name = next(s.name for s in SCHEMAS if s.integration == integration)
+    message = f"Columns of the csv file don't match a known {name} export"
+    missing = [
+        column
+        for s in SCHEMAS
+        if s.integration == integration
+        for column in s.required
+        if column not in known
+    ]
+    if missing:
+        message += f", missing columns: {', '.join(missing)}"
+    unknown = [
+        column for column, known in zip(header, fingerprint) if known is None
+    ]
+    if unknown:
+        message += f", unknown columns: {', '.join(unknown)}"
+    raise UnknownLayout(message)
+
+
+def _read_header(f) -> List[str]:
+    line = f.readline()
+    if isinstance(line, bytes):
+        try:
+            line = line.decode("utf-8")
+        except UnicodeDecodeError:
+            raise UnknownLayout("The file isn't a csv file")
+    return _parse_header(line.lstrip("\ufeff"))
+
+
+def read_csv(
+    filename_or_file, integration: models.IntegrationType, **kwargs
+) -> pd.DataFrame:
+    """Reads the file with the columns named by its schema.
+
+    Only the header is read before the schema is matched, the rest of the
+    file is read by pandas from there on. Columns of schemas matched by name
+    are selected by name, in the order of the schema, and columns the file
+    doesn't have are empty.
+    """
+    if isinstance(filename_or_file, (str, os.PathLike)):
+        with open(filename_or_file, "rb") as f:
+            return read_csv(f, integration, **kwargs)
+
+    header = _read_header(filename_or_file)
+    schema = match(header, integration)
+    if schema.required:
+        fingerprint = _fingerprint(_COLUMN_NAMES[integration], header)
+        names = [column or f"Unnamed: {i}" for i, column in enumerate(fingerprint)]
+        return pd.read_csv(
+            filename_or_file,
+            header=None,
+            names=names,
+            usecols=[column for column in schema.columns if column in names],
+            index_col=False,
+            **kwargs,
+        ).reindex(columns=list(schema.columns))
+    return pd.read_csv(
+        filename_or_file,
+        header=None,
+        names=list(schema.columns),
+        index_col=False,
+        **kwargs,
+    )
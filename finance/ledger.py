@@ -0,0 +1,190 @@
+"""Append-only ledger of the cash balance of accounts.
+
+Every transaction and event adds cash entries with its change of the
+balance. Deleting or correcting one appends entries reversing the previous
+ones, entries are never updated. The balance of an account is derived from
+the entries and stored in `Account.balance` by `sync_balance`, once per
+operation or, for batches of changes such as imports, once per batch.
+
+Checkpoints store the balance including all entries up to a time, so that
+the balance and its history are summed from the nearest checkpoint instead
+of from the first entry. A checkpoint is added every `CHECKPOINT_INTERVAL`
+entries and removed when an entry is backdated before it.
+"""
+import datetime
+import decimal
+from collections import defaultdict
+from typing import Iterable, Optional
+
+from django.db.models import Count, F, Max, Q, Sum, Window
+from django.utils import timezone
+
+from finance import models, valuation
+
+# Entries summed since the last checkpoint before a new one is added.
+CHECKPOINT_INTERVAL = 1000
+
+
+def transaction_entry(transaction: "models.Transaction") -> "models.CashEntry":
+    return models.CashEntry(
+        account_id=transaction.position.account_id,
+        executed_at=transaction.executed_at,
+        amount=transaction.total_in_account_currency,
+        transaction=transaction,
+    )
+
+
+def event_entry(event: "models.AccountEvent", amount) -> "models.CashEntry":
+    """Entry of the event, the amount is in the account currency."""
+    return models.CashEntry(
+        account_id=event.account_id,
+        executed_at=event.executed_at,
+        amount=amount,
+        event=event,
+    )
+
+
+def record(entries: Iterable["models.CashEntry"]) -> None:
+    """Appends the entries, balances have to be synced afterwards."""
+    entries = [entry for entry in entries if entry.amount]
+    if not entries:
+        return
+    models.CashEntry.objects.bulk_create(entries)
+    earliest = {}
+    for entry in entries:
+        earliest[entry.account_id] = min(
+            earliest.get(entry.account_id, entry.executed_at), entry.executed_at
+        )
+    for account_id, executed_at in earliest.items():
+        models.CashCheckpoint.objects.filter(
+            account_id=account_id, executed_at__gte=executed_at
+        ).delete()
+
+
+def reverse(
+    transaction_ids: Iterable[int] = (), event_ids: Iterable[int] = ()
+) -> None:
+    """Appends entries cancelling all entries of the transactions and events.
+
+    Reversing entries are executed at the same time as the reversed ones,
+    so the balance history is as if they were never recorded.
+    """
+    totals = defaultdict(decimal.Decimal)
+    for entry in models.CashEntry.objects.filter(
+        Q(transaction_id__in=transaction_ids) | Q(event_id__in=event_ids)
+    ):
+        key = (
+            entry.account_id,
+            entry.executed_at,
+            entry.transaction_id,
+            entry.event_id,
+        )
+        totals[key] += entry.amount
+    record(
+        models.CashEntry(
+            account_id=account_id,
+            executed_at=executed_at,
+            amount=-total,
+            transaction_id=transaction_id,
+            event_id=event_id,
+        )
+        for (account_id, executed_at, transaction_id, event_id), total in (
+            totals.items()
+        )
+    )
+
+
+def balance(account: "models.Account") -> decimal.Decimal:
+    return _balance(account)[0]
+
+
+def _balance(account: "models.Account"):
+    """Balance and if a checkpoint is due, with the time of the last entry."""
+    checkpoint = account.cash_checkpoints.first()
+    entries = account.cash_entries.all()
+    opening = decimal.Decimal(0)
+    if checkpoint:
+        opening = checkpoint.balance
+        entries = entries.filter(executed_at__gt=checkpoint.executed_at)
+    totals = entries.aggregate(
+        total=Sum("amount"), count=Count("id"), last=Max("executed_at")
+    )
+    checkpoint_due = totals["count"] >= CHECKPOINT_INTERVAL
+    return opening + (totals["total"] or 0), checkpoint_due, totals["last"]
+
+
+def sync_balance(account: "models.Account") -> None:
+    """Stores the balance derived from the ledger in the account.
+
+    Written in one update, the account isn't read and saved again. The row
+    of the account has to be locked, so that entries recorded at the same
+    time are summed by whoever syncs last.
+    """
+    account_balance, checkpoint_due, last = _balance(account)
+    if checkpoint_due:
+        models.CashCheckpoint.objects.create(
+            account=account, executed_at=last, balance=account_balance
+        )
+    models.Account.objects.filter(pk=account.pk).update(
+        balance=account_balance, last_modified=timezone.now()
+    )
+    account.balance = account_balance
+
+
+def _start_of(date: datetime.date) -> datetime.datetime:
+    return datetime.datetime.combine(
+        date, datetime.time(), tzinfo=datetime.timezone.utc
+    )
+
+
+def balance_history(
+    account: "models.Account",
+    from_date: datetime.date,
+    to_date: Optional[datetime.date] = None,
+) -> valuation.History:
+    """Balance at the end of each day, from the newest day.
+
+    The running sum is computed by the database, from the nearest
+    checkpoint before the first day.
+    """
+    if to_date is None:
+        to_date = datetime.date.today()
+    checkpoint = account.cash_checkpoints.filter(
+        executed_at__lt=_start_of(from_date)
+    ).first()
+    entries = account.cash_entries.filter(
+        executed_at__lt=_start_of(to_date + valuation.ONE_DAY)
+    )
+    opening = decimal.Decimal(0)
+    if checkpoint:
+        opening = checkpoint.balance
+        entries = entries.filter(executed_at__gt=checkpoint.executed_at)
+    running = (
+        entries.annotate(
+            running_total=Window(
+                Sum("amount"), order_by=[F("executed_at").asc(), F("id").asc()]
+            )
+        )
+        .order_by("executed_at", "id")
+        .values_list("executed_at", "running_total")
+    )
+    # Balance after the last entry of each day.
+    closing = {}
+    for executed_at, running_total in running:
+        closing[executed_at.astimezone(datetime.timezone.utc).date()] = (
+            opening + running_total
+        )
+
+    day_balance = opening
+    for date, date_balance in closing.items():
+        if date >= from_date:
+            break
+        day_balance = date_balance
+    history = []
+    date = from_date
+    while date <= to_date:
+        day_balance = closing.get(date, day_balance)
+        history.append((date, day_balance))
+        date += valuation.ONE_DAY
+    history.reverse()
+    return history
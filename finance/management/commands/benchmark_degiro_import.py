@@ -0,0 +1,33 @@
+import io
+import time
+
+from django.core.management.base import BaseCommand
+from finance.integrations import degiro_parser
+
+
+class Command(BaseCommand):
+    help = "Measure reading and normalizing a Degiro export, without importing it."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--rows", type=int, default=50000, help="rows of the generated export"
+        )
+        parser.add_argument(
+            "--filename",
+            type=str,
+            default="./finance/transactions_example.csv",
+            help="export whose rows are repeated in the generated one",
+        )
+
+    def handle(self, *args, **options):
+        with open(options["filename"]) as f:
+            header, *lines = f.read().splitlines()
+        lines = (lines * (options["rows"] // len(lines) + 1))[: options["rows"]]
+        export = "\n".join([header, *lines])
+
+        start = time.perf_counter()
+        records = degiro_parser.read_transactions(io.StringIO(export))
+        elapsed = time.perf_counter() - start
+        self.stdout.write(
+            self.style.SUCCESS(f"Read {len(records)} rows in {elapsed:.2f}s")
+        )
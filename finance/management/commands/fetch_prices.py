@@ -1,6 +1,6 @@
 from django.contrib.auth.models import User
 from django.core.management.base import BaseCommand, CommandError
-from finance import accounts, prices, models
+from finance import accounts, prices, models, snapshots
 from django.db.models import Count
 
 
@@ -26,3 +26,9 @@ class Command(BaseCommand):
             self.stdout.write(
                 self.style.SUCCESS(f"Collected {len(price_records)} prices for {asset}")
             )
+
+        positions = models.Position.objects.select_related("asset", "account")
+        self.stdout.write(f"Will update daily snapshots of {positions.count()} positions")
+        for position in positions:
+            snapshots.extend(position)
+        self.stdout.write(self.style.SUCCESS("Updated daily snapshots"))
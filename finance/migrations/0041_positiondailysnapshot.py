@@ -0,0 +1,32 @@
+# Generated by Django 3.2.25 on 2026-10-17 18:13
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('finance', '0040_auto_20220402_1814'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PositionDailySnapshot',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('date', models.DateField()),
+                ('quantity', models.DecimalField(decimal_places=10, max_digits=20)),
+                ('price', models.DecimalField(decimal_places=10, max_digits=20, null=True)),
+                ('price_from_transaction', models.BooleanField(default=False)),
+                ('exchange_rate', models.DecimalField(decimal_places=10, max_digits=20, null=True)),
+                ('value', models.DecimalField(decimal_places=10, max_digits=20, null=True)),
+                ('value_account_currency', models.DecimalField(decimal_places=10, max_digits=20, null=True)),
+                ('position', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='daily_snapshots', to='finance.position')),
+            ],
+            options={
+                'ordering': ['-date'],
+                'unique_together': {('position', 'date')},
+            },
+        ),
+    ]
@@ -0,0 +1,62 @@
+# Generated by Django 3.2.25 on 2026-10-17 18:45
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def fill_latest(apps, schema_editor):
+    PriceHistory = apps.get_model("finance", "PriceHistory")
+    LatestQuote = apps.get_model("finance", "LatestQuote")
+    CurrencyExchangeRate = apps.get_model("finance", "CurrencyExchangeRate")
+    LatestExchangeRate = apps.get_model("finance", "LatestExchangeRate")
+
+    LatestQuote.objects.bulk_create(
+        LatestQuote(asset_id=price.asset_id, value=price.value, date=price.date)
+        for price in PriceHistory.objects.order_by("asset_id", "-date").distinct(
+            "asset_id"
+        )
+    )
+    # Derived pairs are added when exchange rates are collected next time.
+    LatestExchangeRate.objects.bulk_create(
+        LatestExchangeRate(
+            from_currency=rate.from_currency,
+            to_currency=rate.to_currency,
+            value=rate.value,
+            date=rate.date,
+        )
+        for rate in CurrencyExchangeRate.objects.order_by(
+            "from_currency", "to_currency", "-date"
+        ).distinct("from_currency", "to_currency")
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('finance', '0041_positiondailysnapshot'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='LatestQuote',
+            fields=[
+                ('asset', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='latest_quote', serialize=False, to='finance.asset')),
+                ('value', models.DecimalField(decimal_places=10, max_digits=20)),
+                ('date', models.DateField()),
+            ],
+        ),
+        migrations.CreateModel(
+            name='LatestExchangeRate',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('from_currency', models.IntegerField(choices=[(1, 'EUR'), (2, 'GBP'), (3, 'USD'), (4, 'GBX'), (5, 'HKD'), (6, 'SGD'), (7, 'JPY'), (8, 'CAD'), (9, 'PLN')])),
+                ('to_currency', models.IntegerField(choices=[(1, 'EUR'), (2, 'GBP'), (3, 'USD'), (4, 'GBX'), (5, 'HKD'), (6, 'SGD'), (7, 'JPY'), (8, 'CAD'), (9, 'PLN')])),
+                ('value', models.DecimalField(decimal_places=10, max_digits=20)),
+                ('date', models.DateField()),
+            ],
+            options={
+                'unique_together': {('from_currency', 'to_currency')},
+            },
+        ),
+        migrations.RunPython(fill_latest, migrations.RunPython.noop),
+    ]
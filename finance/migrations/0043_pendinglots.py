@@ -0,0 +1,21 @@
+# Generated by Django 3.2.25 on 2026-10-17 19:25
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('finance', '0042_latestquote_latestexchangerate'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PendingLots',
+            fields=[
+                ('position', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='pending_lots', serialize=False, to='finance.position')),
+                ('since', models.DateTimeField(null=True)),
+            ],
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 3.2.25 on 2026-10-17 19:32
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('finance', '0043_pendinglots'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='account',
+            name='cost_basis_method',
+            field=models.IntegerField(choices=[(1, 'FIFO'), (2, 'LIFO'), (3, 'HIFO'), (4, 'AVERAGE')], default=1),
+        ),
+    ]
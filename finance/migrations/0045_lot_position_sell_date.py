@@ -0,0 +1,17 @@
+# Generated by Django 3.2.25 on 2026-10-17 19:37
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('finance', '0044_account_cost_basis_method'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='lot',
+            index=models.Index(fields=['position', 'sell_date'], name='finance_lot_positio_4a0459_idx'),
+        ),
+    ]
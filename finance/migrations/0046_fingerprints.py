@@ -0,0 +1,103 @@
+# Generated by Django 3.2.25 on 2026-10-17 19:46
+
+import datetime
+import decimal
+import hashlib
+import json
+
+from django.db import migrations, models
+from django.utils import timezone
+
+
+# Copy of finance.fingerprints as of this migration, changes to it must
+# not change the fingerprints computed here.
+TRANSACTION_FIELDS = (
+    "executed_at",
+    "quantity",
+    "price",
+    "transaction_costs",
+    "local_value",
+    "value_in_account_currency",
+    "total_in_account_currency",
+    "order_id",
+)
+
+EVENT_FIELDS = (
+    "executed_at",
+    "event_type",
+    "amount",
+    "withheld_taxes",
+    "position_id",
+    "transaction_id",
+)
+
+BATCH_SIZE = 1000
+
+
+def _canonical(field, value):
+    if value is None:
+        return None
+    value = field.to_python(value)
+    if isinstance(field, models.DecimalField):
+        value = value.quantize(
+            decimal.Decimal(1).scaleb(-field.decimal_places),
+            rounding=decimal.ROUND_HALF_UP,
+            context=decimal.Context(prec=field.max_digits + field.decimal_places),
+        )
+        return format(value if value else abs(value), "f")
+    if isinstance(value, datetime.datetime):
+        if timezone.is_naive(value):
+            value = timezone.make_aware(value)
+        return value.astimezone(datetime.timezone.utc).isoformat()
+    return value
+
+
+def _fingerprint(model, fields, values):
+    canonical = [
+        _canonical(model._meta.get_field(field), getattr(values, field))
+        for field in fields
+    ]
+    return hashlib.sha256(json.dumps(canonical).encode()).hexdigest()
+
+
+def fill_fingerprints(apps, schema_editor):
+    # Rows recorded twice keep no fingerprint, except for the first one.
+    for model_name, owner, fields in (
+        ("Transaction", "position_id", TRANSACTION_FIELDS),
+        ("AccountEvent", "account_id", EVENT_FIELDS),
+    ):
+        model = apps.get_model("finance", model_name)
+        seen = set()
+        batch = []
+        for row in model.objects.order_by("id").iterator(chunk_size=BATCH_SIZE):
+            fingerprint = _fingerprint(model, fields, row)
+            if (getattr(row, owner), fingerprint) in seen:
+                continue
+            seen.add((getattr(row, owner), fingerprint))
+            row.fingerprint = fingerprint
+            batch.append(row)
+            if len(batch) == BATCH_SIZE:
+                model.objects.bulk_update(batch, ["fingerprint"])
+                batch = []
+        model.objects.bulk_update(batch, ["fingerprint"])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('finance', '0045_lot_position_sell_date'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='accountevent',
+            name='fingerprint',
+            field=models.CharField(editable=False, max_length=64, null=True),
+        ),
+        migrations.AddField(
+            model_name='transaction',
+            name='fingerprint',
+            field=models.CharField(editable=False, max_length=64, null=True),
+        ),
+        migrations.RunPython(fill_fingerprints, migrations.RunPython.noop),
+    ]
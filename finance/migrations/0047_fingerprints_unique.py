@@ -0,0 +1,21 @@
+# Generated by Django 3.2.25 on 2026-10-17 19:46
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('finance', '0046_fingerprints'),
+    ]
+
+    operations = [
+        migrations.AlterUniqueTogether(
+            name='accountevent',
+            unique_together={('account', 'fingerprint')},
+        ),
+        migrations.AlterUniqueTogether(
+            name='transaction',
+            unique_together={('position', 'fingerprint')},
+        ),
+    ]
@@ -0,0 +1,121 @@
+# Generated by Django 3.2.25 on 2026-10-17 20:00
+
+from django.db import migrations, models
+import django.db.models.deletion
+from django.utils import timezone
+
+DIVIDEND = 3
+
+
+def _closest_rate(CurrencyExchangeRate, date, from_currency, to_currency):
+    """Recorded rate on the date or before, or after if there's none."""
+    rates = CurrencyExchangeRate.objects.filter(
+        from_currency=from_currency, to_currency=to_currency
+    )
+    rate = rates.filter(date__lte=date).order_by("-date").first()
+    if rate is None:
+        rate = rates.filter(date__gt=date).order_by("date").first()
+    return rate
+
+
+def fill_cash_entries(apps, schema_editor):
+    # Entries of all transactions and events, and one adjusting the sum to
+    # the stored balance, e.g. if a dividend rate is no longer known.
+    Account = apps.get_model("finance", "Account")
+    CashEntry = apps.get_model("finance", "CashEntry")
+    CurrencyExchangeRate = apps.get_model("finance", "CurrencyExchangeRate")
+    for account in Account.objects.iterator():
+        entries = [
+            CashEntry(
+                account=account,
+                executed_at=transaction.executed_at,
+                amount=transaction.total_in_account_currency,
+                transaction=transaction,
+            )
+            for transaction in apps.get_model("finance", "Transaction")
+            .objects.filter(position__account=account)
+            .iterator()
+        ]
+        for event in (
+            apps.get_model("finance", "AccountEvent")
+            .objects.filter(account=account)
+            .select_related("position__asset")
+            .iterator()
+        ):
+            amount = event.amount - event.withheld_taxes
+            if (
+                event.event_type == DIVIDEND
+                and event.position
+                and event.position.asset.currency != account.currency
+            ):
+                exchange_rate = _closest_rate(
+                    CurrencyExchangeRate,
+                    event.executed_at.date(),
+                    event.position.asset.currency,
+                    account.currency,
+                )
+                if exchange_rate is not None:
+                    amount *= exchange_rate.value
+            entries.append(
+                CashEntry(
+                    account=account,
+                    executed_at=event.executed_at,
+                    amount=amount,
+                    event=event,
+                )
+            )
+        difference = account.balance - sum(entry.amount for entry in entries)
+        if difference:
+            entries.append(
+                CashEntry(
+                    account=account,
+                    executed_at=max(
+                        [entry.executed_at for entry in entries],
+                        default=timezone.now(),
+                    ),
+                    amount=difference,
+                )
+            )
+        CashEntry.objects.bulk_create(entries, batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('finance', '0047_fingerprints_unique'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CashEntry',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('executed_at', models.DateTimeField()),
+                ('amount', models.DecimalField(decimal_places=10, max_digits=20)),
+                ('account', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='cash_entries', to='finance.account')),
+                ('event', models.ForeignKey(db_constraint=False, null=True, on_delete=django.db.models.deletion.DO_NOTHING, related_name='cash_entries', to='finance.accountevent')),
+                ('transaction', models.ForeignKey(db_constraint=False, null=True, on_delete=django.db.models.deletion.DO_NOTHING, related_name='cash_entries', to='finance.transaction')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='CashCheckpoint',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('executed_at', models.DateTimeField()),
+                ('balance', models.DecimalField(decimal_places=10, max_digits=20)),
+                ('account', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='cash_checkpoints', to='finance.account')),
+            ],
+            options={
+                'ordering': ['-executed_at'],
+            },
+        ),
+        migrations.AddIndex(
+            model_name='cashentry',
+            index=models.Index(fields=['account', 'executed_at'], name='finance_cas_account_bd8035_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='cashcheckpoint',
+            index=models.Index(fields=['account', 'executed_at'], name='finance_cas_account_72b5d5_idx'),
+        ),
+        migrations.RunPython(fill_cash_entries, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,43 @@
+# Generated by Django 3.2.25 on 2026-10-17 20:15
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('finance', '0048_cash_ledger'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='transactionimport',
+            name='import_all_assets',
+            field=models.BooleanField(default=True),
+        ),
+        migrations.AddField(
+            model_name='transactionimport',
+            name='raw_issue',
+            field=models.TextField(null=True),
+        ),
+        migrations.AddField(
+            model_name='transactionimport',
+            name='rows_processed',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='transactionimport',
+            name='rows_total',
+            field=models.IntegerField(null=True),
+        ),
+        migrations.AddField(
+            model_name='transactionimport',
+            name='upload',
+            field=models.BinaryField(null=True),
+        ),
+        migrations.AlterField(
+            model_name='transactionimport',
+            name='status',
+            field=models.IntegerField(choices=[(1, 'Success'), (2, 'Partial success'), (3, 'Failure'), (4, 'Queued'), (5, 'Running')]),
+        ),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 3.2.25 on 2026-10-17 21:01
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('finance', '0049_import_jobs'),
+    ]
+
+    operations = [
+        migrations.RenameField(
+            model_name='transactionimport',
+            old_name='rows_processed',
+            new_name='steps_done',
+        ),
+        migrations.RenameField(
+            model_name='transactionimport',
+            old_name='rows_total',
+            new_name='steps_total',
+        ),
+        migrations.AddField(
+            model_name='transactionimport',
+            name='started_at',
+            field=models.DateTimeField(null=True),
+        ),
+    ]
@@ -1,17 +1,22 @@
 import datetime
 import decimal
-import functools
 from typing import List, Optional, Tuple, Sequence
 from django.core.exceptions import ValidationError
 
-import pytz
 from django.contrib.auth.models import User
+from django.core.cache import cache
 from django.db import models
 from django.db.models import Sum
 from django.utils.translation import gettext_lazy as _
 
-from finance import utils
-import functools
+from finance import (
+    fingerprints,
+    history_cache,
+    ledger,
+    snapshots,
+    utils,
+    valuation,
+)
 
 
 class Currency(models.IntegerChoices):
@@ -37,14 +42,38 @@ def currency_string_from_enum(currency: Currency) -> str:
     return Currency(currency).label
 
 
+def _history_kind(kind: str, numeric: str) -> str:
+    # Histories in the float mode are cached separately from exact ones.
+    if numeric == valuation.DECIMAL:
+        return kind
+    return f"{kind}:{numeric}"
+
+
+class CostBasisMethod(models.IntegerChoices):
+    """Order in which lots are sold, or average cost of all of them."""
+
+    FIFO = 1, _("FIFO")
+    LIFO = 2, _("LIFO")
+    HIFO = 3, _("HIFO")
+    AVERAGE = 4, _("AVERAGE")
+
+
+# Positions valued at once by Account.value_history_per_position.
+VALUATION_CHUNK_SIZE = 100
+
+
 class Account(models.Model):
     user = models.ForeignKey(User, on_delete=models.CASCADE)
     currency = models.IntegerField(choices=Currency.choices, default=Currency.EUR)
     nickname = models.CharField(max_length=200)
     description = models.TextField(blank=True)
 
+    # Derived from the cash entries, maintained by finance.ledger.
     balance = models.DecimalField(max_digits=20, decimal_places=10, default=0)
     last_modified = models.DateTimeField(auto_now=True, null=True)
+    cost_basis_method = models.IntegerField(
+        choices=CostBasisMethod.choices, default=CostBasisMethod.FIFO
+    )
 
     def __str__(self):
         return (
@@ -52,16 +81,68 @@ class Account(models.Model):
             f"currency: {self.get_currency_display()}>"
         )
 
-    def value_history_per_position(self, from_date, to_date):
-        results = []
-        for position in self.positions.all():
-            results.append(
-                (
-                    position.pk,
-                    position.value_history_in_account_currency(from_date, to_date),
-                )
+    def value_history_per_position(
+        self, from_date, to_date, numeric: str = valuation.DECIMAL
+    ):
+        """Yields value histories of positions, ordered by their ids.
+
+        Positions are valued a chunk at a time, so only the histories of one
+        chunk are held in memory, and queries grow with chunks, not positions.
+        """
+        last_pk = 0
+        while True:
+            positions = list(
+                self.positions.filter(pk__gt=last_pk).order_by("pk")[
+                    :VALUATION_CHUNK_SIZE
+                ]
             )
-        return results
+            if not positions:
+                return
+            histories = self._value_histories(positions, from_date, to_date, numeric)
+            for position in positions:
+                yield position.pk, histories.pop(position.pk)
+            if len(positions) < VALUATION_CHUNK_SIZE:
+                return
+            last_pk = positions[-1].pk
+
+    def _value_histories(self, positions, from_date, to_date, numeric):
+        def compute(position_ids):
+            fresh = snapshots.read_many(position_ids, from_date, to_date)
+            histories = {
+                position_id: valuation.as_numeric(
+                    series.value_history_in_account_currency(), numeric
+                )
+                for position_id, series in fresh.items()
+            }
+            stale = [
+                position
+                for position in positions
+                if position.pk in position_ids and position.pk not in fresh
+            ]
+            if stale:
+                histories.update(
+                    (position.pk, series.value_history_in_account_currency())
+                    for position, series in valuation.account_series(
+                        self, from_date, to_date, positions=stale, numeric=numeric
+                    )
+                )
+            return histories
+
+        return history_cache.get_many_or_compute(
+            [position.pk for position in positions],
+            _history_kind(history_cache.VALUE_ACCOUNT_CURRENCY, numeric),
+            from_date,
+            to_date,
+            datetime.timedelta(days=1),
+            compute,
+        )
+
+    def balance_history(
+        self, from_date, to_date=None, numeric: str = valuation.DECIMAL
+    ):
+        return valuation.as_numeric(
+            ledger.balance_history(self, from_date, to_date), numeric
+        )
 
     class Meta:
         unique_together = [["user", "nickname"]]
@@ -206,165 +287,116 @@ class Position(models.Model):
             f"<Position ({self.id}) account: {self.account}, " f"asset: {self.asset}>"
         )
 
-    @functools.lru_cache(maxsize=None)
     def quantity_history(
         self,
         from_date: datetime.date,
         to_date: Optional[datetime.date] = None,
         output_period=datetime.timedelta(days=1),
+        numeric: str = valuation.DECIMAL,
     ):
         if to_date is None:
             to_date = datetime.date.today()
-
-        dates = utils.generate_date_intervals(
-            from_date, to_date, output_period, start_with_end=True
+        return history_cache.get_or_compute(
+            self.pk,
+            _history_kind(history_cache.QUANTITY, numeric),
+            from_date,
+            to_date,
+            output_period,
+            lambda: valuation.as_numeric(
+                self._quantity_history(from_date, to_date, output_period), numeric
+            ),
         )
 
-        quantity = self.quantity
-        transactions = self.transactions.order_by("-executed_at")
-        if not transactions:
-            return [(date, quantity) for date in dates]
-
-        dates_with_quantities = []
-        if transactions[0].executed_at.date() > to_date:
-            # TODO: add support for this if necessary.
-            raise ValueError("history ending before last transaction not supported")
-
-        last_relevant_transaction = 0
-        for date in dates:
-            relevant_transactions = transactions[last_relevant_transaction:]
-            for i, transaction in enumerate(relevant_transactions):
-                if transaction.executed_at.date() < date:
-                    # Since we are going from later to earlier and undoing each
-                    # transaction, this transaction doesn't happen yet, so it couldn't
-                    # affect the current interval. Since transactions are sorted, we
-                    # know that all potentially relevant transactions were already applied.
-                    break
-                else:
-                    last_relevant_transaction += 1
-                    quantity -= transaction.quantity
-            dates_with_quantities.append((date, quantity))
-
-        return dates_with_quantities
+    def _quantity_history(self, from_date, to_date, output_period):
+        series = snapshots.read(self.pk, from_date, to_date, output_period)
+        if series is not None:
+            return series.quantity_history()
+        if self.pk is None:
+            return valuation.position_series(
+                self, from_date, to_date, output_period, with_prices=False
+            ).quantity_history()
+        return valuation.quantity_histories(
+            [self.pk], from_date, to_date, output_period
+        )[self.pk]
+
+    def _series(self, from_date, to_date, output_period, **kwargs):
+        """Series read from daily snapshots if fresh, computed live otherwise.
+
+        Snapshots have exact values, even if the float mode is requested.
+        """
+        series = snapshots.read(self.pk, from_date, to_date, output_period)
+        if series is None:
+            series = valuation.position_series(
+                self, from_date, to_date, output_period, **kwargs
+            )
+        return series
 
     def latest_value_account_currency(self):
-        latest_price = self.asset.pricehistory_set.order_by("-date").first().value
+        latest_price = self.asset.latest_quote.value
         to_currency = self.account.currency
         from_currency = self.asset.currency
         if to_currency == from_currency:
             latest_exchange_rate = 1
         else:
-            latest_exchange_rate = (
-                CurrencyExchangeRate.objects.filter(
-                    from_currency=from_currency, to_currency=to_currency
-                )
-                .order_by("-date")
-                .first()
-                .value
-            )
+            latest_exchange_rate = LatestExchangeRate.objects.get(
+                from_currency=from_currency, to_currency=to_currency
+            ).value
 
         return self.quantity * latest_price * latest_exchange_rate
 
     def unrealized_gain(self):
         return self.latest_value_account_currency() + self.cost_basis
 
-    # This seems pretty ugly and will have to be refactored.
-    # I might also want to use caching so it's not a performance nightmare.
-    @functools.lru_cache(maxsize=None)
     def value_history(
         self,
         from_date: datetime.date,
-        to_date=Optional[datetime.date],
+        to_date: Optional[datetime.date] = None,
         output_period=datetime.timedelta(days=1),
+        numeric: str = valuation.DECIMAL,
     ):
-        quantity_history = self.quantity_history(from_date, to_date, output_period)
-
         if to_date is None:
             to_date = datetime.date.today()
-        prices = self.asset.pricehistory_set.order_by("-date").filter(
-            date__gte=from_date, date__lte=to_date
-        )
-        price_tuples = [(price.date, price.value) for price in prices]
-
-        def to_datetime(date: datetime.date) -> datetime.datetime:
-            dt = datetime.datetime.fromisoformat(date.isoformat())
-            dt = dt.replace(tzinfo=pytz.UTC)
-            return dt
-
-        # Transactions also record price history, so add their data points.
-        transactions = self.transactions.filter(
-            executed_at__gte=to_datetime(from_date),
-            executed_at__lte=to_datetime(to_date),
+        return history_cache.get_or_compute(
+            self.pk,
+            _history_kind(history_cache.VALUE, numeric),
+            from_date,
+            to_date,
+            output_period,
+            lambda: valuation.as_numeric(
+                self._series(
+                    from_date, to_date, output_period, numeric=numeric
+                ).value_history(),
+                numeric,
+            ),
         )
-        price_tuples_from_transactions = [
-            (
-                # The date is rounded up to the next day.
-                # Alternative solution: use the last price and extend it further
-                # to the future.
-                transaction.executed_at.date() + datetime.timedelta(days=1),
-                transaction.price,
-            )
-            for transaction in transactions
-        ]
-        price_tuples.extend(price_tuples_from_transactions)
-        first_price = prices.last()
-        if isinstance(first_price, PriceHistory):
-            if first_price.date > from_date:
-                day_before_first_date = first_price.date - datetime.timedelta(days=1)
-                additional_dates = utils.generate_date_intervals(
-                    from_date, day_before_first_date, output_period=output_period
-                )
-                price_tuples.extend(
-                    [(date, decimal.Decimal("0")) for date in additional_dates]
-                )
-
-        price_tuples.sort(key=lambda x: x[0], reverse=True)
-        return multiply_at_matching_dates(price_tuples, quantity_history)
 
     def value_history_in_account_currency(
         self,
         from_date: datetime.date,
         to_date: Optional[datetime.date] = None,
         output_period: datetime.timedelta = datetime.timedelta(days=1),
+        numeric: str = valuation.DECIMAL,
     ):
-        to_currency = self.account.currency
-        from_currency = self.asset.currency
         if to_date is None:
             to_date = datetime.date.today()
-
-        value_history = self.value_history(from_date, to_date, output_period)
-        if to_currency == from_currency:
-            return value_history
-
-        exchange_rate_tuples = get_exchange_rates(
-            from_date, to_date, from_currency, to_currency
+        return history_cache.get_or_compute(
+            self.pk,
+            _history_kind(history_cache.VALUE_ACCOUNT_CURRENCY, numeric),
+            from_date,
+            to_date,
+            output_period,
+            lambda: valuation.as_numeric(
+                self._series(
+                    from_date,
+                    to_date,
+                    output_period,
+                    in_account_currency=True,
+                    numeric=numeric,
+                ).value_history_in_account_currency(),
+                numeric,
+            ),
         )
 
-        # If no latest exchange rate, reuse the last one.
-        if len(exchange_rate_tuples) > 0 and exchange_rate_tuples[0][0] < to_date:
-            last_day = exchange_rate_tuples[0][0] + datetime.timedelta(days=1)
-
-            additional_dates = utils.generate_date_intervals(
-                last_day, to_date, output_period=output_period
-            )
-            exchange_rate_tuples.extend(
-                [(date, exchange_rate_tuples[0][1]) for date in additional_dates]
-            )
-        exchange_rate_tuples.sort(key=lambda x: x[0], reverse=True)
-        return multiply_at_matching_dates(value_history, exchange_rate_tuples)
-
-
-@functools.lru_cache(maxsize=10)
-def get_exchange_rates(from_date, to_date, from_currency, to_currency):
-    exchange_rates = CurrencyExchangeRate.objects.order_by("-date").filter(
-        date__gte=from_date,
-        date__lte=to_date,
-        from_currency=from_currency,
-        to_currency=to_currency,
-    )
-    exchange_rate_tuples = [(rate.date, rate.value) for rate in exchange_rates]
-    return exchange_rate_tuples
-
 
 class Transaction(models.Model):
     executed_at = models.DateTimeField()
@@ -389,11 +421,21 @@ class Transaction(models.Model):
 
     last_modified = models.DateTimeField(auto_now=True)
 
+    # Hash of the values above, the same transaction is recorded only once.
+    fingerprint = models.CharField(max_length=64, null=True, editable=False)
+
     def __str__(self):
         return f"<Transaction id: {self.pk} executed_at: {self.executed_at}, position: {self.position}>"
 
+    def save(self, *args, **kwargs):
+        self.fingerprint = fingerprints.fingerprint(
+            Transaction, fingerprints.TRANSACTION_FIELDS, self
+        )
+        super().save(*args, **kwargs)
+
     class Meta:
         ordering = ["-executed_at"]
+        unique_together = [["position", "fingerprint"]]
 
 
 class EventType(models.IntegerChoices):
@@ -461,6 +503,15 @@ class AccountEvent(models.Model):
     amount = models.DecimalField(max_digits=20, decimal_places=10)
     withheld_taxes = models.DecimalField(max_digits=20, decimal_places=10, default=0)
 
+    # Hash of the values above, the same event is recorded only once.
+    fingerprint = models.CharField(max_length=64, null=True, editable=False)
+
+    def save(self, *args, **kwargs):
+        self.fingerprint = fingerprints.fingerprint(
+            AccountEvent, fingerprints.EVENT_FIELDS, self
+        )
+        super().save(*args, **kwargs)
+
     def clean(self):
         if self.event_type in EVENT_TYPES_WITH_POSITION:
             if not self.position:
@@ -471,6 +522,7 @@ class AccountEvent(models.Model):
 
     class Meta:
         ordering = ["-executed_at"]
+        unique_together = [["account", "fingerprint"]]
 
 
 class CurrencyExchangeRate(models.Model):
@@ -492,6 +544,55 @@ class PriceHistory(models.Model):
         ordering = ["-date"]
 
 
+class LatestQuote(models.Model):
+    """Latest recorded price of the asset, maintained by finance.prices."""
+
+    asset = models.OneToOneField(
+        Asset, on_delete=models.CASCADE, primary_key=True, related_name="latest_quote"
+    )
+    value = models.DecimalField(max_digits=20, decimal_places=10)
+    date = models.DateField()
+
+
+class LatestExchangeRate(models.Model):
+    """Latest exchange rate of the pair, maintained by finance.prices.
+
+    Includes pairs derived by finance.exchange_rates.
+    """
+
+    from_currency = models.IntegerField(choices=Currency.choices)
+    to_currency = models.IntegerField(choices=Currency.choices)
+    value = models.DecimalField(max_digits=20, decimal_places=10)
+    date = models.DateField()
+
+    class Meta:
+        unique_together = [["from_currency", "to_currency"]]
+
+
+class PositionDailySnapshot(models.Model):
+    """State of the position at the beginning of a day, see finance.snapshots."""
+
+    position = models.ForeignKey(
+        Position, on_delete=models.CASCADE, related_name="daily_snapshots"
+    )
+    date = models.DateField()
+    quantity = models.DecimalField(max_digits=20, decimal_places=10)
+    # Price is null if unknown, it comes either from the price history or
+    # from a transaction executed the day before.
+    price = models.DecimalField(max_digits=20, decimal_places=10, null=True)
+    price_from_transaction = models.BooleanField(default=False)
+    # Exchange rate to the account currency at that day, null if unknown.
+    exchange_rate = models.DecimalField(max_digits=20, decimal_places=10, null=True)
+    value = models.DecimalField(max_digits=20, decimal_places=10, null=True)
+    value_account_currency = models.DecimalField(
+        max_digits=20, decimal_places=10, null=True
+    )
+
+    class Meta:
+        unique_together = [["position", "date"]]
+        ordering = ["-date"]
+
+
 class Lot(models.Model):
     quantity = models.DecimalField(max_digits=20, decimal_places=10)
     buy_date = models.DateField()
@@ -521,6 +622,72 @@ class Lot(models.Model):
 
     class Meta:
         ordering = ["buy_date"]
+        indexes = [models.Index(fields=["position", "sell_date"])]
+
+
+class PendingLots(models.Model):
+    """Position with lots to recompute, maintained by finance.gains.
+
+    Realized gain and cost basis of the position are out of date until
+    the lots are recomputed in the background.
+    """
+
+    position = models.OneToOneField(
+        Position, on_delete=models.CASCADE, primary_key=True, related_name="pending_lots"
+    )
+    # Earliest execution time of changed transactions, all lots are
+    # recomputed if it's not set.
+    since = models.DateTimeField(null=True)
+
+
+class CashEntry(models.Model):
+    """Change of the account balance, maintained by finance.ledger.
+
+    Entries are only appended, a deleted or corrected transaction or event
+    gets entries reversing its previous ones.
+    """
+
+    account = models.ForeignKey(
+        Account, on_delete=models.CASCADE, related_name="cash_entries"
+    )
+    executed_at = models.DateTimeField()
+    # In the account currency.
+    amount = models.DecimalField(max_digits=20, decimal_places=10)
+    # Entries stay as they are after the transaction or event is deleted.
+    transaction = models.ForeignKey(
+        Transaction,
+        on_delete=models.DO_NOTHING,
+        db_constraint=False,
+        null=True,
+        related_name="cash_entries",
+    )
+    event = models.ForeignKey(
+        AccountEvent,
+        on_delete=models.DO_NOTHING,
+        db_constraint=False,
+        null=True,
+        related_name="cash_entries",
+    )
+
+    class Meta:
+        indexes = [models.Index(fields=["account", "executed_at"])]
+
+
+class CashCheckpoint(models.Model):
+    """Balance of the account including all cash entries up to the time.
+
+    Checkpoints after a backdated entry are removed, see finance.ledger.
+    """
+
+    account = models.ForeignKey(
+        Account, on_delete=models.CASCADE, related_name="cash_checkpoints"
+    )
+    executed_at = models.DateTimeField()
+    balance = models.DecimalField(max_digits=20, decimal_places=10)
+
+    class Meta:
+        ordering = ["-executed_at"]
+        indexes = [models.Index(fields=["account", "executed_at"])]
 
 
 class IntegrationType(models.IntegerChoices):
@@ -532,6 +699,18 @@ class ImportStatus(models.IntegerChoices):
     SUCCESS = 1, _("Success")
     PARTIAL_SUCCESS = 2, _("Partial success")
     FAILURE = 3, _("Failure")
+    QUEUED = 4, _("Queued")
+    RUNNING = 5, _("Running")
+
+
+# Running imports are written in a single transaction, so their progress is
+# stored in the cache instead, after at least this part of all steps.
+IMPORT_PROGRESS_PARTS = 100
+# Rows of imports written at once, the progress advances after each batch.
+IMPORT_WRITE_BATCH_SIZE = 500
+# Imports still queued or running after this long are considered lost, e.g.
+# the worker running them crashed, and are queued again.
+IMPORT_TIMEOUT = datetime.timedelta(hours=1)
 
 
 class TransactionImport(models.Model):
@@ -539,10 +718,70 @@ class TransactionImport(models.Model):
     created_at = models.DateTimeField(auto_now_add=True)
     integration = models.IntegerField(choices=IntegrationType.choices)
     status = models.IntegerField(choices=ImportStatus.choices)
+    # Progress counted in steps, every row written and every remote lookup.
+    steps_done = models.IntegerField(default=0)
+    steps_total = models.IntegerField(null=True)
+    started_at = models.DateTimeField(null=True)
+    # Why the whole import failed, e.g. the file had an invalid format.
+    raw_issue = models.TextField(null=True)
+    # Uploaded file of a queued import, removed once it's imported.
+    upload = models.BinaryField(null=True)
+    import_all_assets = models.BooleanField(default=True)
 
     class Meta:
         ordering = ["-created_at"]
 
+    def _progress_key(self) -> str:
+        return f"import-progress:{self.pk}"
+
+    def _store_progress(self) -> None:
+        self._stored_steps = self.steps_done
+        cache.set(
+            self._progress_key(),
+            (self.steps_done, self.steps_total),
+            timeout=IMPORT_TIMEOUT.total_seconds(),
+        )
+
+    def start(self, steps_total: int) -> None:
+        """Marks the import as running, with a step for every row to write."""
+        self.status = ImportStatus.RUNNING
+        self.steps_done = 0
+        self.steps_total = steps_total
+        self.save(update_fields=["status", "steps_done", "steps_total"])
+        # Steps done when the progress was last stored.
+        self._stored_steps = 0
+        self._store_progress()
+
+    def add_steps(self, steps: int) -> None:
+        """Adds steps found while running, e.g. remote lookups."""
+        self.steps_total = (self.steps_total or 0) + steps
+        self._store_progress()
+
+    def advance(self, steps: int = 1) -> None:
+        """Stores the progress, if enough steps were done since."""
+        self.steps_done += steps
+        part = max(1, (self.steps_total or 0) // IMPORT_PROGRESS_PARTS)
+        if self.steps_done - self._stored_steps >= part:
+            self._store_progress()
+
+    def progress(self) -> Tuple[int, Optional[int]]:
+        """Steps done and all steps, as stored so far while running."""
+        if self.status == ImportStatus.RUNNING:
+            stored = cache.get(self._progress_key())
+            if stored is not None:
+                return stored
+        return self.steps_done, self.steps_total
+
+    def finish(self, status: ImportStatus) -> None:
+        self.status = status
+        self.steps_done = self.steps_total or 0
+        self.save(update_fields=["status", "steps_done", "steps_total"])
+
+    def fail(self, error: Exception) -> None:
+        self.status = ImportStatus.FAILURE
+        self.raw_issue = str(error.args[0]) if error.args else str(error)
+        self.save(update_fields=["status", "raw_issue"])
+
 
 class ImportIssueType(models.IntegerChoices):
     UNKNOWN_FAILURE = 1, _("UNKNOWN_FAILURE")
@@ -6,9 +6,10 @@ from typing import Optional
 
 import requests
 from django.conf import settings
+from django.db import transaction
 from django.db.models.base import ModelState
 
-from finance import models
+from finance import exchange_rates, history_cache, models, snapshots
 
 logger = logging.getLogger(__name__)
 
@@ -70,20 +71,9 @@ def generate_symbol_to_currency_pairs(currencies):
     return symbol_to_currency_pairs
 
 
-def get_closest_exchange_rate(
-    date: datetime.date, from_currency: models.Currency, to_currency: models.Currency
-):
-    rates = models.CurrencyExchangeRate.objects.filter(
-        from_currency=from_currency, to_currency=to_currency
-    )
-    rate = rates.filter(date__lte=date).order_by("-date").first()
-    if rate is None:
-        rate = rates.filter(date__gte=date).order_by("date").first()
-    return rate
-
-
 def collect_exchange_rates():
     symbol_to_currency_pair = generate_symbol_to_currency_pairs(currencies)
+    created_any = False
 
     for symbol, pair in symbol_to_currency_pair.items():
         from_currency = pair["from_currency"]
@@ -101,6 +91,7 @@ def collect_exchange_rates():
         if last_record:
             from_date = str(last_record.date)
 
+        first_created_date = None
         divide_by_hundred = False
         if symbol.startswith("GBX"):
             divide_by_hundred = True
@@ -115,17 +106,60 @@ def collect_exchange_rates():
         except Exception as e:
             logger.error("failed fetching %s, because of %s", symbol, e)
 
-        for record in records:
-            if divide_by_hundred:
-                value = record["close"] / 100
-            else:
-                value = record["close"]
-            models.CurrencyExchangeRate.objects.get_or_create(
-                date=record["date"],
-                value=value,
-                from_currency=from_currency,
-                to_currency=to_currency,
+        with transaction.atomic():
+            for record in records:
+                if divide_by_hundred:
+                    value = record["close"] / 100
+                else:
+                    value = record["close"]
+                _, created = models.CurrencyExchangeRate.objects.get_or_create(
+                    date=record["date"],
+                    value=value,
+                    from_currency=from_currency,
+                    to_currency=to_currency,
+                )
+                if created:
+                    date = datetime.date.fromisoformat(record["date"])
+                    first_created_date = min(date, first_created_date or date)
+                created_any = created_any or created
+            if first_created_date:
+                snapshots.invalidate_exchange_rate(
+                    from_currency, to_currency, first_created_date
+                )
+    if created_any:
+        history_cache.invalidate_exchange_rates()
+        exchange_rates.invalidate()
+        update_latest_exchange_rates()
+
+
+@transaction.atomic
+def update_latest_exchange_rates():
+    """Replaces all latest exchange rates with ones from the rate store."""
+    models.LatestExchangeRate.objects.all().delete()
+    models.LatestExchangeRate.objects.bulk_create(
+        [
+            models.LatestExchangeRate(
+                from_currency=rate.from_currency,
+                to_currency=rate.to_currency,
+                value=rate.value,
+                date=rate.date,
             )
+            for rate in exchange_rates.get_all_latest()
+        ]
+    )
+
+
+def update_latest_quote(asset_id: int):
+    """Stores the latest recorded price of the asset as its latest quote."""
+    latest = (
+        models.PriceHistory.objects.filter(asset_id=asset_id).order_by("-date").first()
+    )
+    if latest is None:
+        models.LatestQuote.objects.filter(asset_id=asset_id).delete()
+        return
+    models.LatestQuote.objects.update_or_create(
+        asset_id=asset_id, defaults={"value": latest.value, "date": latest.date}
+    )
 
 
 def collect_prices(asset):
@@ -154,13 +188,23 @@ def collect_prices(asset):
         logger.error("failed fetching %s, because of %s", symbol, e)
     prices = []
     logger.info("Number of new price records: %s", len(records))
-    for record in records:
-        price, _ = models.PriceHistory.objects.get_or_create(
-            date=record["date"],
-            value=record["close"],
-            asset=asset,
-        )
-        prices.append(price)
+    first_created_date = None
+    with transaction.atomic():
+        for record in records:
+            price, created = models.PriceHistory.objects.get_or_create(
+                date=record["date"],
+                value=record["close"],
+                asset=asset,
+            )
+            if created:
+                date = datetime.date.fromisoformat(record["date"])
+                first_created_date = min(date, first_created_date or date)
+            prices.append(price)
+        if first_created_date:
+            update_latest_quote(asset.pk)
+            snapshots.invalidate_asset(asset.pk, first_created_date)
+    if first_created_date:
+        history_cache.invalidate_asset(asset.pk)
     return prices
 
 
@@ -0,0 +1,85 @@
+"""Compact columnar wire formats for history series.
+
+Instead of [date, value] pairs, a history is sent as the date of its
+first point, the number of days between points and a flat array of
+numeric values. Histories are ordered from the latest point, so the
+start is the latest date and the period is negative. If points aren't
+evenly spaced, e.g. after downsampling, offsets of every point from the
+first date are sent instead of the period, also negative.
+
+Values can be delta encoded, then they are integers in units of
+10 ** -scale and all but the first one are differences from the previous
+value. Summing them up gives back every value exactly, rounded to the
+scale.
+
+Selected with the Accept header or ?format=columnar / ?format=msgpack.
+"""
+import decimal
+from typing import Any, Dict, List
+
+import msgpack
+from rest_framework import renderers
+from rest_framework.utils import encoders
+
+from finance import valuation
+
+
+# Decimal places of delta encoded values, scaled values stay well within
+# integers represented exactly by JavaScript numbers.
+DELTA_SCALE = 4
+
+
+def _scaled(values: List[Any]) -> List[int]:
+    # Floats are converted through their shortest representation, so that
+    # e.g. 0.1 is scaled to 1000 rather than rounded from 0.1000000000000000055.
+    return [
+        int(decimal.Decimal(str(value)).scaleb(DELTA_SCALE).to_integral_value())
+        for value in values
+    ]
+
+
+def columnar_history(
+    history: valuation.History, delta: bool = False
+) -> Dict[str, Any]:
+    """Columns of the history, points stay in the same order, latest first."""
+    start = history[0][0] if history else None
+    offsets = [(date - start).days for date, _ in history]
+    steps = {second - first for first, second in zip(offsets, offsets[1:])}
+
+    columns: Dict[str, Any] = {
+        "start": start,
+        "period": steps.pop() if len(steps) == 1 else None,
+    }
+    if columns["period"] is None:
+        columns["offsets"] = offsets
+    columns["delta"] = delta
+    if delta:
+        values = _scaled([value for _, value in history])
+        columns["scale"] = DELTA_SCALE
+        columns["values"] = values[:1] + [
+            second - first for first, second in zip(values, values[1:])
+        ]
+    else:
+        columns["values"] = [float(value) for _, value in history]
+    return columns
+
+
+class ColumnarJSONRenderer(renderers.JSONRenderer):
+    media_type = "application/vnd.invertimo.columnar+json"
+    format = "columnar"
+
+
+class ColumnarMessagePackRenderer(renderers.BaseRenderer):
+    media_type = "application/x-msgpack"
+    format = "msgpack"
+    charset = None
+    render_style = "binary"
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return b""
+        # Values not supported by MessagePack are converted like for JSON.
+        return msgpack.packb(data, default=encoders.JSONEncoder().default)
+
+
+COLUMNAR_FORMATS = (ColumnarJSONRenderer.format, ColumnarMessagePackRenderer.format)
@@ -0,0 +1,225 @@
+"""Exchanges, assets and positions looked up during one import.
+
+Imports refer to the same few exchanges and assets on many rows. They are
+looked up once per import, in one query per kind for all keys in the file,
+and remembered including lookups which found nothing.
+
+Lookups at the remote API, of assets unknown locally and of crypto prices,
+are made by `fetch_remote` before the import is written, at the same time
+and outside of transactions. Writing the import then only uses what was
+fetched, so no transaction is open while waiting for the API.
+"""
+import datetime
+import decimal
+import functools
+from concurrent import futures
+from typing import Callable, Dict, Hashable, Iterable, Optional, Set, Tuple, Union
+
+from django.db import connections
+
+from finance import models, prices, stock_exchanges
+
+# Remote lookups made at the same time.
+REMOTE_WORKERS = 8
+
+
+def _fetch(lookup: Callable):
+    """Result of the lookup or the exception it raised, in a worker thread."""
+    try:
+        return lookup()
+    except Exception as e:
+        return e
+    finally:
+        # Lookups can read the database first, from their own connections.
+        connections.close_all()
+
+
+class ImportResolver:
+    def __init__(self, account: models.Account):
+        self.account = account
+        # By MIC and reference, or the error to raise again.
+        self._exchanges: Dict[Tuple[str, str], Union[models.Exchange, Exception]] = {}
+        # By isin and exchange id, None if there was none.
+        self._assets: Dict[Tuple[str, int], Optional[models.Asset]] = {}
+        self._positions: Dict[Tuple[str, int], Optional[models.Position]] = {}
+        self._loaded_isins: Set[str] = set()
+        # Remote results by isin, symbol and symbol and date, or the error.
+        self._asset_records: Dict[str, Union[list, Exception]] = {}
+        self._crypto_tracked: Dict[str, bool] = {}
+        self._crypto_prices: Dict[
+            Tuple[str, datetime.date], Union[decimal.Decimal, Exception]
+        ] = {}
+
+    def prewarm(
+        self,
+        exchange_keys: Iterable[Tuple[str, str]] = (),
+        isins: Iterable[str] = (),
+    ) -> None:
+        """Looks up all exchanges, assets and positions of the keys at once."""
+        self._load_exchanges(set(exchange_keys) - self._exchanges.keys())
+        self._load_isins(set(isins) - self._loaded_isins)
+
+    def _load_exchanges(self, keys: Set[Tuple[str, str]]) -> None:
+        if not keys:
+            return
+        mics = set()
+        for mic, reference in keys:
+            mics.add(mic)
+            mics.add(stock_exchanges.simplified_mic(reference))
+        by_mic: Dict[str, Set[models.Exchange]] = {}
+        for identifier in models.ExchangeIdentifier.objects.filter(
+            id_type=models.ExchangeIDType.MIC, value__in=mics - {None}
+        ).select_related("exchange"):
+            by_mic.setdefault(identifier.value, set()).add(identifier.exchange)
+
+        def single(mic) -> Optional[models.Exchange]:
+            exchanges = by_mic.get(mic, ())
+            return next(iter(exchanges)) if len(exchanges) == 1 else None
+
+        for mic, reference in keys:
+            if reference == "DEG":
+                repository = stock_exchanges.ExchangeRepository()
+                self._exchanges[(mic, reference)] = repository.get_by_name(
+                    stock_exchanges.OTHER_OR_NA_EXCHANGE_NAME
+                )
+                continue
+            # Like ExchangeRepository.get, try mapping by the reference next.
+            exchange = single(mic) or single(stock_exchanges.simplified_mic(reference))
+            self._exchanges[(mic, reference)] = exchange or ValueError(
+                f"Couldn't map exchange {mic} {reference} to known exchanges."
+            )
+
+    def _load_isins(self, isins: Set[str]) -> None:
+        if not isins:
+            return
+        # Like AssetRepository.get, the first asset in the default ordering
+        # is used if there are a few, and the position of that one.
+        for position in (
+            models.Position.objects.filter(account=self.account, asset__isin__in=isins)
+            .select_related("asset")
+            .order_by("-asset_id", "asset__symbol", "id")
+        ):
+            key = (position.asset.isin, position.asset.exchange_id)
+            self._positions.setdefault(key, position)
+        for asset in models.Asset.objects.filter(isin__in=isins):
+            self._assets.setdefault((asset.isin, asset.exchange_id), asset)
+        self._loaded_isins |= isins
+
+    def fetch_remote(
+        self,
+        asset_keys: Iterable[Tuple[str, str, str]] = (),
+        crypto_symbols: Iterable[str] = (),
+        crypto_prices: Iterable[Tuple[str, datetime.date]] = (),
+        transaction_import: Optional["models.TransactionImport"] = None,
+    ) -> None:
+        """Looks up at the remote API all that isn't known locally, concurrently.
+
+        Assets are passed by isin, MIC and reference of their exchange. Only
+        assets without a position or an asset in the database are looked up.
+        Every lookup is a step of the progress of the import, if it's passed.
+        """
+        asset_keys = set(asset_keys)
+        self.prewarm(
+            exchange_keys={(mic, reference) for _, mic, reference in asset_keys},
+            isins={isin for isin, _, _ in asset_keys},
+        )
+        lookups: Dict[Hashable, Callable] = {}
+        for isin, mic, reference in asset_keys:
+            exchange = self._exchanges[(mic, reference)]
+            if isinstance(exchange, Exception) or isin in self._asset_records:
+                continue
+            key = (isin, exchange.pk)
+            if key not in self._positions and key not in self._assets:
+                lookups[("asset", isin)] = functools.partial(
+                    stock_exchanges.query_asset, isin
+                )
+        for symbol in set(crypto_symbols) - self._crypto_tracked.keys():
+            lookups[("tracked", symbol)] = functools.partial(
+                prices.are_crypto_prices_available, symbol
+            )
+        for symbol, date in set(crypto_prices) - self._crypto_prices.keys():
+            lookups[("price", symbol, date)] = functools.partial(
+                prices.get_crypto_usd_price_at_date, symbol, date=date
+            )
+        if not lookups:
+            return
+        if transaction_import is not None:
+            transaction_import.add_steps(len(lookups))
+
+        with futures.ThreadPoolExecutor(max_workers=REMOTE_WORKERS) as executor:
+            results = executor.map(_fetch, lookups.values())
+            for key, result in zip(lookups.keys(), results):
+                if transaction_import is not None:
+                    transaction_import.advance()
+                kind, *args = key
+                if kind == "asset":
+                    self._asset_records[args[0]] = result
+                elif kind == "tracked":
+                    # Like are_crypto_prices_available, not tracked if it failed.
+                    self._crypto_tracked[args[0]] = result is True
+                else:
+                    self._crypto_prices[tuple(args)] = result
+
+    def crypto_tracked(self, symbol: str) -> bool:
+        """If prices of the crypto asset are available."""
+        if symbol not in self._crypto_tracked:
+            self._crypto_tracked[symbol] = prices.are_crypto_prices_available(symbol)
+        return self._crypto_tracked[symbol]
+
+    def crypto_usd_price(self, symbol: str, date: datetime.date) -> decimal.Decimal:
+        """Price of the crypto asset, raises PriceNotAvailable if unknown."""
+        if (symbol, date) not in self._crypto_prices:
+            try:
+                self._crypto_prices[(symbol, date)] = (
+                    prices.get_crypto_usd_price_at_date(symbol, date=date)
+                )
+            except prices.PriceNotAvailable as e:
+                self._crypto_prices[(symbol, date)] = e
+        price = self._crypto_prices[(symbol, date)]
+        if isinstance(price, Exception):
+            raise price
+        return price
+
+    def exchange(self, mic: str, reference: str) -> models.Exchange:
+        """Exchange by its MIC or Degiro reference, raises ValueError if unknown."""
+        self._load_exchanges({(mic, reference)} - self._exchanges.keys())
+        exchange = self._exchanges[(mic, reference)]
+        if isinstance(exchange, Exception):
+            raise exchange
+        return exchange
+
+    def position(
+        self,
+        isin: str,
+        exchange: models.Exchange,
+        asset_defaults,
+        import_all_assets: bool,
+    ) -> Optional[models.Position]:
+        """Position of the asset in the account, created with the asset if needed.
+
+        None if the asset couldn't be found, like in
+        `AccountRepository._get_or_create_position`.
+        """
+        self._load_isins({isin} - self._loaded_isins)
+        key = (isin, exchange.pk)
+        if key in self._positions:
+            return self._positions[key]
+        asset = self._assets.get(key)
+        if asset is None:
+            asset_records = self._asset_records.get(isin)
+            if isinstance(asset_records, Exception):
+                raise asset_records
+            asset = stock_exchanges.get_or_create_asset(
+                isin,
+                exchange,
+                asset_defaults,
+                add_untracked_if_not_found=import_all_assets,
+                user=self.account.user,
+                asset_records=asset_records,
+            )
+            self._assets[key] = asset
+        position = None
+        if asset:
+            position = models.Position.objects.create(account=self.account, asset=asset)
+        self._positions[key] = position
+        return position
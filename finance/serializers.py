@@ -4,15 +4,16 @@ from rest_framework.request import Request
 
 from django.db.models import QuerySet
 import datetime
-from typing import Any, TypeVar
+from typing import Any, Callable, Iterable, TypeVar
 from django.contrib.auth.models import User
 
-from finance import models, stock_exchanges
+from finance import models, renderers, stock_exchanges, valuation
 from finance import gains
 from finance.models import (
     Account,
     AccountEvent,
     AssetType,
+    CostBasisMethod,
     Currency,
     CurrencyExchangeRate,
     EventType,
@@ -75,6 +76,11 @@ class CurrencyField(ChoicesToStringField):
     name = "currency"
 
 
+class CostBasisMethodField(ChoicesToStringField):
+    choices_class = CostBasisMethod
+    name = "cost basis method"
+
+
 class AssetTypeField(ChoicesToStringField):
     choices_class = AssetType
     name = "asset type"
@@ -244,6 +250,9 @@ class TransactionImportSerializer(serializers.ModelSerializer[TransactionImport]
     status = ImportStatusField()
     integration = IntegrationTypeField()
 
+    steps_done = serializers.SerializerMethodField()
+    steps_total = serializers.SerializerMethodField()
+
     class Meta:
         model = TransactionImport
         fields = [
@@ -252,10 +261,19 @@ class TransactionImportSerializer(serializers.ModelSerializer[TransactionImport]
             "created_at",
             "status",
             "integration",
+            "steps_done",
+            "steps_total",
+            "raw_issue",
             "records",
             "event_records",
         ]
 
+    def get_steps_done(self, obj):
+        return obj.progress()[0]
+
+    def get_steps_total(self, obj):
+        return obj.progress()[1]
+
     def get_extra_kwargs(self):
         kwargs = super().get_extra_kwargs()
         kwargs["account"] = kwargs.get("account", {})
@@ -273,6 +291,9 @@ class SimpleTransactionImportSerializer(serializers.ModelSerializer[TransactionI
     status = ImportStatusField()
     integration = IntegrationTypeField()
 
+    steps_done = serializers.SerializerMethodField()
+    steps_total = serializers.SerializerMethodField()
+
     class Meta:
         model = TransactionImport
         fields = [
@@ -281,8 +302,17 @@ class SimpleTransactionImportSerializer(serializers.ModelSerializer[TransactionI
             "created_at",
             "status",
             "integration",
+            "steps_done",
+            "steps_total",
+            "raw_issue",
         ]
 
+    def get_steps_done(self, obj):
+        return obj.progress()[0]
+
+    def get_steps_total(self, obj):
+        return obj.progress()[1]
+
     def get_extra_kwargs(self):
         kwargs = super().get_extra_kwargs()
         kwargs["account"] = kwargs.get("account", {})
@@ -301,6 +331,8 @@ class PositionSerializer(serializers.ModelSerializer[Position]):
     latest_price = serializers.DecimalField(max_digits=20, decimal_places=10)
     latest_exchange_rate = serializers.DecimalField(max_digits=20, decimal_places=10)
     latest_price_date = serializers.DateField()
+    # Realized gain and cost basis are out of date while lots are pending.
+    lots_pending = serializers.BooleanField(read_only=True)
 
     class Meta:
         model = Position
@@ -314,6 +346,7 @@ class PositionSerializer(serializers.ModelSerializer[Position]):
             "latest_exchange_rate",
             "realized_gain",
             "cost_basis",
+            "lots_pending",
         ]
 
 
@@ -548,6 +581,42 @@ class CorrectTransactionSerializer(serializers.ModelSerializer[Transaction]):
         ]
 
 
+def _deferred(items: Callable[[], Iterable]):
+    yield from items()
+
+
+def _history(context, items: Callable[[], Iterable]):
+    """Items of a history, computed only when written out if streaming."""
+    if context.get("stream"):
+        return _deferred(items)
+    return list(items())
+
+
+def _wire_history(context, history: valuation.History):
+    """History in the representation requested by the client."""
+    if context.get("columnar"):
+        return renderers.columnar_history(history, context.get("delta", False))
+    return history
+
+
+def _series(context, compute):
+    """Downsampled history returned by compute, in the wire representation.
+
+    Histories only feed charts, they are computed in the float mode.
+    """
+
+    def history():
+        return valuation.downsample(
+            compute(),
+            context.get("resolution", valuation.DAY),
+            context.get("points", valuation.LTTB_DEFAULT_POINTS),
+        )
+
+    if context.get("columnar"):
+        return _wire_history(context, history())
+    return _history(context, history)
+
+
 class PositionWithQuantitiesSerializer(serializers.ModelSerializer[Position]):
     asset = AssetSerializer()
     quantities = serializers.SerializerMethodField()
@@ -555,6 +624,7 @@ class PositionWithQuantitiesSerializer(serializers.ModelSerializer[Position]):
     values_account_currency = serializers.SerializerMethodField()
     transactions = EmbeddedTransactionSerializer(many=True)
     events = EmbeddedAccountEventSerializer(many=True)
+    lots_pending = serializers.BooleanField(read_only=True)
 
     class Meta:
         model = Position
@@ -570,28 +640,44 @@ class PositionWithQuantitiesSerializer(serializers.ModelSerializer[Position]):
             "values_account_currency",
             "realized_gain",
             "cost_basis",
+            "lots_pending",
         ]
 
+    def _series(self, compute):
+        return _series(self.context, compute)
+
     def get_quantities(self, obj):
         from_date = self.context["from_date"]
         to_date = self.context["to_date"]
-        return obj.quantity_history(
-            from_date=from_date,
-            to_date=to_date,
-            output_period=datetime.timedelta(days=1),
+        return self._series(
+            lambda: obj.quantity_history(
+                from_date=from_date,
+                to_date=to_date,
+                output_period=datetime.timedelta(days=1),
+                numeric=valuation.FLOAT,
+            )
         )
 
     def get_values(self, obj):
         from_date = self.context["from_date"]
         to_date = self.context["to_date"]
-        return obj.value_history(
-            from_date, to_date, output_period=datetime.timedelta(days=1)
+        return self._series(
+            lambda: obj.value_history(
+                from_date,
+                to_date,
+                output_period=datetime.timedelta(days=1),
+                numeric=valuation.FLOAT,
+            )
         )
 
     def get_values_account_currency(self, obj):
         from_date = self.context["from_date"]
         to_date = self.context["to_date"]
-        return obj.value_history_in_account_currency(from_date, to_date)
+        return self._series(
+            lambda: obj.value_history_in_account_currency(
+                from_date, to_date, numeric=valuation.FLOAT
+            )
+        )
 
 
 class CurrencyExchangeRateSerializer(serializers.ModelSerializer[CurrencyExchangeRate]):
@@ -611,6 +697,42 @@ class FromToDatesSerializer(serializers.Serializer[Any]):
     to_date = serializers.DateField(required=False)
 
 
+class HistoryQuerySerializer(FromToDatesSerializer):
+    resolution = serializers.ChoiceField(
+        choices=valuation.RESOLUTIONS, default=valuation.DAY
+    )
+    # Number of points for the LTTB resolution.
+    points = serializers.IntegerField(
+        min_value=3, max_value=5000, default=valuation.LTTB_DEFAULT_POINTS
+    )
+    # Encode the response while sending it, for long ranges.
+    stream = serializers.BooleanField(default=False)
+    # Delta encode values of columnar histories.
+    delta = serializers.BooleanField(default=False)
+
+
+class RealizedGainsQuerySerializer(serializers.Serializer[Any]):
+    account = serializers.IntegerField(required=False)
+    year = serializers.IntegerField(required=False)
+    # Split gains by how long the lots were held.
+    split_term = serializers.BooleanField(default=False)
+    # Lots held longer than this are long-term holdings.
+    long_term_days = serializers.IntegerField(min_value=0, default=365)
+
+
+class RealizedGainsSerializer(serializers.Serializer[Any]):
+    year = serializers.IntegerField()
+    account = serializers.IntegerField()
+    asset = serializers.IntegerField()
+    asset_symbol = serializers.CharField()
+    asset_type = AssetTypeField()
+    # Only if gains are split by term, "short" or "long".
+    term = serializers.CharField(required=False)
+    realized_gain = serializers.DecimalField(max_digits=20, decimal_places=10)
+    proceeds = serializers.DecimalField(max_digits=20, decimal_places=10)
+    cost_basis = serializers.DecimalField(max_digits=20, decimal_places=10)
+
+
 class CurrencyQuerySerializer(FromToDatesSerializer):
     from_currency = serializers.CharField()
     to_currency = serializers.CharField()
@@ -628,10 +750,22 @@ class CurrencyQuerySerializer(FromToDatesSerializer):
             raise serializers.ValidationError(f"{value} is not a valid currency symbol")
 
 
+class CostBasisQuerySerializer(serializers.Serializer[Any]):
+    # Cost basis method of the account if not passed.
+    method = CostBasisMethodField(required=False)
+
+
+class CostBasisComparisonSerializer(serializers.Serializer[Any]):
+    position = serializers.IntegerField()
+    realized_gain = serializers.DecimalField(max_digits=20, decimal_places=10)
+    cost_basis = serializers.DecimalField(max_digits=20, decimal_places=10)
+
+
 class AccountSerializer(serializers.ModelSerializer[Account]):
     positions_count = serializers.IntegerField()
     events_count = serializers.IntegerField()
     currency = CurrencyField()
+    cost_basis_method = CostBasisMethodField()
 
     class Meta:
         model = Account
@@ -644,12 +778,14 @@ class AccountSerializer(serializers.ModelSerializer[Account]):
             "last_modified",
             "positions_count",
             "events_count",
+            "cost_basis_method",
         ]
 
 
 class AccountEditSerializer(serializers.ModelSerializer[Account]):
     # Currency needs to be changed from string to enum.
     currency = CurrencyField()
+    cost_basis_method = CostBasisMethodField(required=False)
 
     class Meta:
         model = Account
@@ -658,6 +794,7 @@ class AccountEditSerializer(serializers.ModelSerializer[Account]):
             "currency",
             "nickname",
             "description",
+            "cost_basis_method",
         ]
 
     def validate_nickname(self, value):
@@ -683,7 +820,9 @@ class AccountWithValuesSerializer(serializers.ModelSerializer[Account]):
     positions_count = serializers.IntegerField()
     events_count = serializers.IntegerField()
     currency = CurrencyField()
+    cost_basis_method = CostBasisMethodField()
     values = serializers.SerializerMethodField()
+    balance_history = serializers.SerializerMethodField()
 
     class Meta:
         model = Account
@@ -696,14 +835,40 @@ class AccountWithValuesSerializer(serializers.ModelSerializer[Account]):
             "last_modified",
             "positions_count",
             "events_count",
+            "cost_basis_method",
             "values",
+            "balance_history",
         ]
 
-    def get_values(self, obj):
+    def get_balance_history(self, obj):
         from_date = self.context["from_date"]
         to_date = self.context["to_date"]
+        return _series(
+            self.context,
+            lambda: obj.balance_history(from_date, to_date, numeric=valuation.FLOAT),
+        )
 
-        return obj.value_history_per_position(from_date, to_date)
+    def get_values(self, obj):
+        from_date = self.context["from_date"]
+        to_date = self.context["to_date"]
+        resolution = self.context.get("resolution", valuation.DAY)
+        points = self.context.get("points", valuation.LTTB_DEFAULT_POINTS)
+
+        return _history(
+            self.context,
+            lambda: (
+                (
+                    position_id,
+                    _wire_history(
+                        self.context,
+                        valuation.downsample(history, resolution, points),
+                    ),
+                )
+                for position_id, history in obj.value_history_per_position(
+                    from_date, to_date, numeric=valuation.FLOAT
+                )
+            ),
+        )
 
 
 class AccountEventSerializer(serializers.ModelSerializer[AccountEvent]):
@@ -876,6 +1041,9 @@ class AddCryptoIncomeEventSerializer(serializers.ModelSerializer[AccountEvent]):
 
 
 class LotSerializer(serializers.ModelSerializer[Lot]):
+    # Lots of the position are about to be recomputed.
+    lots_pending = serializers.BooleanField(read_only=True)
+
     class Meta:
         model = Lot
         fields = "__all__"
@@ -0,0 +1,320 @@
+"""Materialized daily snapshots of positions.
+
+Every position gets a row per day, from the start of its history up to
+tomorrow, with the quantity, price and exchange rate of that day and the
+resulting values. Changes truncate the rows from the earliest affected
+date, later the rows are extended again up to tomorrow.
+
+Reading a date range is then a single index scan. If rows for any day of
+the range are missing, the snapshot isn't fresh and callers compute the
+history from transactions and prices instead.
+"""
+import datetime
+import decimal
+from collections import defaultdict
+from typing import Dict, List, NamedTuple, Optional, Sequence, Set, Tuple
+
+from django.db import transaction
+from django.db.models import F, Q
+
+from finance import models, valuation
+
+
+# Prices and exchange rates are collected from this date onwards.
+HISTORY_START = datetime.date(2020, 1, 1)
+
+
+class SnapshotRow(NamedTuple):
+    date: datetime.date
+    quantity: decimal.Decimal
+    price: Optional[decimal.Decimal]
+    price_from_transaction: bool
+    exchange_rate: Optional[decimal.Decimal]
+    value: Optional[decimal.Decimal]
+    value_account_currency: Optional[decimal.Decimal]
+
+
+_ROW_FIELDS = SnapshotRow._fields
+
+
+def horizon() -> datetime.date:
+    """Last day with a snapshot, charts include tomorrow by default."""
+    return datetime.date.today() + valuation.ONE_DAY
+
+
+def _lock_account(position: "models.Position") -> None:
+    """Takes the lock of the account, the same one its changes take.
+
+    Snapshots are then computed from committed changes only, and changes
+    invalidate them after they're written.
+    """
+    # Imported here, as accounts imports this module.
+    from finance import accounts
+
+    accounts._lock_accounts([position.account_id])
+    # The quantity might have been changed in the meantime.
+    position.refresh_from_db(fields=["quantity"])
+
+
+def rebuild(position: "models.Position", from_date: datetime.date) -> int:
+    """Replaces snapshots of the position from the date up to the horizon.
+
+    Returns the number of created rows.
+    """
+    with transaction.atomic():
+        _lock_account(position)
+        return _rebuild(position, from_date)
+
+
+def _rebuild(position: "models.Position", from_date: datetime.date) -> int:
+    to_date = horizon()
+    models.PositionDailySnapshot.objects.filter(
+        position=position, date__gte=from_date
+    ).delete()
+    if from_date > to_date:
+        return 0
+
+    # Transactions executed the day before set the price of the first day.
+    axis = valuation.DateAxis(from_date - valuation.ONE_DAY, to_date, valuation.ONE_DAY)
+    transactions = valuation.load_transactions(position)
+    quantities = valuation.compute_quantities(axis, position.quantity, transactions)
+    recorded, recorded_present = valuation.recorded_prices(
+        axis, valuation.load_prices(position, axis.from_date, to_date)
+    )
+    from_transactions, from_transactions_present = valuation.transaction_prices(
+        axis, transactions
+    )
+    from_currency = position.asset.currency
+    to_currency = position.account.currency
+    if from_currency == to_currency:
+        rates = [decimal.Decimal(1)] * axis.size
+        rates_present = [True] * axis.size
+    else:
+        rates, rates_present = valuation.compute_exchange_rates(
+            axis,
+            valuation.load_exchange_rates(
+                axis.from_date, to_date, from_currency, to_currency
+            ),
+            fill_forward=False,
+        )
+
+    snapshots = []
+    # The axis is ordered latest first, the last date is the extra day.
+    for i in range(axis.size - 1):
+        price = None
+        price_from_transaction = False
+        if recorded_present[i]:
+            price = recorded[i]
+        elif from_transactions_present[i]:
+            price = from_transactions[i]
+            price_from_transaction = True
+        exchange_rate = rates[i] if rates_present[i] else None
+        value = None
+        value_account_currency = None
+        if price is not None:
+            value = quantities[i] * price
+            if exchange_rate is not None:
+                value_account_currency = value * exchange_rate
+        snapshots.append(
+            models.PositionDailySnapshot(
+                position=position,
+                date=axis.dates[i],
+                quantity=quantities[i],
+                price=price,
+                price_from_transaction=price_from_transaction,
+                exchange_rate=exchange_rate,
+                value=value,
+                value_account_currency=value_account_currency,
+            )
+        )
+    models.PositionDailySnapshot.objects.bulk_create(snapshots, batch_size=1000)
+    return len(snapshots)
+
+
+def extend(position: "models.Position") -> int:
+    """Adds missing snapshots of the position after the latest one."""
+    with transaction.atomic():
+        _lock_account(position)
+        return _extend(position)
+
+
+def _extend(position: "models.Position") -> int:
+    latest_date = (
+        position.daily_snapshots.order_by("-date")
+        .values_list("date", flat=True)
+        .first()
+    )
+    if latest_date is not None:
+        return _rebuild(position, latest_date + valuation.ONE_DAY)
+
+    from_date = HISTORY_START
+    first_executed_at = (
+        position.transactions.order_by("executed_at")
+        .values_list("executed_at", flat=True)
+        .first()
+    )
+    if first_executed_at is not None:
+        from_date = min(from_date, first_executed_at.date())
+    return _rebuild(position, from_date)
+
+
+def invalidate(from_dates: Dict[int, datetime.date]) -> None:
+    """Removes snapshots of positions that might be affected by changes.
+
+    Dates are the earliest affected date of every position.
+    """
+    if not from_dates:
+        return
+    condition = Q()
+    for position_id, from_date in from_dates.items():
+        condition |= Q(position_id=position_id, date__gte=from_date)
+    models.PositionDailySnapshot.objects.filter(condition).delete()
+
+
+def invalidate_asset(asset_id: int, from_date: datetime.date) -> None:
+    models.PositionDailySnapshot.objects.filter(
+        position__asset_id=asset_id, date__gte=from_date
+    ).delete()
+
+
+def invalidate_exchange_rate(
+    from_currency: "models.Currency",
+    to_currency: "models.Currency",
+    from_date: datetime.date,
+) -> None:
+    """Removes snapshots of positions with rates derived from the pair.
+
+    Rates of the pair are also used for the inverse pair, and for pairs
+    triangulated through USD or EUR, see exchange_rates.
+    """
+    pair = (from_currency, to_currency)
+    condition = Q(
+        position__asset__currency=from_currency,
+        position__account__currency=to_currency,
+    ) | Q(
+        position__asset__currency=to_currency,
+        position__account__currency=from_currency,
+    )
+    for through in (models.Currency.USD, models.Currency.EUR):
+        if through in pair:
+            other = pair[1] if pair[0] == through else pair[0]
+            condition |= Q(position__asset__currency=other) | Q(
+                position__account__currency=other
+            )
+    models.PositionDailySnapshot.objects.filter(
+        condition, date__gte=from_date
+    ).exclude(position__asset__currency=F("position__account__currency")).delete()
+
+
+class SnapshotSeries:
+    """Histories of a position read from snapshots covering a date range.
+
+    Has the same interface as valuation.PositionSeries and returns the
+    same histories, including zero values before the first price of the
+    range and exchange rates reused after the latest one.
+    """
+
+    def __init__(self, rows: List[SnapshotRow]):
+        """Rows are ordered latest first, one per day of the range."""
+        self.rows = rows
+
+    def quantity_history(self) -> valuation.History:
+        return [(row.date, row.quantity) for row in self.rows]
+
+    def _values(self) -> Tuple[List[Optional[decimal.Decimal]], Set[int]]:
+        """Values at dates of the range and indices of values not stored."""
+        values = [row.value for row in self.rows]
+        adjusted = set()
+        last = len(self.rows) - 1
+        if self.rows[last].price_from_transaction:
+            # Price comes from a transaction executed before the range.
+            values[last] = None
+            adjusted.add(last)
+
+        recorded = [
+            i
+            for i, row in enumerate(self.rows)
+            if row.price is not None and not row.price_from_transaction
+        ]
+        if recorded:
+            for i in range(recorded[-1] + 1, len(self.rows)):
+                if values[i] is None:
+                    values[i] = self.rows[i].quantity * decimal.Decimal("0")
+                    adjusted.add(i)
+        return values, adjusted
+
+    def value_history(self) -> valuation.History:
+        values, _ = self._values()
+        return [
+            (row.date, value)
+            for row, value in zip(self.rows, values)
+            if value is not None
+        ]
+
+    def value_history_in_account_currency(self) -> valuation.History:
+        values, adjusted = self._values()
+        latest_index = next(
+            (i for i, row in enumerate(self.rows) if row.exchange_rate is not None),
+            None,
+        )
+        if latest_index is None:
+            return []
+        latest_rate = self.rows[latest_index].exchange_rate
+
+        history = []
+        for i, (row, value) in enumerate(zip(self.rows, values)):
+            if value is None:
+                continue
+            if i < latest_index:
+                # Dates after the latest rate reuse it.
+                history.append((row.date, latest_rate * value))
+            elif row.exchange_rate is None:
+                continue
+            elif i in adjusted:
+                history.append((row.date, row.exchange_rate * value))
+            else:
+                history.append((row.date, row.value_account_currency))
+        return history
+
+
+def read_many(
+    position_ids: Sequence[int],
+    from_date: datetime.date,
+    to_date: datetime.date,
+    output_period: datetime.timedelta = valuation.ONE_DAY,
+) -> Dict[int, SnapshotSeries]:
+    """Series of positions with fresh snapshots for the whole range.
+
+    Positions missing from the result have to be computed live.
+    """
+    if output_period != valuation.ONE_DAY or from_date > to_date:
+        return {}
+    rows = defaultdict(list)
+    for position_id, *fields in (
+        models.PositionDailySnapshot.objects.filter(
+            position_id__in=position_ids, date__gte=from_date, date__lte=to_date
+        )
+        .order_by("position_id", "-date")
+        .values_list("position_id", *_ROW_FIELDS)
+    ):
+        rows[position_id].append(SnapshotRow(*fields))
+
+    days = (to_date - from_date).days + 1
+    return {
+        position_id: SnapshotSeries(position_rows)
+        for position_id, position_rows in rows.items()
+        if len(position_rows) == days
+    }
+
+
+def read(
+    position_id: Optional[int],
+    from_date: datetime.date,
+    to_date: datetime.date,
+    output_period: datetime.timedelta = valuation.ONE_DAY,
+) -> Optional[SnapshotSeries]:
+    if position_id is None:
+        return None
+    return read_many([position_id], from_date, to_date, output_period).get(
+        position_id
+    )
@@ -24,6 +24,11 @@ _REFERENCE_TO_OPERATING_MIC_SIMPLIFIED_MAPPING: Dict[str, str] = {
 
 OTHER_OR_NA_EXCHANGE_NAME = "Other / NA"
 
+
+def simplified_mic(exchange_reference: str) -> Optional[str]:
+    """Operating MIC of the exchange with the Degiro reference, if known."""
+    return _REFERENCE_TO_OPERATING_MIC_SIMPLIFIED_MAPPING.get(exchange_reference, None)
+
 SUPPORTED_EXCHANGE_CODES = [
     "US",
     "XETRA",
@@ -54,12 +59,10 @@ class ExchangeRepository:
             )
         except Exception as e:
             # Try mapping by exchange reference (relevant to degiro).
-            simplified_mic = _REFERENCE_TO_OPERATING_MIC_SIMPLIFIED_MAPPING.get(
-                exchange_reference, None
-            )
+            mic = simplified_mic(exchange_reference)
             try:
                 return models.Exchange.objects.get(
-                    identifiers__value=simplified_mic,
+                    identifiers__value=mic,
                     identifiers__id_type=models.ExchangeIDType.MIC,
                 )
             except:
@@ -127,7 +130,12 @@ def get_or_create_asset(
     asset_defaults,
     add_untracked_if_not_found,
     user,
+    asset_records=None,
 ):
+    """Asset of the isin on the exchange, searched for if it's not known yet.
+
+    Asset records of the search can be passed if they were fetched already.
+    """
     repository = AssetRepository(exchange)
     asset = repository.get(isin)
     if asset:
@@ -138,7 +146,8 @@ def get_or_create_asset(
         ).value
     else:
         exchange_code = ""
-    asset_records = query_asset(isin)
+    if asset_records is None:
+        asset_records = query_asset(isin)
     for record in asset_records:
         if record["Exchange"] == exchange_code:
             asset_type_raw = record["Type"]
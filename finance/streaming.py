@@ -0,0 +1,70 @@
+"""Streaming JSON responses for large histories.
+
+Data is encoded incrementally and iterators in it are consumed only when
+they are written out, so a serializer can return lazily computed
+histories and the whole response never has to be in memory at once.
+"""
+import collections.abc
+from typing import Any, Iterator
+
+from django.http import StreamingHttpResponse
+from rest_framework.utils import encoders
+
+
+# Size of chunks sent to the client, in characters.
+CHUNK_SIZE = 64 * 1024
+
+
+def _encoder() -> encoders.JSONEncoder:
+    # Same output as the compact, strict DRF JSONRenderer.
+    return encoders.JSONEncoder(
+        ensure_ascii=False, separators=(",", ":"), allow_nan=False
+    )
+
+
+def _iter_encode(value: Any, encoder: encoders.JSONEncoder) -> Iterator[str]:
+    if isinstance(value, collections.abc.Mapping):
+        yield "{"
+        for i, (key, item) in enumerate(value.items()):
+            if i:
+                yield ","
+            yield encoder.encode(str(key))
+            yield ":"
+            yield from _iter_encode(item, encoder)
+        yield "}"
+    elif isinstance(value, (list, tuple, collections.abc.Iterator)):
+        yield "["
+        for i, item in enumerate(value):
+            if i:
+                yield ","
+            yield from _iter_encode(item, encoder)
+        yield "]"
+    else:
+        yield encoder.encode(value)
+
+
+def iter_json(data: Any, chunk_size: int = CHUNK_SIZE) -> Iterator[bytes]:
+    """Encodes data as JSON in chunks of roughly the given size."""
+    chunk = []
+    size = 0
+    for piece in _iter_encode(data, _encoder()):
+        chunk.append(piece)
+        size += len(piece)
+        if size >= chunk_size:
+            yield "".join(chunk).encode()
+            chunk = []
+            size = 0
+    if chunk:
+        yield "".join(chunk).encode()
+
+
+class StreamingJSONResponse(StreamingHttpResponse):
+    """Response with data encoded as JSON while it's being sent.
+
+    Errors raised while the data is produced can't change the status of
+    the response anymore, the client gets a truncated body instead.
+    """
+
+    def __init__(self, data: Any, **kwargs):
+        kwargs.setdefault("content_type", "application/json")
+        super().__init__(iter_json(data), **kwargs)
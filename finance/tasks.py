@@ -1,19 +1,84 @@
 
 from invertimo.celery import app
+from celery.signals import task_prerun
 from celery.utils.log import get_task_logger
-from finance import prices, models
+from finance import exchange_rates, gains, prices, models, snapshots
+from django.core.cache import cache
 from django.core.management import call_command
 
 
 logger = get_task_logger(__name__)
 
 
+@task_prerun.connect
+def expire_exchange_rates(**kwargs):
+    # Every task sees rates at most as old as its start, like a request does.
+    exchange_rates.expire()
+
+
 @app.task()
 def collect_prices(asset_id):
     asset = models.Asset.objects.get(pk=asset_id)
     logger.info(f"Collecting prices for asset: {asset}.")
     values = prices.collect_prices(asset)
     logger.info(f"Collected {len(values)} of prices for asset: {asset}.")
+    for position in asset.positions.select_related("account"):
+        snapshots.extend(position)
+
+
+@app.task()
+def update_snapshots(position_ids):
+    positions = models.Position.objects.filter(pk__in=position_ids).select_related(
+        "asset", "account"
+    )
+    for position in positions:
+        created = snapshots.extend(position)
+        logger.info(f"Created {created} daily snapshots for position: {position}.")
+
+
+# Lots are recomputed this many seconds after the first change, changes
+# in the meantime are recomputed together.
+LOTS_DELAY = 5
+
+
+def _lots_scheduled_key(position_id):
+    return f"lots:scheduled:{position_id}"
+
+
+def schedule_update_lots(position_ids):
+    """Schedules recomputing pending lots, unless it's already scheduled."""
+    for position_id in position_ids:
+        # Expires in case the task is lost, so that later changes retry.
+        if cache.add(_lots_scheduled_key(position_id), True, timeout=LOTS_DELAY * 12):
+            update_lots.apply_async((position_id,), countdown=LOTS_DELAY)
+
+
+@app.task()
+def update_lots(position_id):
+    # Changes from now on need another run.
+    cache.delete(_lots_scheduled_key(position_id))
+    if gains.update_pending_lots(position_id):
+        logger.info(f"Updated lots for position: {position_id}.")
+
+
+# Acknowledged once done, so that the import is delivered again if the
+# worker is lost while running it.
+@app.task(acks_late=True, reject_on_worker_lost=True)
+def run_import(transaction_import_id):
+    # Imported here, as the parsers schedule tasks.
+    from finance import imports
+
+    imports.run(transaction_import_id)
+    logger.info(f"Ran transaction import: {transaction_import_id}.")
+
+
+@app.task()
+def requeue_stale_imports():
+    from finance import imports
+
+    requeued = imports.requeue_stale()
+    if requeued:
+        logger.info(f"Queued {requeued} stale transaction imports again.")
 
 
 @app.task()
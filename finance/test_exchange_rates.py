@@ -0,0 +1,124 @@
+import datetime
+import decimal
+
+from django.core.cache import cache
+from django.test import TestCase
+
+from finance import exchange_rates, models
+
+
+class TestExchangeRates(TestCase):
+    def setUp(self):
+        super().setUp()
+        cache.clear()
+        self._add_rate(models.Currency.USD, models.Currency.EUR, "2021-03-01", "0.8")
+        self._add_rate(models.Currency.USD, models.Currency.EUR, "2021-03-05", "0.9")
+        self._add_rate(models.Currency.PLN, models.Currency.USD, "2021-03-03", "0.25")
+        self._add_rate(models.Currency.GBP, models.Currency.EUR, "2021-03-02", "1.2")
+
+    def _add_rate(self, from_currency, to_currency, date, value):
+        models.CurrencyExchangeRate.objects.create(
+            from_currency=from_currency,
+            to_currency=to_currency,
+            date=date,
+            value=decimal.Decimal(value),
+        )
+
+    def test_recorded_pair(self):
+        rate = exchange_rates.get_closest(
+            datetime.date(2021, 3, 4), models.Currency.USD, models.Currency.EUR
+        )
+        self.assertEqual(rate.date, datetime.date(2021, 3, 1))
+        self.assertEqual(rate.value, decimal.Decimal("0.8"))
+
+    def test_inverse_pair(self):
+        rate = exchange_rates.get_latest(models.Currency.EUR, models.Currency.USD)
+        self.assertEqual(rate.date, datetime.date(2021, 3, 5))
+        self.assertEqual(rate.from_currency, models.Currency.EUR)
+        self.assertEqual(rate.to_currency, models.Currency.USD)
+        self.assertAlmostEqual(rate.value, decimal.Decimal(1) / decimal.Decimal("0.9"))
+
+    def test_triangulated_through_usd(self):
+        rate = exchange_rates.get_closest(
+            datetime.date(2021, 3, 4), models.Currency.PLN, models.Currency.EUR
+        )
+        # Rates of both legs on the latest date of either of them.
+        self.assertEqual(rate.date, datetime.date(2021, 3, 3))
+        self.assertEqual(rate.value, decimal.Decimal("0.2"))
+        rate = exchange_rates.get_latest(models.Currency.PLN, models.Currency.EUR)
+        self.assertEqual(rate.date, datetime.date(2021, 3, 5))
+        self.assertEqual(rate.value, decimal.Decimal("0.225"))
+
+    def test_triangulated_through_eur(self):
+        rate = exchange_rates.get_closest(
+            datetime.date(2021, 3, 2), models.Currency.GBP, models.Currency.USD
+        )
+        self.assertEqual(rate.date, datetime.date(2021, 3, 2))
+        self.assertAlmostEqual(
+            rate.value, decimal.Decimal("1.2") / decimal.Decimal("0.8")
+        )
+
+    def test_unknown_pair(self):
+        self.assertIsNone(
+            exchange_rates.get_latest(models.Currency.JPY, models.Currency.EUR)
+        )
+        self.assertIsNone(
+            exchange_rates.get_latest(models.Currency.EUR, models.Currency.EUR)
+        )
+
+    def test_lookups_dont_query(self):
+        exchange_rates.get_latest(models.Currency.USD, models.Currency.EUR)
+        with self.assertNumQueries(0):
+            exchange_rates.get_closest(
+                datetime.date(2021, 3, 4), models.Currency.PLN, models.Currency.EUR
+            )
+            exchange_rates.get_between(
+                datetime.date(2021, 3, 1),
+                datetime.date(2021, 3, 5),
+                models.Currency.USD,
+                models.Currency.EUR,
+            )
+
+    def test_expired_lookup_only_checks_freshness(self):
+        exchange_rates.get_latest(models.Currency.USD, models.Currency.EUR)
+        exchange_rates.expire()
+        with self.assertNumQueries(1):
+            exchange_rates.get_latest(models.Currency.USD, models.Currency.EUR)
+
+    def test_rates_between(self):
+        self.assertEqual(
+            exchange_rates.get_between(
+                datetime.date(2021, 3, 1),
+                datetime.date(2021, 3, 5),
+                models.Currency.USD,
+                models.Currency.EUR,
+            ),
+            [
+                (datetime.date(2021, 3, 5), decimal.Decimal("0.9")),
+                (datetime.date(2021, 3, 1), decimal.Decimal("0.8")),
+            ],
+        )
+        self.assertEqual(
+            exchange_rates.get_between(
+                datetime.date(2021, 3, 2),
+                datetime.date(2021, 3, 4),
+                models.Currency.USD,
+                models.Currency.EUR,
+            ),
+            [],
+        )
+
+    def test_reloads_new_rates(self):
+        exchange_rates.get_latest(models.Currency.USD, models.Currency.EUR)
+        self._add_rate(models.Currency.USD, models.Currency.EUR, "2021-03-08", "0.7")
+        rate = exchange_rates.get_latest(models.Currency.USD, models.Currency.EUR)
+        self.assertEqual(rate.value, decimal.Decimal("0.7"))
+
+    def test_reloads_when_invalidated(self):
+        exchange_rates.get_latest(models.Currency.USD, models.Currency.EUR)
+        models.CurrencyExchangeRate.objects.filter(
+            from_currency=models.Currency.USD, date="2021-03-05"
+        ).update(value=decimal.Decimal("0.95"))
+        exchange_rates.invalidate()
+        rate = exchange_rates.get_latest(models.Currency.USD, models.Currency.EUR)
+        self.assertEqual(rate.value, decimal.Decimal("0.95"))
@@ -0,0 +1,233 @@
+import datetime
+import decimal
+
+from django.contrib.auth.models import User
+from django.test import TestCase
+from hypothesis import given, settings
+from hypothesis import strategies as st
+from hypothesis.extra.django import TestCase as HypothesisTestCase
+
+from finance import accounts, gains, models
+
+
+START = datetime.datetime(2021, 3, 1, 10, tzinfo=datetime.timezone.utc)
+
+transactions = st.lists(
+    st.tuples(
+        # Hours after the start, some transactions are executed at once.
+        st.integers(min_value=0, max_value=200),
+        st.integers(min_value=-10, max_value=10).filter(bool),
+        # Total in account currency, in cents.
+        st.integers(min_value=-100000, max_value=100000),
+    ),
+    min_size=1,
+    max_size=12,
+)
+
+changes = st.lists(
+    st.one_of(
+        st.tuples(st.just("delete"), st.integers(min_value=0)),
+        st.tuples(
+            st.just("correct"),
+            st.integers(min_value=0),
+            st.integers(min_value=0, max_value=200),
+            st.integers(min_value=-10, max_value=10).filter(bool),
+        ),
+    ),
+    max_size=4,
+)
+
+
+class TestIncrementalLots(HypothesisTestCase):
+    def setUp(self):
+        super().setUp()
+        self.user = User.objects.create(username="testuser", email="test@example.com")
+        self.account = models.Account.objects.create(
+            user=self.user, currency=models.Currency.EUR, nickname="test account"
+        )
+        exchange = models.Exchange.objects.create(name="USA stocks", country="USA")
+        self.asset = models.Asset.objects.create(
+            isin="US1234",
+            symbol="MOONIES",
+            name="a stock",
+            currency=models.Currency.USD,
+            exchange=exchange,
+            tracked=True,
+        )
+        self.repository = accounts.AccountRepository()
+
+    def _state(self):
+        position = models.Position.objects.get(asset=self.asset)
+        # Ids of lots of the same buy can be assigned in another order.
+        lots = sorted(
+            models.Lot.objects.values_list(
+                "quantity",
+                "buy_transaction_id",
+                "cost_basis_account_currency",
+                "sell_transaction_id",
+                "sell_basis_account_currency",
+                "realized_gain_account_currency",
+            ),
+            key=str,
+        )
+        return lots, position.realized_gain, position.cost_basis
+
+    def _assert_matches_full_rebuild(self):
+        state = self._state()
+        gains.update_lots(models.Position.objects.get(asset=self.asset))
+        self.assertEqual(state, self._state())
+
+    @settings(max_examples=40, deadline=None)
+    @given(
+        transactions=transactions,
+        changes=changes,
+        method=st.sampled_from(models.CostBasisMethod),
+    )
+    def test_incremental_matches_full_rebuild(self, transactions, changes, method):
+        self.account.cost_basis_method = method
+        self.account.save()
+        for hours, quantity, total in transactions:
+            try:
+                self.repository.add_transaction_known_asset(
+                    self.account,
+                    self.asset.pk,
+                    START + datetime.timedelta(hours=hours),
+                    decimal.Decimal(quantity),
+                    decimal.Decimal(10),
+                    decimal.Decimal(0),
+                    decimal.Decimal(total) / 100,
+                    decimal.Decimal(total) / 100,
+                    decimal.Decimal(total) / 100,
+                )
+            except gains.SoldBeforeBought:
+                continue
+            self._assert_matches_full_rebuild()
+
+        for change in changes:
+            existing = list(models.Transaction.objects.order_by("id"))
+            if not existing:
+                break
+            transaction = existing[change[1] % len(existing)]
+            try:
+                if change[0] == "delete":
+                    self.repository.delete_transaction(transaction)
+                else:
+                    self.repository.correct_transaction(
+                        transaction,
+                        {
+                            "executed_at": START
+                            + datetime.timedelta(hours=change[2]),
+                            "quantity": decimal.Decimal(change[3]),
+                        },
+                    )
+            except (gains.SoldBeforeBought, accounts.DuplicateTransaction):
+                continue
+            self._assert_matches_full_rebuild()
+
+
+class TestCostBasisMethods(TestCase):
+    def setUp(self):
+        super().setUp()
+        self.user = User.objects.create(username="testuser", email="test@example.com")
+        self.account = models.Account.objects.create(
+            user=self.user, currency=models.Currency.EUR, nickname="test account"
+        )
+        exchange = models.Exchange.objects.create(name="USA stocks", country="USA")
+        self.asset = models.Asset.objects.create(
+            isin="US1234",
+            symbol="MOONIES",
+            name="a stock",
+            currency=models.Currency.USD,
+            exchange=exchange,
+            tracked=True,
+        )
+        repository = accounts.AccountRepository()
+        for days, quantity, price in (
+            (0, 10, 10),
+            (1, 10, 30),
+            (2, 10, 20),
+            (3, -15, 30),
+        ):
+            total = decimal.Decimal(-quantity * price)
+            repository.add_transaction_known_asset(
+                self.account,
+                self.asset.pk,
+                START + datetime.timedelta(days=days),
+                decimal.Decimal(quantity),
+                decimal.Decimal(price),
+                decimal.Decimal(0),
+                total,
+                total,
+                total,
+            )
+        self.position = models.Position.objects.get(asset=self.asset)
+
+    def test_methods(self):
+        # Sold 15 for 450, bought for 100, 300 and 200 per 10.
+        expected = {
+            models.CostBasisMethod.FIFO: (200, -350),
+            models.CostBasisMethod.LIFO: (100, -250),
+            models.CostBasisMethod.HIFO: (50, -200),
+            models.CostBasisMethod.AVERAGE: (150, -300),
+        }
+        for method, (realized_gain, cost_basis) in expected.items():
+            with self.subTest(method=method):
+                matcher = gains.compare(self.position, method)
+                self.assertEqual(matcher.realized_gain, realized_gain)
+                self.assertEqual(matcher.cost_basis, cost_basis)
+
+                self.account.cost_basis_method = method
+                self.account.save()
+                gains.update_lots(models.Position.objects.get(pk=self.position.pk))
+                self.position.refresh_from_db()
+                self.assertEqual(self.position.realized_gain, realized_gain)
+                self.assertEqual(self.position.cost_basis, cost_basis)
+                self.assertEqual(
+                    sum(
+                        lot.quantity
+                        for lot in self.position.lots.filter(sell_date=None)
+                    ),
+                    15,
+                )
+
+    def test_comparing_doesnt_save_lots(self):
+        lots = list(models.Lot.objects.values_list("id", "cost_basis_account_currency"))
+        gains.compare(self.position, models.CostBasisMethod.HIFO)
+        self.assertEqual(
+            list(models.Lot.objects.values_list("id", "cost_basis_account_currency")),
+            lots,
+        )
+
+    def test_checking_quantities(self):
+        later = START + datetime.timedelta(days=5)
+        gains.check_quantities_many({self.position: None})
+        models.Transaction.objects.create(
+            executed_at=START + datetime.timedelta(days=4),
+            position=self.position,
+            quantity=decimal.Decimal(-20),
+            price=decimal.Decimal(30),
+            local_value=0,
+            value_in_account_currency=0,
+            total_in_account_currency=0,
+        )
+
+        with self.assertRaises(gains.SoldBeforeBought):
+            gains.check_quantities_many({self.position: None})
+        # Only transactions since the time are checked.
+        with self.assertNumQueries(1):
+            gains.check_quantities_many({self.position: later})
+        with self.assertRaises(gains.SoldBeforeBought):
+            gains.check_quantities(self.position, START)
+
+    def test_queued_lots_keep_the_earliest_time(self):
+        later = START + datetime.timedelta(days=5)
+        with self.assertNumQueries(1):
+            gains.mark_pending_many({self.position.pk: later})
+        gains.mark_pending(self.position.pk, START)
+        gains.mark_pending(self.position.pk, later)
+        self.assertEqual(self.position.pending_lots.since, START)
+
+        gains.mark_pending(self.position.pk)
+        gains.mark_pending(self.position.pk, START)
+        self.position.pending_lots.refresh_from_db()
+        self.assertIsNone(self.position.pending_lots.since)
@@ -1,22 +1,27 @@
 import datetime
 import decimal
+import io
 from unittest.mock import patch
 
 from django.contrib.auth.models import User
 from django.core import validators
 from django.db.models import Sum
-from django.test import TestCase
+from django.test import TestCase, override_settings
+from django.utils import timezone
 
 from finance import (
+    assets,
+    imports,
     models,
     prices,
+    resolution,
     testing_utils,
     utils,
     tasks,
     stock_exchanges,
     accounts,
 )
-from finance.integrations import binance_parser, degiro_parser
+from finance.integrations import binance_parser, degiro_parser, schemas
 
 
 ETH_QUANTITY = decimal.Decimal("0.1850657800")
@@ -245,6 +250,113 @@ class TestDegiroParser(TestCase):
         self.assertEqual(stock.currency, models.Currency.USD)
         self.assertTrue(stock.tracked)
 
+    def test_read_transactions_normalizes_columns(self):
+        with open("./finance/transactions_example_latest.csv") as f:
+            header, row, *_ = f.read().splitlines()
+        export = "\n".join(
+            [
+                header,
+                row,
+                row.replace("18-11-2021,15:30", "02.12.20,9:04"),
+                row.replace("18-11-2021", "2021/11/18").replace("206.2600", "?"),
+            ]
+        )
+        records = degiro_parser.read_transactions(io.StringIO(export))
+
+        self.assertEqual(
+            [record.executed_at for record in records],
+            [
+                datetime.datetime(2020, 12, 2, 9, 4, tzinfo=datetime.timezone.utc),
+                datetime.datetime(2021, 11, 18, 15, 30, tzinfo=datetime.timezone.utc),
+                None,
+            ],
+        )
+        self.assertEqual(records[0].price, decimal.Decimal("206.2600"))
+        self.assertEqual(str(records[0].total), "-182.40")
+        self.assertEqual(records[0].transaction_costs, decimal.Decimal("-0.50"))
+        self.assertEqual(records[0].value_currency, "EUR")
+        self.assertEqual(records[0].venue, "XNAS")
+        self.assertIsNone(records[2].price)
+
+    def test_read_transactions_quotes_raw_records(self):
+        with open("./finance/transactions_example_latest.csv") as f:
+            header, row, *_ = f.read().splitlines()
+        export = "\n".join(
+            [header, row.replace("PAYPAL HOLDINGS INC.", '"PAYPAL ""PP"", INC."')]
+        )
+        records = degiro_parser.read_transactions(io.StringIO(export))
+
+        self.assertIn('\nProduct,"PAYPAL ""PP"", INC."\n', records[0].raw_record)
+        self.assertIn("\nISIN,US70450Y103812\n", records[0].raw_record)
+
+    @patch("finance.stock_exchanges.query_asset")
+    def test_import_resolver_looks_up_once(self, query_asset_mock):
+        query_asset_mock.return_value = []
+        account = models.Account.objects.create(
+            user=User.objects.all()[0], nickname="test"
+        )
+        nasdaq = stock_exchanges.ExchangeRepository().get("CDED", "NDQ")
+        resolver = resolution.ImportResolver(account)
+        resolver.prewarm(
+            exchange_keys=[("CDED", "NDQ"), ("XXXX", "ABC")],
+            isins=["US0378331005"],
+        )
+
+        with self.assertNumQueries(0):
+            self.assertEqual(resolver.exchange("CDED", "NDQ"), nasdaq)
+            for _ in range(2):
+                with self.assertRaises(ValueError):
+                    resolver.exchange("XXXX", "ABC")
+
+        position = resolver.position(
+            "US0378331005", nasdaq, {"local_currency": "USD"}, False
+        )
+        self.assertEqual(position.asset.isin, "US0378331005")
+        with self.assertNumQueries(0):
+            self.assertEqual(
+                resolver.position(
+                    "US0378331005", nasdaq, {"local_currency": "USD"}, False
+                ),
+                position,
+            )
+
+        # Assets which weren't found aren't looked up again.
+        for _ in range(2):
+            self.assertIsNone(
+                resolver.position(
+                    "US0000000000", nasdaq, {"local_currency": "USD"}, False
+                )
+            )
+        self.assertEqual(query_asset_mock.call_count, 1)
+
+    def test_import_resolver_picks_the_same_asset_as_repository(self):
+        account = models.Account.objects.create(
+            user=User.objects.all()[0], nickname="test"
+        )
+        nasdaq = stock_exchanges.ExchangeRepository().get("CDED", "NDQ")
+        for symbol in ("AAPL", "AAPL.OLD"):
+            models.Asset.objects.create(
+                isin="US0378331005",
+                symbol=symbol,
+                name="Apple",
+                currency=models.Currency.USD,
+                exchange=nasdaq,
+                tracked=True,
+            )
+        asset = assets.AssetRepository(nasdaq).get("US0378331005")
+
+        resolver = resolution.ImportResolver(account)
+        position = resolver.position(
+            "US0378331005", nasdaq, {"local_currency": "USD"}, False
+        )
+        self.assertEqual(position.asset, asset)
+        self.assertEqual(
+            resolution.ImportResolver(account).position(
+                "US0378331005", nasdaq, {"local_currency": "USD"}, False
+            ),
+            position,
+        )
+
     @patch("finance.stock_exchanges.query_asset")
     def test_assets_with_same_isin_multiple_currencies(self, mock):
         mock.return_value = SAME_ISIN_MULTIPLE_CURRENCIES_RESPONSE
@@ -259,6 +371,73 @@ class TestDegiroParser(TestCase):
         self.assertEqual(asset.currency, models.Currency.GBP)
 
 
+class TestSchemas(TestCase):
+    def test_matches_headers_in_any_language(self):
+        for header in (
+            "Date,Time,Product,ISIN,Reference,Venue,Quantity,Price,,Local value,,"
+            "Value,,Exchange rate,Transaction and/or third,,Total,,Order ID",
+            "Datum,Uhrzeit,Produkt,ISIN,Referenzbörse,Ausführungsort,Anzahl,Kurs,,"
+            "Wert in Lokalwährung,,Wert,,Wechselkurs,Transaktionskosten und/oder,,"
+            "Gesamt,,Order-ID",
+            # Partly translated.
+            "Data,Czas,Produkt,ISIN,Reference,Venue,Quantity,Price,,Local value,,"
+            "Value,,Exchange rate,Transaction and/or third,,Total,,Order ID",
+        ):
+            self.assertEqual(
+                schemas.match(header.split(","), models.IntegrationType.DEGIRO),
+                schemas.DEGIRO,
+            )
+        with self.assertRaises(schemas.UnknownLayout):
+            schemas.match(
+                schemas.BINANCE.headers[0].split(","), models.IntegrationType.DEGIRO
+            )
+
+    def test_unknown_layout_fails_before_reading_the_body(self):
+        with open("./finance/transactions_example_latest_bad_columns.csv", "rb") as f:
+            with patch("pandas.read_csv") as read_csv_mock:
+                with self.assertRaisesRegex(
+                    schemas.UnknownLayout, "unknown columns: Foo, Bar$"
+                ):
+                    schemas.read_csv(f, models.IntegrationType.DEGIRO)
+        read_csv_mock.assert_not_called()
+
+    def test_reads_columns_named_by_the_schema(self):
+        data = schemas.read_csv(
+            "./finance/transactions_example_latest_renamed.csv",
+            models.IntegrationType.DEGIRO,
+            dtype=str,
+        )
+        self.assertEqual(list(data.columns), list(schemas.DEGIRO.columns))
+        self.assertEqual(len(data), 6)
+        self.assertEqual(data["Value currency"].iloc[0], "EUR")
+
+    def test_matches_binance_columns_by_name(self):
+        export = (
+            "UTC_Time,Coin,Operation,Fee,Change,User_ID\n"
+            "2021-11-18 15:30:00,BTC,Deposit,0.1,1.5,123\n"
+        )
+        data = schemas.read_csv(
+            io.StringIO(export), models.IntegrationType.BINANCE_CSV, dtype=str
+        )
+        self.assertEqual(list(data.columns), list(schemas.BINANCE.columns))
+        self.assertEqual(data["Coin"].iloc[0], "BTC")
+        self.assertEqual(data["Change"].iloc[0], "1.5")
+        self.assertEqual(data["User_ID"].iloc[0], "123")
+        self.assertTrue(data["Remark"].isna().all())
+
+        with self.assertRaisesRegex(
+            schemas.UnknownLayout, "missing columns: Change$"
+        ):
+            schemas.match(
+                ["UTC_Time", "Coin", "Operation"], models.IntegrationType.BINANCE_CSV
+            )
+        with self.assertRaises(schemas.UnknownLayout):
+            schemas.match(
+                ["UTC_Time", "Coin", "Operation", "Change", "Coin"],
+                models.IntegrationType.BINANCE_CSV,
+            )
+
+
 class TestDegiroTransactionImportView(testing_utils.ViewTestBase, TestCase):
     URL = "/api/integrations/degiro/transactions/"
     VIEW_NAME = "degiro-transaction-upload-list"
@@ -302,6 +481,121 @@ class TestDegiroTransactionImportView(testing_utils.ViewTestBase, TestCase):
         response = self.client.get(f"/api/transaction-imports/{transaction_import_id}/")
         self.assertEqual(response.status_code, 200)
 
+    @override_settings(SYNCHRONOUS_IMPORT_MAX_SIZE=0)
+    @patch("finance.tasks.run_import")
+    @patch("finance.stock_exchanges.query_asset")
+    def test_large_upload_is_queued(self, query_asset_mock, run_import_mock):
+        query_asset_mock.side_effect = _assets_with_isin_side_effect
+        with self.captureOnCommitCallbacks(execute=True):
+            with open("./finance/transactions_example_latest.csv", "rb") as fp:
+                response = self.client.post(
+                    self.URL, {"account": self.account.id, "transaction_file": fp}
+                )
+        self.assertEqual(response.status_code, 202)
+        data = response.json()
+        self.assertEqual(data["status"], models.ImportStatus.QUEUED.label)
+        self.assertEqual(models.Transaction.objects.count(), 0)
+        run_import_mock.delay.assert_called_once_with(data["id"])
+
+        imports.run(data["id"])
+        # Imports which aren't queued any more aren't run again.
+        imports.run(data["id"])
+        self.assertEqual(models.Transaction.objects.count(), 6)
+        response = self.client.get(response["Location"])
+        data = response.json()
+        self.assertEqual(data["status"], models.ImportStatus.SUCCESS.label)
+        # A step for every row written and every asset looked up.
+        self.assertEqual(data["steps_total"], 6 + query_asset_mock.call_count)
+        self.assertEqual(data["steps_done"], data["steps_total"])
+        self.assertEqual(len(data["records"]), 6)
+        self.assertIsNone(models.TransactionImport.objects.get().upload)
+
+    @override_settings(SYNCHRONOUS_IMPORT_MAX_SIZE=0)
+    @patch("finance.tasks.run_import")
+    @patch("finance.stock_exchanges.query_asset")
+    def test_progress_of_running_import(self, query_asset_mock, run_import_mock):
+        progress = []
+
+        def query_asset(isin):
+            # As read by a client polling the import while it's running,
+            # lookups run in other threads, which don't see the test's data.
+            progress.append(
+                models.TransactionImport(
+                    pk=import_id, status=models.ImportStatus.RUNNING
+                ).progress()
+            )
+            return _assets_with_isin_side_effect(isin)
+
+        query_asset_mock.side_effect = query_asset
+        with open("./finance/transactions_example_latest.csv", "rb") as fp:
+            response = self.client.post(
+                self.URL, {"account": self.account.id, "transaction_file": fp}
+            )
+        import_id = response.json()["id"]
+        imports.run(import_id)
+
+        lookups = query_asset_mock.call_count
+        self.assertEqual(len(progress), lookups)
+        # Lookups run concurrently, the progress is stored after each one.
+        self.assertTrue(all(total == 6 + lookups for _, total in progress))
+        self.assertTrue(all(done < lookups for done, _ in progress))
+
+    @override_settings(SYNCHRONOUS_IMPORT_MAX_SIZE=0)
+    @patch("finance.tasks.run_import")
+    @patch("finance.stock_exchanges.query_asset")
+    def test_stale_running_import_is_run_again(
+        self, query_asset_mock, run_import_mock
+    ):
+        query_asset_mock.side_effect = _assets_with_isin_side_effect
+        with open("./finance/transactions_example_latest.csv", "rb") as fp:
+            response = self.client.post(
+                self.URL, {"account": self.account.id, "transaction_file": fp}
+            )
+        # As if a worker crashed while running the import.
+        transaction_import = models.TransactionImport.objects.get()
+        transaction_import.status = models.ImportStatus.RUNNING
+        transaction_import.started_at = timezone.now()
+        transaction_import.save()
+
+        imports.run(transaction_import.pk)
+        self.assertEqual(models.Transaction.objects.count(), 0)
+
+        transaction_import.started_at -= models.IMPORT_TIMEOUT
+        transaction_import.save()
+        imports.run(transaction_import.pk)
+        self.assertEqual(models.Transaction.objects.count(), 6)
+        transaction_import.refresh_from_db()
+        self.assertEqual(transaction_import.status, models.ImportStatus.SUCCESS)
+
+    @patch("finance.tasks.run_import")
+    def test_stale_imports_are_queued_again(self, run_import_mock):
+        now = timezone.now()
+        stale_ids = []
+        for status, started_at, stale in (
+            (models.ImportStatus.QUEUED, None, False),
+            (models.ImportStatus.QUEUED, None, True),
+            (models.ImportStatus.RUNNING, now, False),
+            (models.ImportStatus.RUNNING, now - models.IMPORT_TIMEOUT, True),
+            (models.ImportStatus.SUCCESS, now - models.IMPORT_TIMEOUT, False),
+        ):
+            transaction_import = models.TransactionImport.objects.create(
+                account=self.account,
+                integration=models.IntegrationType.DEGIRO,
+                status=status,
+                started_at=started_at,
+            )
+            if stale:
+                models.TransactionImport.objects.filter(
+                    pk=transaction_import.pk
+                ).update(created_at=now - models.IMPORT_TIMEOUT)
+                stale_ids.append(transaction_import.pk)
+
+        self.assertEqual(imports.requeue_stale(), 2)
+        self.assertCountEqual(
+            [call.args[0] for call in run_import_mock.delay.call_args_list],
+            stale_ids,
+        )
+
     def test_can_upload_to_owned_account_currency_mismatch(self):
         another_account = models.Account.objects.create(
             user=self.user,
@@ -729,6 +1023,42 @@ class TestBinanceParser(TestCase):
         self.assertEqual(models.TransactionImport.objects.count(), 2)
         self.assertEqual(transaction_import.event_records.count(), 9)
 
+    @patch("finance.prices.get_crypto_usd_price_at_date")
+    @patch("finance.prices.are_crypto_prices_available")
+    def test_prices_fetched_before_writing(self, mock, crypto_price_mock):
+        mock.return_value = False
+        crypto_price_mock.return_value = decimal.Decimal("100")
+        account = models.Account.objects.create(
+            user=User.objects.all()[0], nickname="test"
+        )
+        _add_dummy_exchange_rates()
+
+        write_import = binance_parser._write_import
+        calls_before_writing = []
+
+        def write_after_fetching(*args):
+            calls_before_writing.append(
+                (mock.call_count, crypto_price_mock.call_count)
+            )
+            return write_import(*args)
+
+        with patch.object(
+            binance_parser, "_write_import", side_effect=write_after_fetching
+        ):
+            binance_parser.import_transactions_from_file(
+                account, "./finance/binance_transaction_sample_with_income.csv"
+            )
+        # Nothing was looked up while writing, and each price only once.
+        self.assertEqual(
+            calls_before_writing, [(mock.call_count, crypto_price_mock.call_count)]
+        )
+        prices_looked_up = [
+            call.args + (call.kwargs["date"],)
+            for call in crypto_price_mock.call_args_list
+        ]
+        self.assertEqual(len(prices_looked_up), len(set(prices_looked_up)))
+        self.assertEqual(account.events.count(), 9)
+
     @patch("finance.prices.get_crypto_usd_price_at_date")
     @patch("finance.prices.are_crypto_prices_available")
     def test_importing_with_income_and_deleting_import(self, mock, crypto_price_mock):
@@ -762,12 +1092,14 @@ class TestBinanceParser(TestCase):
 
         self.assertEqual(models.TransactionImportRecord.objects.count(), 2)
         account_repository = accounts.AccountRepository(
-            recompute_lots=False,
             batch_related_changes=True,
+            defer_lots=True,
         )
 
         # TODO: bring it down to something like 6.
-        with self.assertNumQueries(22):
+        # 2 of them to check quantities and queue lots of all positions,
+        # 6 to reverse cash entries and sync the balance, 1 to lock the account.
+        with self.assertNumQueries(31):
             account_repository.delete_transaction_import(first_import)
             account_repository.update_lots()
         self.assertEqual(models.Transaction.objects.count(), 0)
@@ -974,6 +1306,24 @@ class TestBinanceTransactionImportView(testing_utils.ViewTestBase, TestCase):
         response = self.client.get(f"/api/transaction-imports/{transaction_import_id}/")
         self.assertEqual(response.status_code, 200)
 
+    @override_settings(SYNCHRONOUS_IMPORT_MAX_SIZE=0)
+    @patch("finance.tasks.run_import")
+    def test_queued_bad_file_fails_import(self, run_import_mock):
+        with open("./finance/transactions_example_latest.csv", "rb") as fp:
+            response = self.client.post(
+                self.URL, {"account": self.account.id, "transaction_file": fp}
+            )
+        self.assertEqual(response.status_code, 202)
+
+        imports.run(response.json()["id"])
+        data = self.client.get(response["Location"]).json()
+        self.assertEqual(data["status"], models.ImportStatus.FAILURE.label)
+        self.assertTrue(
+            data["raw_issue"].startswith(
+                "Columns of the csv file don't match a known Binance export"
+            )
+        )
+
     @patch("finance.prices.get_crypto_usd_price_at_date")
     @patch("finance.prices.are_crypto_prices_available")
     def test_bad_files_return_errors(self, mock, crypto_price_mock):
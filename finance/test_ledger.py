@@ -0,0 +1,134 @@
+import datetime
+import decimal
+from unittest.mock import patch
+
+from django.contrib.auth.models import User
+from django.test import TestCase
+
+from finance import accounts, ledger, models
+
+
+class TestLedger(TestCase):
+    def setUp(self):
+        super().setUp()
+        self.user = User.objects.create(username="testuser", email="test@example.com")
+        self.account = models.Account.objects.create(
+            user=self.user, currency=models.Currency.EUR, nickname="test account"
+        )
+        exchange = models.Exchange.objects.create(name="USA stocks", country="USA")
+        self.asset = models.Asset.objects.create(
+            isin="US1234",
+            symbol="MOONIES",
+            name="a stock",
+            currency=models.Currency.USD,
+            exchange=exchange,
+            tracked=True,
+        )
+        self.repository = accounts.AccountRepository()
+
+    def _add_transaction(self, executed_at, quantity, total):
+        return self.repository.add_transaction_known_asset(
+            self.account,
+            self.asset.pk,
+            datetime.datetime.strptime(executed_at, "%Y-%m-%d %H:%M%z"),
+            quantity,
+            decimal.Decimal(10),
+            decimal.Decimal(0),
+            decimal.Decimal(total),
+            decimal.Decimal(total),
+            decimal.Decimal(total),
+        )
+
+    def _deposit(self, executed_at, amount):
+        event, _ = self.repository.add_event(
+            self.account,
+            decimal.Decimal(amount),
+            datetime.datetime.strptime(executed_at, "%Y-%m-%d %H:%M%z"),
+            models.EventType.DEPOSIT,
+        )
+        return event
+
+    def _history(self, from_date, to_date):
+        return ledger.balance_history(
+            self.account,
+            datetime.date.fromisoformat(from_date),
+            datetime.date.fromisoformat(to_date),
+        )
+
+    def _checkpoints(self):
+        return [
+            (checkpoint.executed_at.day, checkpoint.balance)
+            for checkpoint in self.account.cash_checkpoints.order_by("executed_at")
+        ]
+
+    def test_balance_follows_entries(self):
+        deposit = self._deposit("2021-03-01 10:00Z", 1000)
+        first = self._add_transaction("2021-03-02 10:00Z", 2, -200)
+        self._add_transaction("2021-03-04 10:00Z", 1, -150)
+        self.assertEqual(self.account.balance, 650)
+
+        self.repository.correct_transaction(
+            first,
+            {
+                "executed_at": datetime.datetime(
+                    2021, 3, 3, 10, tzinfo=datetime.timezone.utc
+                ),
+                "total_in_account_currency": decimal.Decimal(-250),
+            },
+        )
+        self.account.refresh_from_db()
+        self.assertEqual(self.account.balance, 600)
+        self.assertEqual(
+            self._history("2021-03-01", "2021-03-04"),
+            [
+                (datetime.date(2021, 3, 4), 600),
+                (datetime.date(2021, 3, 3), 750),
+                (datetime.date(2021, 3, 2), 1000),
+                (datetime.date(2021, 3, 1), 1000),
+            ],
+        )
+
+        self.repository.delete_event(deposit)
+        self.account.refresh_from_db()
+        self.assertEqual(self.account.balance, -400)
+        self.assertEqual(ledger.balance(self.account), -400)
+        # Nothing recorded was changed, reversing entries were added.
+        self.assertEqual(models.CashEntry.objects.count(), 6)
+        self.assertEqual(
+            self._history("2021-03-01", "2021-03-02"),
+            [(datetime.date(2021, 3, 2), 0), (datetime.date(2021, 3, 1), 0)],
+        )
+
+    @patch.object(ledger, "CHECKPOINT_INTERVAL", 2)
+    def test_history_from_checkpoints(self):
+        for day in range(1, 6):
+            self._deposit(f"2021-03-0{day} 10:00Z", 100 * day)
+        self.assertEqual(self._checkpoints(), [(2, 300), (4, 1000)])
+        expected = [
+            (datetime.date(2021, 3, 5), 1500),
+            (datetime.date(2021, 3, 4), 1000),
+            (datetime.date(2021, 3, 3), 600),
+        ]
+        self.assertEqual(self._history("2021-03-03", "2021-03-05"), expected)
+
+        # Checkpoints after a backdated entry are no longer right, a new one
+        # is added for the entries since the remaining one.
+        self._deposit("2021-03-03 12:00Z", 50)
+        self.assertEqual(self._checkpoints(), [(2, 300), (5, 1550)])
+        self.assertEqual(self.account.balance, 1550)
+        self.assertEqual(
+            self._history("2021-03-03", "2021-03-05"),
+            [(date, balance + 50) for date, balance in expected],
+        )
+
+    def test_batch_syncs_balance_once(self):
+        self.repository = accounts.AccountRepository(batch_related_changes=True)
+        for day in range(1, 4):
+            self._deposit(f"2021-03-0{day} 10:00Z", 100)
+        self.account.refresh_from_db()
+        self.assertEqual(self.account.balance, 0)
+
+        with self.assertNumQueries(3):
+            self.repository.sync_balances()
+        self.account.refresh_from_db()
+        self.assertEqual(self.account.balance, 300)
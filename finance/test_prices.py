@@ -1,8 +1,9 @@
 import datetime
 import decimal
+from django.core.cache import cache
 from django.test import TestCase
 
-from finance import prices
+from finance import exchange_rates, prices
 from finance import models
 from finance import utils
 
@@ -48,7 +49,7 @@ class TestPrices(TestCase):
 
     def test_exchange_rate_present(self):
 
-        rate = prices.get_closest_exchange_rate(
+        rate = exchange_rates.get_closest(
             date=datetime.date.fromisoformat("2021-04-03"),
             from_currency=self.from_currency,
             to_currency=self.to_currency,
@@ -59,7 +60,7 @@ class TestPrices(TestCase):
         self.assertEqual(rate.value, decimal.Decimal("1.1"))
 
     def test_exchange_rate_sparse_range(self):
-        rate = prices.get_closest_exchange_rate(
+        rate = exchange_rates.get_closest(
             date=datetime.date.fromisoformat("2020-04-03"),
             from_currency=self.from_currency,
             to_currency=self.to_currency,
@@ -72,7 +73,7 @@ class TestPrices(TestCase):
 
 
     def test_exchange_too_early(self):
-        rate = prices.get_closest_exchange_rate(
+        rate = exchange_rates.get_closest(
             date=datetime.date.fromisoformat("2000-04-03"),
             from_currency=self.from_currency,
             to_currency=self.to_currency,
@@ -84,7 +85,7 @@ class TestPrices(TestCase):
         self.assertEqual(rate.value, decimal.Decimal("1.8"))
 
     def test_exchange_too_late(self):
-        rate = prices.get_closest_exchange_rate(
+        rate = exchange_rates.get_closest(
             date=datetime.date.fromisoformat("2021-11-03"),
             from_currency=self.from_currency,
             to_currency=self.to_currency,
@@ -100,4 +101,61 @@ class TestPrices(TestCase):
         self.assertEqual(len(symbol_to_currencies), 6)
 
         all_symbol_to_currencies = prices.generate_symbol_to_currency_pairs(prices.currencies)
-        self.assertEqual(len(all_symbol_to_currencies), len(prices.currencies) * (len(prices.currencies) - 1))
\ No newline at end of file
+        self.assertEqual(len(all_symbol_to_currencies), len(prices.currencies) * (len(prices.currencies) - 1))
+
+class TestLatestQuotes(TestCase):
+    def setUp(self):
+        super().setUp()
+        cache.clear()
+        exchange = models.Exchange.objects.create(name="USA stocks", country="USA")
+        self.asset = models.Asset.objects.create(
+            isin="US1234",
+            symbol="MOONIES",
+            name="a stock",
+            currency=models.Currency.USD,
+            exchange=exchange,
+        )
+
+    def test_latest_quote(self):
+        prices.update_latest_quote(self.asset.pk)
+        self.assertFalse(models.LatestQuote.objects.exists())
+
+        for date, value in (
+            ("2021-03-02", 11),
+            ("2021-03-04", 13),
+            ("2021-03-03", 12),
+        ):
+            models.PriceHistory.objects.create(
+                asset=self.asset, date=date, value=value
+            )
+            prices.update_latest_quote(self.asset.pk)
+        quote = models.Asset.objects.get(pk=self.asset.pk).latest_quote
+        self.assertEqual(quote.date, datetime.date(2021, 3, 4))
+        self.assertEqual(quote.value, 13)
+
+    def test_latest_exchange_rates_include_derived_pairs(self):
+        for from_currency, date, value in (
+            (models.Currency.GBP, "2021-03-01", "1.3"),
+            (models.Currency.GBP, "2021-03-02", "1.4"),
+            (models.Currency.PLN, "2021-03-01", "0.25"),
+        ):
+            models.CurrencyExchangeRate.objects.create(
+                from_currency=from_currency,
+                to_currency=models.Currency.USD,
+                date=date,
+                value=decimal.Decimal(value),
+            )
+        prices.update_latest_exchange_rates()
+
+        rates = {
+            (rate.from_currency, rate.to_currency): rate
+            for rate in models.LatestExchangeRate.objects.all()
+        }
+        self.assertEqual(len(rates), 6)
+        self.assertEqual(
+            rates[(models.Currency.GBP, models.Currency.USD)].value,
+            decimal.Decimal("1.4"),
+        )
+        rate = rates[(models.Currency.GBP, models.Currency.PLN)]
+        self.assertEqual(rate.date, datetime.date(2021, 3, 2))
+        self.assertEqual(rate.value, decimal.Decimal("5.6"))
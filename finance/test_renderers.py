@@ -0,0 +1,79 @@
+import datetime
+import decimal
+
+from django.test import SimpleTestCase
+
+from finance import renderers
+
+
+def _history(*points):
+    return [
+        (datetime.date.fromisoformat(date), decimal.Decimal(value))
+        for date, value in points
+    ]
+
+
+class TestColumnarHistory(SimpleTestCase):
+    def test_evenly_spaced(self):
+        history = _history(
+            ("2021-03-03", "3.5"), ("2021-03-02", "2"), ("2021-03-01", "1")
+        )
+        self.assertEqual(
+            renderers.columnar_history(history),
+            {
+                "start": datetime.date(2021, 3, 3),
+                "period": -1,
+                "delta": False,
+                "values": [3.5, 2.0, 1.0],
+            },
+        )
+
+    def test_unevenly_spaced(self):
+        history = _history(
+            ("2021-03-10", "3"), ("2021-03-03", "2"), ("2021-03-01", "1")
+        )
+        columns = renderers.columnar_history(history)
+        self.assertIsNone(columns["period"])
+        self.assertEqual(columns["offsets"], [0, -7, -9])
+
+    def test_delta(self):
+        history = _history(
+            ("2021-03-03", "3.5"), ("2021-03-02", "2"), ("2021-03-01", "1")
+        )
+        columns = renderers.columnar_history(history, delta=True)
+        self.assertTrue(columns["delta"])
+        self.assertEqual(columns["scale"], 4)
+        self.assertEqual(columns["values"], [35000, -15000, -10000])
+
+    def test_delta_decodes_exactly(self):
+        values = [0.1, 0.2, 0.3, 1234567.8912, 0.7, 1e-05, 0.0]
+        history = [
+            (datetime.date(2021, 3, 10) - datetime.timedelta(days=i), value)
+            for i, value in enumerate(values)
+        ]
+        columns = renderers.columnar_history(history, delta=True)
+        decoded = []
+        total = 0
+        for change in columns["values"]:
+            self.assertIsInstance(change, int)
+            total += change
+            decoded.append(decimal.Decimal(total).scaleb(-columns["scale"]))
+        self.assertEqual(
+            decoded,
+            [
+                decimal.Decimal(str(value)).quantize(decimal.Decimal("0.0001"))
+                for value in values
+            ],
+        )
+
+    def test_empty(self):
+        self.assertEqual(
+            renderers.columnar_history([]),
+            {
+                "start": None,
+                "period": None,
+                "offsets": [],
+                "delta": False,
+                "values": [],
+            },
+        )
@@ -0,0 +1,227 @@
+import datetime
+import decimal
+import random
+from unittest.mock import patch
+
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.test import TestCase
+
+from finance import accounts, models, snapshots, valuation
+from finance.test_valuation import populate_random_history
+
+
+FROM_DATE = datetime.date.fromisoformat("2021-01-01")
+TO_DATE = datetime.date.fromisoformat("2021-04-30")
+
+
+@patch.object(snapshots, "horizon", lambda: TO_DATE)
+class TestSnapshots(TestCase):
+    def setUp(self):
+        super().setUp()
+        cache.clear()
+        self.user = User.objects.create(username="testuser", email="test@example.com")
+        self.account = models.Account.objects.create(
+            user=self.user, currency=models.Currency.EUR, nickname="test account"
+        )
+        exchange = models.Exchange.objects.create(name="USA stocks", country="USA")
+        self.asset = models.Asset.objects.create(
+            isin="US1234",
+            symbol="MOONIES",
+            name="a stock",
+            currency=models.Currency.USD,
+            exchange=exchange,
+            tracked=True,
+        )
+        self.position = models.Position.objects.create(
+            account=self.account, asset=self.asset
+        )
+        self.repository = accounts.AccountRepository()
+
+    def _assert_same_as_live(self, from_date, to_date):
+        series = snapshots.read(self.position.pk, from_date, to_date)
+        self.assertIsNotNone(series)
+        live = valuation.position_series(
+            self.position, from_date, to_date, in_account_currency=True
+        )
+        for method in (
+            "quantity_history",
+            "value_history",
+            "value_history_in_account_currency",
+        ):
+            self.assertEqual(
+                getattr(series, method)(), getattr(live, method)(), method
+            )
+
+    def _add_transaction(self, executed_at, quantity):
+        return self.repository.add_transaction_known_asset(
+            self.account,
+            self.asset.pk,
+            datetime.datetime.strptime(executed_at, "%Y-%m-%d %H:%M%z"),
+            decimal.Decimal(quantity),
+            decimal.Decimal("12.5"),
+            decimal.Decimal(0),
+            decimal.Decimal(0),
+            decimal.Decimal(0),
+            decimal.Decimal(0),
+        )
+
+    def test_same_as_live_computation(self):
+        rng = random.Random(4321)
+        for scenario in range(10):
+            populate_random_history(rng, self.position, FROM_DATE, TO_DATE)
+            models.PositionDailySnapshot.objects.all().delete()
+            snapshots.extend(self.position)
+            last_executed_at = self.position.transactions.values_list(
+                "executed_at", flat=True
+            ).first()
+            for _ in range(5):
+                from_date = FROM_DATE + datetime.timedelta(days=rng.randint(-10, 60))
+                to_date = from_date + datetime.timedelta(days=rng.randint(0, 60))
+                # Live computation doesn't support ranges ending before the
+                # last transaction.
+                if last_executed_at:
+                    to_date = max(to_date, last_executed_at.date())
+                with self.subTest(
+                    scenario=scenario, from_date=from_date, to_date=to_date
+                ):
+                    self._assert_same_as_live(from_date, to_date)
+
+    def test_same_as_live_computation_same_currency(self):
+        self.asset.currency = models.Currency.EUR
+        self.asset.save()
+        rng = random.Random(24)
+        for scenario in range(3):
+            populate_random_history(rng, self.position, FROM_DATE, TO_DATE)
+            models.PositionDailySnapshot.objects.all().delete()
+            snapshots.extend(self.position)
+            with self.subTest(scenario=scenario):
+                self._assert_same_as_live(FROM_DATE, TO_DATE)
+
+    def test_starts_with_first_transaction_or_history_start(self):
+        self._add_transaction("2019-06-03 10:00Z", 3)
+        snapshots.extend(self.position)
+        self.assertEqual(
+            self.position.daily_snapshots.order_by("date").first().date,
+            datetime.date(2019, 6, 3),
+        )
+        self.assertEqual(self.position.daily_snapshots.first().date, TO_DATE)
+
+    def test_not_fresh_when_range_not_covered(self):
+        snapshots.extend(self.position)
+        self.assertIsNotNone(snapshots.read(self.position.pk, FROM_DATE, TO_DATE))
+        self.assertIsNone(
+            snapshots.read(
+                self.position.pk, FROM_DATE, TO_DATE + datetime.timedelta(days=1)
+            )
+        )
+        self.assertIsNone(
+            snapshots.read(
+                self.position.pk, FROM_DATE, TO_DATE, datetime.timedelta(days=7)
+            )
+        )
+
+    def test_transaction_writes_truncate_from_affected_date(self):
+        snapshots.extend(self.position)
+        transaction = self._add_transaction("2021-03-10 10:00Z", 3)
+        self.assertEqual(
+            self.position.daily_snapshots.first().date, datetime.date(2021, 3, 9)
+        )
+
+        snapshots.extend(self.position)
+        self.repository.correct_transaction(
+            transaction,
+            {"executed_at": datetime.datetime(2021, 2, 1, tzinfo=datetime.timezone.utc)},
+        )
+        self.assertEqual(
+            self.position.daily_snapshots.first().date, datetime.date(2021, 1, 31)
+        )
+
+        snapshots.extend(self.position)
+        self.repository.delete_transaction(transaction)
+        self.assertEqual(
+            self.position.daily_snapshots.first().date, datetime.date(2021, 1, 31)
+        )
+        snapshots.extend(self.position)
+        self._assert_same_as_live(FROM_DATE, TO_DATE)
+
+    def test_new_prices_and_rates_truncate_snapshots(self):
+        snapshots.extend(self.position)
+        snapshots.invalidate_asset(self.asset.pk, datetime.date(2021, 4, 1))
+        self.assertEqual(
+            self.position.daily_snapshots.first().date, datetime.date(2021, 3, 31)
+        )
+        snapshots.invalidate_exchange_rate(
+            models.Currency.GBP, models.Currency.EUR, datetime.date(2021, 3, 1)
+        )
+        self.assertEqual(
+            self.position.daily_snapshots.first().date, datetime.date(2021, 3, 31)
+        )
+        snapshots.invalidate_exchange_rate(
+            models.Currency.USD, models.Currency.EUR, datetime.date(2021, 3, 1)
+        )
+        self.assertEqual(
+            self.position.daily_snapshots.first().date, datetime.date(2021, 2, 28)
+        )
+
+    def test_rates_truncate_snapshots_of_derived_pairs(self):
+        gbp_asset = models.Asset.objects.create(
+            isin="GB1234",
+            symbol="QUIDS",
+            name="another stock",
+            currency=models.Currency.GBP,
+            exchange=self.asset.exchange,
+            tracked=True,
+        )
+        gbp_position = models.Position.objects.create(
+            account=self.account, asset=gbp_asset
+        )
+        snapshots.extend(self.position)
+        snapshots.extend(gbp_position)
+
+        # GBP to EUR is triangulated through USD if it isn't recorded.
+        snapshots.invalidate_exchange_rate(
+            models.Currency.USD, models.Currency.GBP, datetime.date(2021, 3, 1)
+        )
+        self.assertEqual(
+            gbp_position.daily_snapshots.first().date, datetime.date(2021, 2, 28)
+        )
+        self.assertEqual(self.position.daily_snapshots.first().date, TO_DATE)
+
+        # USD to EUR is the inverse of EUR to USD.
+        snapshots.invalidate_exchange_rate(
+            models.Currency.EUR, models.Currency.USD, datetime.date(2021, 4, 1)
+        )
+        self.assertEqual(
+            self.position.daily_snapshots.first().date, datetime.date(2021, 3, 31)
+        )
+
+    def test_extend_appends_new_days(self):
+        snapshots.extend(self.position)
+        self.assertEqual(snapshots.extend(self.position), 0)
+        with patch.object(
+            snapshots, "horizon", lambda: TO_DATE + datetime.timedelta(days=1)
+        ):
+            self.assertEqual(snapshots.extend(self.position), 1)
+
+    def test_extend_under_the_account_lock(self):
+        stale_position = models.Position.objects.get(pk=self.position.pk)
+        self._add_transaction("2021-03-10 10:00Z", 3)
+        with patch.object(
+            accounts, "_lock_accounts", wraps=accounts._lock_accounts
+        ) as lock_mock:
+            snapshots.extend(stale_position)
+        lock_mock.assert_called_once_with([self.account.pk])
+        self.assertEqual(
+            stale_position.daily_snapshots.first().quantity, decimal.Decimal(3)
+        )
+
+    def test_histories_read_from_fresh_snapshots(self):
+        populate_random_history(random.Random(5), self.position, FROM_DATE, TO_DATE)
+        expected = self.position.value_history(FROM_DATE, TO_DATE)
+        snapshots.extend(self.position)
+        cache.clear()
+
+        position = models.Position.objects.get(pk=self.position.pk)
+        with self.assertNumQueries(1):
+            self.assertEqual(position.value_history(FROM_DATE, TO_DATE), expected)
@@ -0,0 +1,47 @@
+import datetime
+import decimal
+import json
+
+from django.test import SimpleTestCase
+
+from finance import streaming
+
+
+class TestIterJson(SimpleTestCase):
+    def test_same_as_json(self):
+        data = {
+            "id": 1,
+            "name": "zażółć",
+            "values": [(datetime.date(2021, 3, 1), decimal.Decimal("1.5"))],
+            "empty": [],
+            "nested": {"flag": True, "missing": None},
+        }
+        self.assertEqual(
+            b"".join(streaming.iter_json(data)).decode(),
+            json.dumps(
+                {
+                    "id": 1,
+                    "name": "zażółć",
+                    "values": [["2021-03-01", 1.5]],
+                    "empty": [],
+                    "nested": {"flag": True, "missing": None},
+                },
+                ensure_ascii=False,
+                separators=(",", ":"),
+            ),
+        )
+
+    def test_consumes_iterators_lazily(self):
+        produced = []
+
+        def values():
+            for i in range(1000):
+                produced.append(i)
+                yield i
+
+        chunks = streaming.iter_json({"values": values()}, chunk_size=100)
+        first = next(chunks)
+        self.assertLess(len(produced), 1000)
+        self.assertEqual(
+            json.loads(first + b"".join(chunks)), {"values": list(range(1000))}
+        )
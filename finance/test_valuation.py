@@ -0,0 +1,753 @@
+import datetime
+import decimal
+import math
+import random
+import tracemalloc
+from unittest import mock
+
+import pytz
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.test import SimpleTestCase, TestCase, override_settings
+
+from finance import accounts, exchange_rates, history_cache, models, utils, valuation
+
+
+def _reference_quantity_history(position, from_date, to_date, output_period):
+    """Implementation of Position.quantity_history from before the valuation engine."""
+    dates = utils.generate_date_intervals(
+        from_date, to_date, output_period, start_with_end=True
+    )
+
+    quantity = position.quantity
+    transactions = position.transactions.order_by("-executed_at")
+    if not transactions:
+        return [(date, quantity) for date in dates]
+
+    dates_with_quantities = []
+    if transactions[0].executed_at.date() > to_date:
+        raise ValueError("history ending before last transaction not supported")
+
+    last_relevant_transaction = 0
+    for date in dates:
+        relevant_transactions = transactions[last_relevant_transaction:]
+        for transaction in relevant_transactions:
+            if transaction.executed_at.date() < date:
+                break
+            else:
+                last_relevant_transaction += 1
+                quantity -= transaction.quantity
+        dates_with_quantities.append((date, quantity))
+
+    return dates_with_quantities
+
+
+def _reference_value_history(position, from_date, to_date, output_period):
+    """Implementation of Position.value_history from before the valuation engine."""
+    quantity_history = _reference_quantity_history(
+        position, from_date, to_date, output_period
+    )
+
+    prices = position.asset.pricehistory_set.order_by("-date").filter(
+        date__gte=from_date, date__lte=to_date
+    )
+    price_tuples = [(price.date, price.value) for price in prices]
+
+    def to_datetime(date):
+        dt = datetime.datetime.fromisoformat(date.isoformat())
+        return dt.replace(tzinfo=pytz.UTC)
+
+    transactions = position.transactions.filter(
+        executed_at__gte=to_datetime(from_date),
+        executed_at__lte=to_datetime(to_date),
+    )
+    price_tuples.extend(
+        [
+            (
+                transaction.executed_at.date() + datetime.timedelta(days=1),
+                transaction.price,
+            )
+            for transaction in transactions
+        ]
+    )
+    first_price = prices.last()
+    if isinstance(first_price, models.PriceHistory):
+        if first_price.date > from_date:
+            day_before_first_date = first_price.date - datetime.timedelta(days=1)
+            additional_dates = utils.generate_date_intervals(
+                from_date, day_before_first_date, output_period=output_period
+            )
+            price_tuples.extend(
+                [(date, decimal.Decimal("0")) for date in additional_dates]
+            )
+
+    price_tuples.sort(key=lambda x: x[0], reverse=True)
+    return models.multiply_at_matching_dates(price_tuples, quantity_history)
+
+
+def _reference_value_history_in_account_currency(
+    position, from_date, to_date, output_period
+):
+    """Implementation of Position.value_history_in_account_currency from before the valuation engine."""
+    to_currency = position.account.currency
+    from_currency = position.asset.currency
+
+    value_history = _reference_value_history(
+        position, from_date, to_date, output_period
+    )
+    if to_currency == from_currency:
+        return value_history
+
+    exchange_rate_tuples = [
+        (rate.date, rate.value)
+        for rate in models.CurrencyExchangeRate.objects.order_by("-date").filter(
+            date__gte=from_date,
+            date__lte=to_date,
+            from_currency=from_currency,
+            to_currency=to_currency,
+        )
+    ]
+
+    if len(exchange_rate_tuples) > 0 and exchange_rate_tuples[0][0] < to_date:
+        last_day = exchange_rate_tuples[0][0] + datetime.timedelta(days=1)
+        additional_dates = utils.generate_date_intervals(
+            last_day, to_date, output_period=output_period
+        )
+        exchange_rate_tuples.extend(
+            [(date, exchange_rate_tuples[0][1]) for date in additional_dates]
+        )
+    exchange_rate_tuples.sort(key=lambda x: x[0], reverse=True)
+    return models.multiply_at_matching_dates(value_history, exchange_rate_tuples)
+
+
+def populate_random_history(rng, position, from_date, to_date):
+    """Replaces transactions, prices and USD to EUR rates with random ones."""
+    models.Transaction.objects.all().delete()
+    models.PriceHistory.objects.all().delete()
+    models.CurrencyExchangeRate.objects.all().delete()
+
+    quantity = decimal.Decimal(0)
+    days = (to_date - from_date).days
+    # Some transactions happen before the history starts.
+    offsets = sorted(rng.sample(range(-30, days + 1), rng.randint(0, 25)))
+    for offset in offsets:
+        executed_at = datetime.datetime.combine(
+            from_date + datetime.timedelta(days=offset),
+            datetime.time(rng.choice([0, 9, 15, 23]), rng.randint(0, 59)),
+            tzinfo=pytz.UTC,
+        )
+        change = decimal.Decimal(rng.randint(1, 20))
+        if quantity > change and rng.random() < 0.3:
+            change = -change
+        quantity += change
+        models.Transaction.objects.create(
+            executed_at=executed_at,
+            position=position,
+            quantity=change,
+            price=decimal.Decimal(rng.randint(1000, 5000)) / 100,
+            local_value=0,
+            value_in_account_currency=0,
+            total_in_account_currency=0,
+        )
+    position.quantity = quantity
+    position.save()
+
+    first_price = rng.randint(0, days)
+    for offset in range(first_price, days + 1):
+        if rng.random() < 0.7:
+            models.PriceHistory.objects.create(
+                asset=position.asset,
+                date=from_date + datetime.timedelta(days=offset),
+                value=decimal.Decimal(rng.randint(1000, 5000)) / 100,
+            )
+
+    last_rate = rng.randint(0, days)
+    for offset in range(0, last_rate + 1):
+        if rng.random() < 0.7:
+            models.CurrencyExchangeRate.objects.create(
+                from_currency=models.Currency.USD,
+                to_currency=models.Currency.EUR,
+                date=from_date + datetime.timedelta(days=offset),
+                value=decimal.Decimal(rng.randint(80, 120)) / 100,
+            )
+
+
+class TestDateAxis(SimpleTestCase):
+    def test_dates_match_generated_intervals(self):
+        from_date = datetime.date.fromisoformat("2021-01-03")
+        to_date = datetime.date.fromisoformat("2021-03-01")
+        for days in (1, 2, 7, 30, 100):
+            period = datetime.timedelta(days=days)
+            axis = valuation.DateAxis(from_date, to_date, period)
+            self.assertEqual(
+                axis.dates, utils.generate_date_intervals(from_date, to_date, period)
+            )
+
+    def test_empty_axis(self):
+        axis = valuation.DateAxis(
+            datetime.date.fromisoformat("2021-03-02"),
+            datetime.date.fromisoformat("2021-03-01"),
+        )
+        self.assertEqual(axis.dates, [])
+
+    def test_sub_day_period_not_supported(self):
+        with self.assertRaises(ValueError):
+            valuation.DateAxis(
+                datetime.date.fromisoformat("2021-03-01"),
+                datetime.date.fromisoformat("2021-03-02"),
+                datetime.timedelta(hours=6),
+            )
+
+
+class TestDownsample(SimpleTestCase):
+    def setUp(self):
+        super().setUp()
+        to_date = datetime.date.fromisoformat("2021-03-31")
+        self.history = [
+            (to_date - datetime.timedelta(days=i), decimal.Decimal(i % 10))
+            for i in range(90)
+        ]
+
+    def test_day_keeps_history(self):
+        self.assertEqual(valuation.downsample(self.history), self.history)
+
+    def test_week_keeps_latest_point_of_every_week(self):
+        downsampled = valuation.downsample(self.history, valuation.WEEK)
+        self.assertEqual(len(downsampled), 14)
+        self.assertEqual(downsampled[0], self.history[0])
+        # 2021-03-28 is a Sunday, the end of the previous week.
+        self.assertEqual(downsampled[1][0], datetime.date.fromisoformat("2021-03-28"))
+        for (date, _), (next_date, _) in zip(downsampled, downsampled[1:]):
+            self.assertNotEqual(date.isocalendar()[:2], next_date.isocalendar()[:2])
+
+    def test_month_keeps_latest_point_of_every_month(self):
+        downsampled = valuation.downsample(self.history, valuation.MONTH)
+        self.assertEqual(
+            [date for date, _ in downsampled],
+            [
+                datetime.date.fromisoformat("2021-03-31"),
+                datetime.date.fromisoformat("2021-02-28"),
+                datetime.date.fromisoformat("2021-01-31"),
+            ],
+        )
+
+    def test_lttb_keeps_requested_number_of_points(self):
+        downsampled = valuation.downsample(self.history, valuation.LTTB, 20)
+        self.assertEqual(len(downsampled), 20)
+        self.assertEqual(downsampled[0], self.history[0])
+        self.assertEqual(downsampled[-1], self.history[-1])
+        dates = [date for date, _ in downsampled]
+        self.assertEqual(dates, sorted(dates, reverse=True))
+        for point in downsampled:
+            self.assertIn(point, self.history)
+
+    def test_lttb_keeps_spikes(self):
+        history = [
+            (date, decimal.Decimal(100) if i == 42 else value)
+            for i, (date, value) in enumerate(self.history)
+        ]
+        downsampled = valuation.downsample(history, valuation.LTTB, 10)
+        self.assertIn(history[42], downsampled)
+
+    def test_lttb_short_history_unchanged(self):
+        self.assertEqual(
+            valuation.downsample(self.history[:5], valuation.LTTB, 10),
+            self.history[:5],
+        )
+
+
+class TestValuationParity(TestCase):
+    """Compares the valuation engine with the previous implementation."""
+
+    FROM_DATE = datetime.date.fromisoformat("2021-01-01")
+    TO_DATE = datetime.date.fromisoformat("2021-06-30")
+
+    def setUp(self):
+        super().setUp()
+        self.user = User.objects.create(username="testuser", email="test@example.com")
+        self.account = models.Account.objects.create(
+            user=self.user, currency=models.Currency.EUR, nickname="test account"
+        )
+        exchange = models.Exchange.objects.create(name="USA stocks", country="USA")
+        self.asset = models.Asset.objects.create(
+            isin="US1234",
+            symbol="MOONIES",
+            name="a stock",
+            currency=models.Currency.USD,
+            exchange=exchange,
+            tracked=True,
+        )
+        self.position = models.Position.objects.create(
+            account=self.account, asset=self.asset
+        )
+
+    def _populate(self, rng):
+        populate_random_history(rng, self.position, self.FROM_DATE, self.TO_DATE)
+
+    def _assert_parity(self, from_date, to_date, output_period):
+        position = models.Position.objects.get(pk=self.position.pk)
+        for method, reference in (
+            ("quantity_history", _reference_quantity_history),
+            ("value_history", _reference_value_history),
+            (
+                "value_history_in_account_currency",
+                _reference_value_history_in_account_currency,
+            ),
+        ):
+            expected = reference(position, from_date, to_date, output_period)
+            got = getattr(valuation.position_series(
+                position,
+                from_date,
+                to_date,
+                output_period,
+                in_account_currency=True,
+            ), method)()
+            self.assertEqual(got, expected, method)
+
+    def test_parity_on_random_histories(self):
+        rng = random.Random(1234)
+        for scenario in range(15):
+            self._populate(rng)
+            for days in (1, 3, 7):
+                for from_date in (
+                    self.FROM_DATE,
+                    self.FROM_DATE + datetime.timedelta(days=40),
+                ):
+                    with self.subTest(
+                        scenario=scenario, days=days, from_date=from_date
+                    ):
+                        self._assert_parity(
+                            from_date, self.TO_DATE, datetime.timedelta(days=days)
+                        )
+
+    def test_parity_same_currency(self):
+        self.asset.currency = models.Currency.EUR
+        self.asset.save()
+        rng = random.Random(42)
+        for scenario in range(3):
+            self._populate(rng)
+            with self.subTest(scenario=scenario):
+                self._assert_parity(
+                    self.FROM_DATE, self.TO_DATE, datetime.timedelta(days=1)
+                )
+
+    def test_float_mode_within_tolerance(self):
+        """Float histories are close enough to exact ones for charts.
+
+        Every value is a sum of up to a few dozens of quantities times a
+        price and an exchange rate, each rounded to float64 with a relative
+        error of about 1e-16. A relative tolerance of 1e-9 leaves a wide
+        margin while still catching wrong or misaligned values.
+        """
+        rng = random.Random(99)
+        for scenario in range(10):
+            self._populate(rng)
+            position = models.Position.objects.get(pk=self.position.pk)
+            exact, fast = (
+                valuation.position_series(
+                    position,
+                    self.FROM_DATE,
+                    self.TO_DATE,
+                    in_account_currency=True,
+                    numeric=numeric,
+                )
+                for numeric in (valuation.DECIMAL, valuation.FLOAT)
+            )
+            for method in (
+                "quantity_history",
+                "value_history",
+                "value_history_in_account_currency",
+            ):
+                with self.subTest(scenario=scenario, method=method):
+                    expected = getattr(exact, method)()
+                    got = getattr(fast, method)()
+                    self.assertEqual(
+                        [date for date, _ in got], [date for date, _ in expected]
+                    )
+                    for (_, value), (_, expected_value) in zip(got, expected):
+                        self.assertIsInstance(value, float)
+                        self.assertTrue(
+                            math.isclose(
+                                value, expected_value, rel_tol=1e-9, abs_tol=1e-9
+                            ),
+                            f"{value} != {expected_value}",
+                        )
+
+    def test_history_ending_before_last_transaction(self):
+        self._populate(random.Random(7))
+        models.Transaction.objects.create(
+            executed_at=datetime.datetime(2021, 7, 2, tzinfo=pytz.UTC),
+            position=self.position,
+            quantity=1,
+            price=1,
+            local_value=0,
+            value_in_account_currency=0,
+            total_in_account_currency=0,
+        )
+        self.position.quantity += 1
+        self.position.save()
+        longer_history = _reference_quantity_history(
+            self.position,
+            self.FROM_DATE,
+            datetime.date(2021, 7, 3),
+            datetime.timedelta(days=1),
+        )
+        expected = [
+            (date, quantity)
+            for date, quantity in longer_history
+            if date <= self.TO_DATE
+        ]
+        self.assertEqual(
+            valuation.position_series(
+                self.position, self.FROM_DATE, self.TO_DATE
+            ).quantity_history(),
+            expected,
+        )
+        self.assertEqual(
+            valuation.quantity_histories(
+                [self.position.pk], self.FROM_DATE, self.TO_DATE
+            )[self.position.pk],
+            expected,
+        )
+
+
+class TestQuantityHistories(TestCase):
+    """Compares quantity histories computed in SQL with the previous implementation."""
+
+    FROM_DATE = datetime.date.fromisoformat("2021-01-01")
+    TO_DATE = datetime.date.fromisoformat("2021-04-30")
+
+    def setUp(self):
+        super().setUp()
+        self.user = User.objects.create(username="testuser", email="test@example.com")
+        self.account = models.Account.objects.create(
+            user=self.user, currency=models.Currency.EUR, nickname="test account"
+        )
+        exchange = models.Exchange.objects.create(name="USA stocks", country="USA")
+        self.positions = []
+        for i in range(3):
+            asset = models.Asset.objects.create(
+                isin=f"US{i}",
+                symbol=f"S{i}",
+                name="a stock",
+                currency=models.Currency.USD,
+                exchange=exchange,
+            )
+            self.positions.append(
+                models.Position.objects.create(account=self.account, asset=asset)
+            )
+
+    def _populate(self, rng):
+        models.Transaction.objects.all().delete()
+        days = (self.TO_DATE - self.FROM_DATE).days
+        for position in self.positions:
+            quantity = decimal.Decimal(0)
+            offsets = sorted(rng.sample(range(-30, days + 1), rng.randint(0, 25)))
+            for offset in offsets:
+                change = decimal.Decimal(rng.randint(1, 2000)) / 100
+                if quantity > change and rng.random() < 0.3:
+                    change = -change
+                quantity += change
+                models.Transaction.objects.create(
+                    executed_at=datetime.datetime.combine(
+                        self.FROM_DATE + datetime.timedelta(days=offset),
+                        datetime.time(rng.choice([0, 9, 23]), rng.randint(0, 59)),
+                        tzinfo=pytz.UTC,
+                    ),
+                    position=position,
+                    quantity=change,
+                    price=1,
+                    local_value=0,
+                    value_in_account_currency=0,
+                    total_in_account_currency=0,
+                )
+            position.quantity = quantity
+            position.save()
+
+    def test_parity_on_random_histories(self):
+        rng = random.Random(555)
+        position_ids = [position.pk for position in self.positions]
+        for scenario in range(5):
+            self._populate(rng)
+            for days in (1, 3, 7):
+                for from_date in (
+                    self.FROM_DATE,
+                    self.FROM_DATE + datetime.timedelta(days=40),
+                ):
+                    output_period = datetime.timedelta(days=days)
+                    with self.subTest(
+                        scenario=scenario, days=days, from_date=from_date
+                    ):
+                        with self.assertNumQueries(1):
+                            histories = valuation.quantity_histories(
+                                position_ids, from_date, self.TO_DATE, output_period
+                            )
+                        for position in self.positions:
+                            self.assertEqual(
+                                histories[position.pk],
+                                _reference_quantity_history(
+                                    position, from_date, self.TO_DATE, output_period
+                                ),
+                            )
+
+    def test_ending_before_last_transaction(self):
+        self._populate(random.Random(8))
+        position_ids = [position.pk for position in self.positions]
+        to_date = self.TO_DATE - datetime.timedelta(days=45)
+        histories = valuation.quantity_histories(position_ids, self.FROM_DATE, to_date)
+        for position in self.positions:
+            self.assertEqual(
+                histories[position.pk],
+                valuation.position_series(
+                    position, self.FROM_DATE, to_date, with_prices=False
+                ).quantity_history(),
+            )
+
+    def test_empty_range(self):
+        self.assertEqual(
+            valuation.quantity_histories(
+                [self.positions[0].pk], self.TO_DATE, self.FROM_DATE
+            ),
+            {self.positions[0].pk: []},
+        )
+
+
+class TestAccountSeries(TestCase):
+    FROM_DATE = datetime.date.fromisoformat("2021-01-01")
+    TO_DATE = datetime.date.fromisoformat("2021-03-31")
+
+    def setUp(self):
+        super().setUp()
+        self.user = User.objects.create(username="testuser", email="test@example.com")
+        self.account = models.Account.objects.create(
+            user=self.user, currency=models.Currency.EUR, nickname="test account"
+        )
+        self.exchange = models.Exchange.objects.create(name="USA stocks", country="USA")
+        self.rng = random.Random(99)
+        for currency in (models.Currency.USD, models.Currency.GBP):
+            dates = utils.generate_date_intervals(self.FROM_DATE, self.TO_DATE)
+            for date in dates[5:]:
+                models.CurrencyExchangeRate.objects.create(
+                    from_currency=currency,
+                    to_currency=models.Currency.EUR,
+                    date=date,
+                    value=decimal.Decimal(self.rng.randint(80, 120)) / 100,
+                )
+
+    def _add_position(self, i):
+        currency = [models.Currency.USD, models.Currency.GBP, models.Currency.EUR][
+            i % 3
+        ]
+        asset = models.Asset.objects.create(
+            isin=f"US{i}",
+            symbol=f"S{i}",
+            name="a stock",
+            currency=currency,
+            exchange=self.exchange,
+        )
+        position = models.Position.objects.create(account=self.account, asset=asset)
+        quantity = decimal.Decimal(0)
+        for day in sorted(self.rng.sample(range(0, 80), 5)):
+            change = decimal.Decimal(self.rng.randint(1, 10))
+            quantity += change
+            models.Transaction.objects.create(
+                executed_at=datetime.datetime.combine(
+                    self.FROM_DATE + datetime.timedelta(days=day),
+                    datetime.time(12),
+                    tzinfo=pytz.UTC,
+                ),
+                position=position,
+                quantity=change,
+                price=decimal.Decimal(self.rng.randint(1000, 5000)) / 100,
+                local_value=0,
+                value_in_account_currency=0,
+                total_in_account_currency=0,
+            )
+        position.quantity = quantity
+        position.save()
+        for date in utils.generate_date_intervals(
+            self.FROM_DATE + datetime.timedelta(days=10), self.TO_DATE
+        ):
+            if self.rng.random() < 0.8:
+                models.PriceHistory.objects.create(
+                    asset=asset,
+                    date=date,
+                    value=decimal.Decimal(self.rng.randint(1000, 5000)) / 100,
+                )
+
+    def _value_history_per_position(self):
+        return list(
+            self.account.value_history_per_position(self.FROM_DATE, self.TO_DATE)
+        )
+
+    def test_same_as_per_position_history(self):
+        for i in range(6):
+            self._add_position(i)
+
+        got = self._value_history_per_position()
+        expected = [
+            (
+                position.pk,
+                valuation.position_series(
+                    position, self.FROM_DATE, self.TO_DATE, in_account_currency=True
+                ).value_history_in_account_currency(),
+            )
+            for position in self.account.positions.order_by("pk")
+        ]
+        self.assertEqual(got, expected)
+        self.assertEqual(len(got), 6)
+        for _, history in got:
+            self.assertTrue(history)
+
+    def test_query_count_independent_of_positions_count(self):
+        # Exchange rates are looked up in memory once they are loaded.
+        exchange_rates.get_all_latest()
+        for i in range(2):
+            self._add_position(i)
+        with self.assertNumQueries(5):
+            self._value_history_per_position()
+
+        for i in range(2, 12):
+            self._add_position(i)
+        with self.assertNumQueries(5):
+            self._value_history_per_position()
+
+    def test_empty_account(self):
+        with self.assertNumQueries(1):
+            self.assertEqual(self._value_history_per_position(), [])
+
+    @mock.patch.object(models, "VALUATION_CHUNK_SIZE", 2)
+    def test_values_positions_a_chunk_at_a_time(self):
+        for i in range(5):
+            self._add_position(i)
+        exchange_rates.get_all_latest()
+
+        histories = self.account.value_history_per_position(
+            self.FROM_DATE, self.TO_DATE
+        )
+        # Only the first chunk is loaded and valued before it's consumed.
+        with self.assertNumQueries(5):
+            first = next(histories)
+        with self.assertNumQueries(0):
+            second = next(histories)
+        self.assertEqual(
+            [first, second] + list(histories), self._value_history_per_position()
+        )
+
+    def _peak_memory_of_values(self):
+        tracemalloc.start()
+        try:
+            for _ in self.account.value_history_per_position(
+                self.FROM_DATE, self.TO_DATE
+            ):
+                pass
+            return tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+
+    # Cached histories would be held in memory by the local memory cache.
+    @override_settings(
+        CACHES={"default": {"BACKEND": "django.core.cache.backends.dummy.DummyCache"}}
+    )
+    @mock.patch.object(models, "VALUATION_CHUNK_SIZE", 2)
+    def test_memory_independent_of_positions_count(self):
+        for i in range(2):
+            self._add_position(i)
+        exchange_rates.get_all_latest()
+        self._peak_memory_of_values()
+        few_positions_peak = self._peak_memory_of_values()
+
+        for i in range(2, 20):
+            self._add_position(i)
+        many_positions_peak = self._peak_memory_of_values()
+        self.assertLess(many_positions_peak, few_positions_peak * 1.5)
+
+
+class TestHistoryCache(TestCase):
+    FROM_DATE = datetime.date.fromisoformat("2021-04-25")
+    TO_DATE = datetime.date.fromisoformat("2021-05-04")
+
+    def setUp(self):
+        super().setUp()
+        cache.clear()
+        self.user = User.objects.create(username="testuser", email="test@example.com")
+        self.account = models.Account.objects.create(
+            user=self.user, currency=models.Currency.EUR, nickname="test account"
+        )
+        exchange = models.Exchange.objects.create(name="USA stocks", country="USA")
+        self.asset = models.Asset.objects.create(
+            isin="US1234",
+            symbol="MOONIES",
+            name="a stock",
+            currency=models.Currency.USD,
+            exchange=exchange,
+            tracked=True,
+        )
+        self.repository = accounts.AccountRepository()
+        self.transaction = self._add_transaction("2021-04-27 10:00Z", 3)
+        self.position = self.transaction.position
+
+    def _add_transaction(self, executed_at, quantity):
+        return self.repository.add_transaction_known_asset(
+            self.account,
+            self.asset.pk,
+            datetime.datetime.strptime(executed_at, "%Y-%m-%d %H:%M%z"),
+            decimal.Decimal(quantity),
+            decimal.Decimal("12.5"),
+            decimal.Decimal(0),
+            decimal.Decimal(0),
+            decimal.Decimal(0),
+            decimal.Decimal(0),
+        )
+
+    def _quantity_history(self):
+        position = models.Position.objects.get(pk=self.position.pk)
+        return position.quantity_history(self.FROM_DATE, self.TO_DATE)
+
+    def test_history_cached_across_instances(self):
+        history = self._quantity_history()
+        position = models.Position.objects.get(pk=self.position.pk)
+        with self.assertNumQueries(0):
+            self.assertEqual(
+                position.quantity_history(self.FROM_DATE, self.TO_DATE), history
+            )
+
+    def test_adding_transaction_invalidates_history(self):
+        self.assertEqual(self._quantity_history()[0][1], 3)
+        self._add_transaction("2021-05-01 10:00Z", 2)
+        self.assertEqual(self._quantity_history()[0][1], 5)
+
+    def test_correcting_and_deleting_transaction_invalidates_history(self):
+        self.assertEqual(self._quantity_history()[0][1], 3)
+        self.repository.correct_transaction(
+            self.transaction, {"quantity": decimal.Decimal(4)}
+        )
+        self.assertEqual(self._quantity_history()[0][1], 4)
+        self.repository.delete_transaction(self.transaction)
+        self.assertEqual(self._quantity_history()[0][1], 0)
+
+    def test_invalidating_asset_invalidates_value_history(self):
+        position = models.Position.objects.get(pk=self.position.pk)
+        history = position.value_history(self.FROM_DATE, self.TO_DATE)
+        models.PriceHistory.objects.create(
+            asset=self.asset, date=self.TO_DATE, value=decimal.Decimal(20)
+        )
+        self.assertEqual(position.value_history(self.FROM_DATE, self.TO_DATE), history)
+
+        history_cache.invalidate_asset(self.asset.pk)
+        self.assertEqual(
+            position.value_history(self.FROM_DATE, self.TO_DATE)[0],
+            (self.TO_DATE, decimal.Decimal(60)),
+        )
+
+    def test_other_positions_not_invalidated(self):
+        other_account = models.Account.objects.create(
+            user=self.user, currency=models.Currency.EUR, nickname="other account"
+        )
+        other_position = models.Position.objects.create(
+            account=other_account, asset=self.asset
+        )
+        other_position.quantity_history(self.FROM_DATE, self.TO_DATE)
+        self._add_transaction("2021-05-01 10:00Z", 2)
+        with self.assertNumQueries(0):
+            other_position.quantity_history(self.FROM_DATE, self.TO_DATE)
@@ -1,16 +1,30 @@
 import datetime
 import decimal
+import json
 from unittest.mock import patch
 
 from django.contrib.auth.models import User
+from django.core.cache import cache
 from django.test import TestCase
 from django.urls import reverse
 from django.utils import timezone
 from hypothesis import given
 from hypothesis import strategies as st
 from hypothesis.extra.django import TestCase as HypothesisTestCase
-
-from finance import accounts, models, testing_utils, utils, assets, stock_exchanges
+import msgpack
+
+from finance import (
+    accounts,
+    gains,
+    models,
+    prices,
+    renderers,
+    tasks,
+    testing_utils,
+    utils,
+    assets,
+    stock_exchanges,
+)
 
 
 _FAKE_TRANSACTIONS = [
@@ -77,6 +91,8 @@ def _add_transaction(
             value=0.84,
             date="2020-02-03",
         )
+        prices.update_latest_quote(asset.pk)
+        prices.update_latest_exchange_rates()
 
 
 class TestPositionsView(testing_utils.ViewTestBase, TestCase):
@@ -125,6 +141,8 @@ class TestPositionsView(testing_utils.ViewTestBase, TestCase):
                 from_currency=self.asset.currency,
                 to_currency=self.account.currency,
             )
+        prices.update_latest_quote(self.asset.pk)
+        prices.update_latest_exchange_rates()
 
         response = self.client.get(self.get_url() + self.QUERY_PARAMS)
 
@@ -133,6 +151,23 @@ class TestPositionsView(testing_utils.ViewTestBase, TestCase):
         self.assertContains(response, '"latest_price":"1')
         self.assertContains(response, '"latest_exchange_rate":"1')
 
+    def test_queries_dont_grow_with_positions(self):
+        # Session, user and positions.
+        with self.assertNumQueries(3):
+            response = self.client.get(self.get_url() + self.QUERY_PARAMS)
+        self.assertEqual(response.status_code, 200)
+
+        for i in range(5):
+            isin = f"USA{i}"
+            _add_dummy_account_and_asset(self.user, isin=isin)
+            _add_transaction(
+                self.account, isin, self.exchange, "2021-04-27 10:00Z", 3, 12.11
+            )
+        with self.assertNumQueries(3):
+            response = self.client.get(self.get_url() + self.QUERY_PARAMS)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.json()), 6)
+
 
 class TestPositionDetailView(testing_utils.ViewTestBase, TestCase):
     URL = "/api/positions/%s/"
@@ -164,6 +199,84 @@ class TestPositionDetailView(testing_utils.ViewTestBase, TestCase):
     def get_reversed_url(self):
         return reverse(self.VIEW_NAME, args=[self.position.pk])
 
+    def _get_position(self, query):
+        response = self.client.get(
+            reverse(self.VIEW_NAME, args=[self.position.pk]) + query
+        )
+        self.assertEqual(response.status_code, 200)
+        return response.json()
+
+    def test_resolution_week(self):
+        query = "?from_date=2021-03-01&to_date=2021-05-30"
+        daily = self._get_position(query)
+        weekly = self._get_position(query + "&resolution=week")
+        self.assertEqual(len(daily["quantities"]), 91)
+        self.assertEqual(len(weekly["quantities"]), 13)
+        self.assertEqual(weekly["quantities"][0], daily["quantities"][0])
+
+    def test_resolution_lttb(self):
+        position = self._get_position(
+            "?from_date=2021-03-01&to_date=2021-05-30&resolution=lttb&points=10"
+        )
+        self.assertEqual(len(position["quantities"]), 10)
+
+    def test_invalid_resolution_fails(self):
+        response = self.client.get(
+            reverse(self.VIEW_NAME, args=[self.position.pk]) + "?resolution=hour"
+        )
+        self.assertEqual(response.status_code, 400)
+
+    def test_columnar_format(self):
+        query = "?from_date=2021-03-01&to_date=2021-05-30"
+        daily = self._get_position(query)
+        columnar = self._get_position(query + "&format=columnar")
+        self.assertEqual(columnar["id"], daily["id"])
+        quantities = columnar["quantities"]
+        self.assertEqual(quantities["start"], "2021-05-30")
+        self.assertEqual(quantities["period"], -1)
+        self.assertEqual(
+            quantities["values"], [float(value) for _, value in daily["quantities"]]
+        )
+
+        response = self.client.get(
+            reverse(self.VIEW_NAME, args=[self.position.pk]) + query + "&delta=true",
+            HTTP_ACCEPT=renderers.ColumnarJSONRenderer.media_type,
+        )
+        self.assertEqual(response.status_code, 200)
+        values = response.json()["values"]
+        self.assertTrue(values["delta"])
+        self.assertAlmostEqual(
+            sum(values["values"]) / 10 ** values["scale"],
+            columnar["values"]["values"][-1],
+            places=4,
+        )
+
+    def test_msgpack_format(self):
+        query = "?from_date=2021-03-01&to_date=2021-05-30"
+        response = self.client.get(
+            reverse(self.VIEW_NAME, args=[self.position.pk])
+            + query
+            + "&format=msgpack"
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response["Content-Type"], "application/x-msgpack")
+        self.assertEqual(
+            msgpack.unpackb(response.content),
+            self._get_position(query + "&format=columnar"),
+        )
+
+    def test_stream(self):
+        query = "?from_date=2021-03-01&to_date=2021-05-30"
+        response = self.client.get(
+            reverse(self.VIEW_NAME, args=[self.position.pk]) + query + "&stream=true"
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.streaming)
+        self.assertEqual(
+            json.loads(b"".join(response.streaming_content)),
+            self._get_position(query),
+        )
+
 
 class TestAccountsView(testing_utils.ViewTestBase, HypothesisTestCase):
     URL = "/api/accounts/"
@@ -277,6 +390,96 @@ class TestAccountDetailView(testing_utils.ViewTestBase, TestCase):
     def get_reversed_url(self):
         return reverse(self.VIEW_NAME, args=[self.account.pk])
 
+    def test_resolution_month(self):
+        _add_transaction(
+            self.account,
+            self.isin,
+            self.exchange,
+            "2021-01-05 10:00Z",
+            3,
+            12.11,
+        )
+        asset = models.Position.objects.get(account=self.account).asset
+        for date in ("2021-02-15", "2021-03-15"):
+            models.PriceHistory.objects.create(asset=asset, value=13, date=date)
+        models.CurrencyExchangeRate.objects.create(
+            from_currency=models.Currency.USD,
+            to_currency=models.Currency.EUR,
+            value=0.84,
+            date="2021-01-04",
+        )
+        response = self.client.get(
+            reverse(self.VIEW_NAME, args=[self.account.pk])
+            + "?from_date=2021-01-01&to_date=2021-03-31&resolution=month"
+        )
+        self.assertEqual(response.status_code, 200)
+        [(_, values)] = response.json()["values"]
+        self.assertEqual(
+            [date for date, _ in values], ["2021-03-15", "2021-02-15", "2021-01-06"]
+        )
+
+    def test_balance_history(self):
+        for executed_at, quantity, price in _FAKE_TRANSACTIONS[:3]:
+            _add_transaction(
+                self.account, self.isin, self.exchange, executed_at, quantity, price
+            )
+        response = self.client.get(
+            reverse(self.VIEW_NAME, args=[self.account.pk])
+            + "?from_date=2021-04-28&to_date=2021-05-01"
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()["balance"], "1.5000000000")
+        self.assertEqual(
+            response.json()["balance_history"],
+            [
+                ["2021-05-01", 1.5],
+                ["2021-04-30", 1.5],
+                ["2021-04-29", 1.0],
+                ["2021-04-28", 0.5],
+            ],
+        )
+
+    def test_columnar_format(self):
+        _add_transaction(
+            self.account, self.isin, self.exchange, "2021-04-27 10:00Z", 3, 12.11
+        )
+        asset = models.Position.objects.get(account=self.account).asset
+        models.PriceHistory.objects.create(asset=asset, value=13, date="2021-05-10")
+        models.CurrencyExchangeRate.objects.create(
+            from_currency=models.Currency.USD,
+            to_currency=models.Currency.EUR,
+            value=0.84,
+            date="2021-04-26",
+        )
+        url = reverse(self.VIEW_NAME, args=[self.account.pk])
+        query = "?from_date=2021-04-01&to_date=2021-05-30&resolution=week"
+        response = self.client.get(url + query + "&format=columnar")
+        self.assertEqual(response.status_code, 200)
+        [(position_id, columns)] = response.json()["values"]
+        [(_, values)] = self.client.get(url + query).json()["values"]
+        self.assertEqual(columns["start"], values[0][0])
+        self.assertEqual(columns["values"], [float(value) for _, value in values])
+
+    def test_stream(self):
+        for transaction in _FAKE_TRANSACTIONS:
+            _add_transaction(
+                self.account,
+                self.isin,
+                self.exchange,
+                transaction[0],
+                transaction[1],
+                transaction[2],
+            )
+        url = reverse(self.VIEW_NAME, args=[self.account.pk])
+        query = "?from_date=2021-04-01&to_date=2021-05-30"
+        response = self.client.get(url + query + "&stream=true")
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.streaming)
+        self.assertEqual(
+            json.loads(b"".join(response.streaming_content)),
+            self.client.get(url + query).json(),
+        )
+
     def test_deleting_the_account(self):
         # Delete is only successful if there aren't any associated
         # transactions or events (because they are deleted).
@@ -355,6 +558,63 @@ class TestAccountDetailView(testing_utils.ViewTestBase, TestCase):
         self.assertEqual(self.account.currency, models.Currency.USD)
 
 
+    @patch.object(tasks, "schedule_update_lots")
+    def test_cost_basis_method(self, schedule_update_lots):
+        for transaction in _FAKE_TRANSACTIONS:
+            _add_transaction(
+                self.account,
+                self.isin,
+                self.exchange,
+                transaction[0],
+                transaction[1],
+                transaction[2],
+            )
+        position = models.Position.objects.get(account=self.account)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.put(
+                reverse(self.VIEW_NAME, args=[self.account.pk]),
+                {
+                    "id": self.account.pk,
+                    "nickname": self.account.nickname,
+                    "description": "",
+                    "currency": "EUR",
+                    "cost_basis_method": "LIFO",
+                },
+                content_type="application/json",
+            )
+        self.assertEqual(response.status_code, 200)
+        self.account.refresh_from_db()
+        self.assertEqual(self.account.cost_basis_method, models.CostBasisMethod.LIFO)
+        # Lots are recomputed with the new method in the background.
+        schedule_update_lots.assert_called_once_with([position.pk])
+        self.assertTrue(models.PendingLots.objects.filter(position=position).exists())
+
+        url = reverse("account-cost-basis", args=[self.account.pk])
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()["method"], "LIFO")
+
+        response = self.client.get(url + "?method=hifo")
+        self.assertEqual(response.status_code, 200)
+        data = response.json()
+        self.assertEqual(data["method"], "HIFO")
+        matcher = gains.compare(position, models.CostBasisMethod.HIFO)
+        self.assertEqual(
+            data["positions"],
+            [
+                {
+                    "position": position.pk,
+                    "realized_gain": f"{matcher.realized_gain:.10f}",
+                    "cost_basis": f"{matcher.cost_basis:.10f}",
+                }
+            ],
+        )
+
+        response = self.client.get(url + "?method=newest")
+        self.assertEqual(response.status_code, 400)
+
+
 class TestTransactionsView(testing_utils.ViewTestBase, TestCase):
     URL = "/api/transactions/"
     VIEW_NAME = "transaction-list"
@@ -499,6 +759,53 @@ class TestTransactionsView(testing_utils.ViewTestBase, TestCase):
         )
         self.assertEqual(response.status_code, 400)
 
+    @patch.object(tasks.update_snapshots, "delay")
+    @patch.object(tasks.update_lots, "apply_async")
+    def test_lots_recomputed_in_background(self, apply_async, _):
+        cache.clear()
+        with self.captureOnCommitCallbacks(execute=True):
+            for executed_at in ("2021-05-05T00:00:00Z", "2021-05-06T00:00:00Z"):
+                response = self.client.post(
+                    reverse(self.VIEW_NAME),
+                    {
+                        "executed_at": executed_at,
+                        "account": self.account.pk,
+                        "asset": self.asset.pk,
+                        "quantity": -5,
+                        "price": 3.15,
+                        "transaction_costs": 0,
+                        "local_value": 15.75,
+                        "value_in_account_currency": 13.23,
+                        "total_in_account_currency": 13.23,
+                        "currency": "EUR",
+                    },
+                )
+                self.assertEqual(response.status_code, 201)
+
+        position = models.Position.objects.get(asset=self.asset)
+        # Both changes are recomputed together.
+        apply_async.assert_called_once_with(
+            (position.pk,), countdown=tasks.LOTS_DELAY
+        )
+        response = self.client.get(reverse("api-positions"))
+        self.assertEqual(response.json()[0]["lots_pending"], True)
+        self.assertEqual(
+            models.Lot.objects.filter(sell_date__gte="2021-05-05").count(), 0
+        )
+
+        tasks.update_lots(position.pk)
+
+        response = self.client.get(reverse("api-positions"))
+        self.assertEqual(response.json()[0]["lots_pending"], False)
+        self.assertEqual(
+            models.Lot.objects.filter(sell_date__gte="2021-05-05").count(), 4
+        )
+        position.refresh_from_db()
+        self.assertEqual(
+            position.realized_gain,
+            sum(lot.realized_gain_account_currency or 0 for lot in position.lots.all()),
+        )
+
     def test_add_transaction_for_known_asset_for_not_owned_account_fails(self):
 
         self.other_user = User.objects.create(
@@ -1422,3 +1729,43 @@ class TestLotListView(testing_utils.ViewTestBase, TestCase):
         self.assertEqual(response.status_code, 200)
         data = response.json()
         self.assertEqual(len(data), 1)
+
+    def test_realized_gains_by_year(self):
+        _add_transaction(
+            self.account, self.isin, self.exchange, "2022-06-01 10:00Z", -5, 30
+        )
+        url = reverse("lot-realized-gains")
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        data = response.json()
+        self.assertEqual([row["year"] for row in data], [2021, 2022])
+        for row in data:
+            lots = models.Lot.objects.filter(sell_date__year=row["year"])
+            self.assertEqual(row["account"], self.account.pk)
+            self.assertEqual(row["asset"], self.asset.pk)
+            self.assertEqual(row["asset_type"], "Stock")
+            self.assertNotIn("term", row)
+            self.assertEqual(
+                decimal.Decimal(row["realized_gain"]),
+                sum(lot.realized_gain_account_currency for lot in lots),
+            )
+            self.assertEqual(
+                decimal.Decimal(row["proceeds"]),
+                sum(lot.sell_basis_account_currency for lot in lots),
+            )
+            self.assertEqual(
+                decimal.Decimal(row["cost_basis"]),
+                sum(lot.cost_basis_account_currency for lot in lots),
+            )
+
+        response = self.client.get(url + "?split_term=true&year=2022")
+        self.assertEqual(response.status_code, 200)
+        [row] = response.json()
+        # Bought in 2021, sold more than a year later.
+        self.assertEqual((row["year"], row["term"]), (2022, "long"))
+
+        response = self.client.get(url + "?split_term=true&long_term_days=500")
+        self.assertEqual(
+            [(row["year"], row["term"]) for row in response.json()],
+            [(2021, "short"), (2022, "short")],
+        )
@@ -1,11 +1,21 @@
 import datetime
 import decimal
+import threading
 
 from django.contrib.auth.models import User
-from django.test import SimpleTestCase, TestCase
+from django.db import IntegrityError, connection, transaction
+from django.test import SimpleTestCase, TestCase, TransactionTestCase
 from unittest.mock import patch
 
-from finance import accounts, models, stock_exchanges, utils
+from finance import (
+    accounts,
+    fingerprints,
+    gains,
+    ledger,
+    models,
+    stock_exchanges,
+    utils,
+)
 
 DATE_FORMAT = "%Y-%m-%d %H:%M%z"
 
@@ -357,11 +367,14 @@ class TestPosition(TestCase):
             lots[0].realized_gain_account_currency, decimal.Decimal("12.34")
         )
 
+        lot_ids = [lot.id for lot in lots]
         account_repository.correct_transaction(transaction, {"quantity": -5})
 
         self.assertEqual(models.Lot.objects.count(), 2)
         lots = models.Lot.objects.order_by("id").all()
 
+        # Lots matched again are updated in place.
+        self.assertEqual([lot.id for lot in lots], lot_ids)
         self.assertEqual(lots[0].quantity, 5)
         self.assertEqual(lots[1].quantity, 5)
 
@@ -372,6 +385,156 @@ class TestPosition(TestCase):
         self.assertEqual(lots[0].quantity, 10)
         self.assertEqual(lots[0].realized_gain_account_currency, None)
 
+    def test_deleting_transaction_corrected_in_the_meantime(self):
+        _add_transaction(
+            self.account, self.isin, self.exchange, "2021-04-27 10:00Z", 10, 3
+        )
+        stale = models.Transaction.objects.get()
+        account_repository = accounts.AccountRepository()
+        account_repository.correct_transaction(
+            models.Transaction.objects.get(), {"quantity": 4}
+        )
+
+        account_repository.delete_transaction(stale)
+        position = models.Position.objects.get()
+        self.assertEqual(position.quantity, 0)
+        self.assertEqual(models.Transaction.objects.count(), 0)
+
+    def test_lots_rebuilt_match_added_one_by_one(self):
+        for transaction in _FAKE_TRANSACTIONS:
+            _add_transaction(
+                self.account,
+                self.isin,
+                self.exchange,
+                transaction[0],
+                transaction[1],
+                transaction[2],
+            )
+        position = models.Position.objects.first()
+
+        def lot_values():
+            return sorted(
+                models.Lot.objects.values_list(
+                    "id",
+                    "quantity",
+                    "buy_date",
+                    "cost_basis_account_currency",
+                    "sell_date",
+                    "realized_gain_account_currency",
+                ),
+                key=str,
+            )
+
+        added_lots = lot_values()
+        realized_gain = position.realized_gain
+        cost_basis = position.cost_basis
+
+        # Rebuilding doesn't need queries per transaction or lot, unchanged
+        # lots aren't written.
+        with self.assertNumQueries(6):
+            gains.update_lots(position)
+
+        self.assertEqual(lot_values(), added_lots)
+        position.refresh_from_db()
+        self.assertEqual(position.realized_gain, realized_gain)
+        self.assertEqual(position.cost_basis, cost_basis)
+        self.assertEqual(
+            sum(lot[1] for lot in added_lots if lot[4] is None), position.quantity
+        )
+
+    def test_transaction_fingerprints(self):
+        for fake_transaction in _FAKE_TRANSACTIONS[:2]:
+            _add_transaction(self.account, self.isin, self.exchange, *fake_transaction)
+        first, second = models.Transaction.objects.order_by("executed_at")
+
+        # Values read back from the database have the same fingerprint.
+        self.assertEqual(
+            fingerprints.fingerprint(
+                models.Transaction, fingerprints.TRANSACTION_FIELDS, first
+            ),
+            first.fingerprint,
+        )
+        self.assertNotEqual(first.fingerprint, second.fingerprint)
+
+        account_repository = accounts.AccountRepository()
+        with self.assertRaises(accounts.DuplicateTransaction):
+            account_repository.correct_transaction(
+                second,
+                {
+                    "executed_at": first.executed_at,
+                    "quantity": first.quantity,
+                    "price": first.price,
+                },
+            )
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            models.Transaction.objects.create(
+                position=first.position,
+                **{
+                    field: getattr(first, field)
+                    for field in fingerprints.TRANSACTION_FIELDS
+                },
+            )
+
+    def test_events_recorded_once(self):
+        account_repository = accounts.AccountRepository()
+        for _ in range(2):
+            account_repository.add_event(
+                self.account,
+                amount=decimal.Decimal("100.1"),
+                executed_at=datestr_to_datetime("2021-04-27 10:00Z"),
+                event_type=models.EventType.DEPOSIT,
+            )
+        self.assertEqual(models.AccountEvent.objects.count(), 1)
+        self.account.refresh_from_db()
+        self.assertEqual(self.account.balance, decimal.Decimal("100.1"))
+
+    def test_adding_transactions_in_bulk(self):
+        def record(executed_at, quantity, price):
+            return accounts.TransactionRecord(
+                executed_at=datestr_to_datetime(executed_at),
+                quantity=decimal.Decimal(quantity),
+                price=decimal.Decimal(price),
+                transaction_costs=decimal.Decimal("0.5"),
+                local_value=decimal.Decimal("0.5"),
+                value_in_account_currency=decimal.Decimal("0.5"),
+                total_in_account_currency=decimal.Decimal("0.5"),
+                order_id="123",
+                isin=self.isin,
+                exchange=self.exchange,
+                asset_defaults={"local_currency": "USD"},
+            )
+
+        # The first transaction is recorded already.
+        _add_transaction(self.account, self.isin, self.exchange, *_FAKE_TRANSACTIONS[0])
+        records = [record(*transaction) for transaction in _FAKE_TRANSACTIONS]
+        # Selling more than owned before the last transaction.
+        records.append(record("2021-05-04 11:00Z", -18, 20))
+
+        account_repository = accounts.AccountRepository()
+        # The number of queries doesn't depend on the number of records.
+        with self.assertNumQueries(29):
+            results = account_repository.add_transactions_bulk(self.account, records)
+
+        self.assertEqual(
+            [result.created for result in results], [False] + [True] * 7 + [False]
+        )
+        self.assertIsInstance(results[-1].error, gains.SoldBeforeBought)
+        self.assertEqual(models.Transaction.objects.count(), len(_FAKE_TRANSACTIONS))
+        position = models.Position.objects.get()
+        self.assertEqual(position.quantity, 20)
+        self.account.refresh_from_db()
+        self.assertEqual(self.account.balance, decimal.Decimal("0.5") * 8)
+        self.assertEqual(
+            sum(lot.quantity for lot in position.lots.filter(sell_date=None)), 20
+        )
+
+        # Adding them again doesn't change anything.
+        results = account_repository.add_transactions_bulk(self.account, records[:-1])
+        self.assertFalse(any(result.created for result in results))
+        self.assertEqual(models.Transaction.objects.count(), len(_FAKE_TRANSACTIONS))
+        position.refresh_from_db()
+        self.assertEqual(position.quantity, 20)
+
 
 BTC_ASSET_SEARCH_RESULT = [
     {
@@ -777,6 +940,72 @@ UNSUPPORTED_EXCHANGE_AND_CURRENCY_RESULTS = [
 ]
 
 
+@patch("finance.tasks.update_snapshots.delay")
+class TestConcurrentChanges(TransactionTestCase):
+    THREADS = 4
+    CHANGES = 8
+
+    def setUp(self):
+        super().setUp()
+        self.user = User.objects.create(username="testuser", email="test@example.com")
+        self.isin = "US1234"
+        self.account, self.exchange, self.asset = _add_dummy_account_and_asset(
+            self.user, isin=self.isin
+        )
+
+    def _hammer(self, thread, barrier, errors):
+        try:
+            account = models.Account.objects.get(pk=self.account.pk)
+            account_repository = accounts.AccountRepository()
+            barrier.wait()
+            for i in range(self.CHANGES):
+                executed_at = datetime.datetime(
+                    2021, 4, 1 + i, thread, tzinfo=datetime.timezone.utc
+                )
+                account_repository.add_transaction_known_asset(
+                    account,
+                    self.asset.pk,
+                    executed_at,
+                    quantity=decimal.Decimal(1),
+                    price=decimal.Decimal(10),
+                    transaction_costs=decimal.Decimal(0),
+                    local_value=decimal.Decimal(-10),
+                    value_in_account_currency=decimal.Decimal(-10),
+                    total_in_account_currency=decimal.Decimal(-10),
+                )
+                account_repository.add_event(
+                    account,
+                    decimal.Decimal(25),
+                    executed_at,
+                    models.EventType.DEPOSIT,
+                )
+        except Exception as e:
+            errors.append(e)
+        finally:
+            connection.close()
+
+    def test_changes_of_one_account_from_many_threads(self, _):
+        barrier = threading.Barrier(self.THREADS)
+        errors = []
+        threads = [
+            threading.Thread(target=self._hammer, args=(thread, barrier, errors))
+            for thread in range(self.THREADS)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+
+        changes = self.THREADS * self.CHANGES
+        position = models.Position.objects.get(account=self.account)
+        self.assertEqual(position.quantity, changes)
+        self.assertEqual(position.transactions.count(), changes)
+        self.account.refresh_from_db()
+        self.assertEqual(self.account.balance, changes * 15)
+        self.assertEqual(ledger.balance(self.account), changes * 15)
+
+
 class TestAssetSearch(TestCase):
     # This fixture provides data about 65 different exchanges,
     # and sets up a single account for testing.
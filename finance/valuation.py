@@ -0,0 +1,642 @@
+"""Vectorized valuation of positions.
+
+Quantities, prices and exchange rates are aligned on a shared date axis
+as NumPy arrays, so that the history of a position is computed with
+cumulative sums and elementwise products instead of merging lists of
+(date, value) tuples one element at a time.
+
+The output is the same as the one of the original implementation:
+lists of (date, value) tuples ordered from the latest date.
+
+Values are exact decimals by default. Histories that only feed charts can
+be computed in the float mode instead, on float64 arrays, which is much
+faster for long ranges. Balances, lots and gains never use it.
+"""
+import datetime
+import decimal
+from collections import defaultdict
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple, Union
+
+import numpy as np
+import pytz
+from django.db import connection
+
+from finance import exchange_rates, models
+
+
+History = List[Tuple[datetime.date, Union[decimal.Decimal, float]]]
+
+# (executed_at, quantity, price) ordered from the latest transaction.
+TransactionRecords = Sequence[
+    Tuple[datetime.datetime, decimal.Decimal, decimal.Decimal]
+]
+# (date, value) ordered from the latest date.
+DatedRecords = Sequence[Tuple[datetime.date, decimal.Decimal]]
+
+ONE_DAY = datetime.timedelta(days=1)
+
+# Numeric modes.
+DECIMAL = "decimal"
+FLOAT = "float"
+
+# Resolutions of histories sent to charts, see downsample.
+DAY = "day"
+WEEK = "week"
+MONTH = "month"
+LTTB = "lttb"
+RESOLUTIONS = (DAY, WEEK, MONTH, LTTB)
+LTTB_DEFAULT_POINTS = 300
+
+
+class DateAxis:
+    """Dates from to_date back to from_date, every output_period."""
+
+    def __init__(
+        self,
+        from_date: datetime.date,
+        to_date: datetime.date,
+        output_period: datetime.timedelta = ONE_DAY,
+    ):
+        if output_period.days < 1:
+            raise ValueError("output_period has to be at least one day")
+        self.from_date = from_date
+        self.to_date = to_date
+        self.period = output_period.days
+        if to_date < from_date:
+            self.size = 0
+        else:
+            self.size = (to_date - from_date).days // self.period + 1
+        self.ordinals = to_date.toordinal() - np.arange(
+            self.size, dtype=np.int64
+        ) * self.period
+        self.dates = [datetime.date.fromordinal(int(o)) for o in self.ordinals]
+
+    def locate(self, ordinals: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """Returns indices of the ordinals on the axis and a mask of the ones on it."""
+        offsets = self.to_date.toordinal() - ordinals
+        indices = offsets // self.period
+        mask = (offsets >= 0) & (offsets % self.period == 0) & (indices < self.size)
+        return indices, mask
+
+
+def _ordinals(dates: Sequence[datetime.date]) -> np.ndarray:
+    return np.fromiter(
+        (date.toordinal() for date in dates), dtype=np.int64, count=len(dates)
+    )
+
+
+def _to_datetime(date: datetime.date) -> datetime.datetime:
+    return datetime.datetime(date.year, date.month, date.day, tzinfo=pytz.UTC)
+
+
+def _empty(size: int, numeric: str) -> np.ndarray:
+    if numeric == FLOAT:
+        return np.full(size, np.nan)
+    return np.empty(size, dtype=object)
+
+
+def _scalar(value: decimal.Decimal, numeric: str) -> Union[decimal.Decimal, float]:
+    if numeric == FLOAT:
+        return float(value)
+    return value
+
+
+def as_numeric(history: History, numeric: str) -> History:
+    """History with values of the numeric mode."""
+    if numeric == FLOAT:
+        return [(date, float(value)) for date, value in history]
+    return history
+
+
+def _assign_first(
+    axis: DateAxis,
+    values: np.ndarray,
+    present: np.ndarray,
+    ordinals: np.ndarray,
+    record_values: Sequence[decimal.Decimal],
+) -> None:
+    """Writes record values at their dates, the first record for a date wins."""
+    indices, mask = axis.locate(ordinals)
+    positions = np.flatnonzero(mask)
+    if not len(positions):
+        return
+    indices, first = np.unique(indices[positions], return_index=True)
+    record_array = np.empty(len(record_values), dtype=object)
+    record_array[:] = list(record_values)
+    values[indices] = record_array[positions[first]]
+    present[indices] = True
+
+
+def compute_quantities(
+    axis: DateAxis,
+    quantity: decimal.Decimal,
+    transactions: TransactionRecords,
+    numeric: str = DECIMAL,
+) -> np.ndarray:
+    """Quantity held at the beginning of every day of the axis.
+
+    Works backwards from the current quantity by undoing transactions
+    executed on the day or later, including ones after the end of the axis.
+    """
+    quantity = _scalar(quantity, numeric)
+    quantities = _empty(axis.size, numeric)
+    if not transactions:
+        quantities[:] = [quantity] * axis.size
+        return quantities
+
+    dates = [executed_at.date() for executed_at, _, _ in transactions]
+    ordinals = _ordinals(dates)
+    order = np.argsort(ordinals, kind="stable")
+    transaction_quantities = _empty(len(transactions), numeric)
+    transaction_quantities[:] = [record[1] for record in transactions]
+
+    # undone[k] is the sum of quantities of transactions starting from k-th
+    # (in date order), the last element is an empty sum.
+    undone = _empty(len(transactions) + 1, numeric)
+    undone[:-1] = np.cumsum(transaction_quantities[order][::-1])[::-1]
+    undone[-1] = decimal.Decimal(0)
+
+    first_undone = np.searchsorted(ordinals[order], axis.ordinals, side="left")
+    quantities[:] = quantity - undone[first_undone]
+    return quantities
+
+
+def recorded_prices(
+    axis: DateAxis, prices: DatedRecords, numeric: str = DECIMAL
+) -> Tuple[np.ndarray, np.ndarray]:
+    """Recorded prices of the asset at dates of the axis and their mask."""
+    values = _empty(axis.size, numeric)
+    present = np.zeros(axis.size, dtype=bool)
+    if prices and axis.size:
+        _assign_first(
+            axis,
+            values,
+            present,
+            _ordinals([date for date, _ in prices]),
+            [value for _, value in prices],
+        )
+    return values, present
+
+
+def transaction_prices(
+    axis: DateAxis, transactions: TransactionRecords, numeric: str = DECIMAL
+) -> Tuple[np.ndarray, np.ndarray]:
+    """Prices of transactions within the axis, applied from the next day."""
+    values = _empty(axis.size, numeric)
+    present = np.zeros(axis.size, dtype=bool)
+    from_datetime = _to_datetime(axis.from_date)
+    to_datetime = _to_datetime(axis.to_date)
+    dated_prices = [
+        (executed_at.date() + ONE_DAY, price)
+        for executed_at, _, price in transactions
+        if from_datetime <= executed_at <= to_datetime
+    ]
+    if dated_prices and axis.size:
+        _assign_first(
+            axis,
+            values,
+            present,
+            _ordinals([date for date, _ in dated_prices]),
+            [price for _, price in dated_prices],
+        )
+    return values, present
+
+
+def compute_prices(
+    axis: DateAxis,
+    transactions: TransactionRecords,
+    prices: DatedRecords,
+    numeric: str = DECIMAL,
+) -> Tuple[np.ndarray, np.ndarray]:
+    """Price of the asset at dates of the axis and a mask of known prices.
+
+    Recorded prices take precedence over prices of transactions, which
+    apply from the next day. Dates before the first recorded price are
+    valued at zero.
+    """
+    values, present = transaction_prices(axis, transactions, numeric)
+    if not axis.size or not prices:
+        return values, present
+
+    first_price_date = min(date for date, _ in prices)
+    if first_price_date > axis.from_date:
+        day_before_first_date = first_price_date.toordinal() - 1
+        offsets = day_before_first_date - axis.ordinals
+        padding = (offsets >= 0) & (offsets % axis.period == 0) & ~present
+        values[padding] = decimal.Decimal("0")
+        present |= padding
+
+    recorded, recorded_present = recorded_prices(axis, prices, numeric)
+    values[recorded_present] = recorded[recorded_present]
+    present |= recorded_present
+    return values, present
+
+
+def compute_exchange_rates(
+    axis: DateAxis,
+    exchange_rates: DatedRecords,
+    fill_forward: bool = True,
+    numeric: str = DECIMAL,
+) -> Tuple[np.ndarray, np.ndarray]:
+    """Exchange rate at dates of the axis and a mask of known rates.
+
+    Dates after the latest known rate reuse it, unless fill_forward is False.
+    """
+    values = _empty(axis.size, numeric)
+    present = np.zeros(axis.size, dtype=bool)
+    if not exchange_rates or not axis.size:
+        return values, present
+
+    if fill_forward:
+        latest_date, latest_rate = exchange_rates[0]
+        for date, rate in exchange_rates:
+            if date > latest_date:
+                latest_date, latest_rate = date, rate
+        after_latest = axis.ordinals > latest_date.toordinal()
+        values[after_latest] = latest_rate
+        present |= after_latest
+
+    _assign_first(
+        axis,
+        values,
+        present,
+        _ordinals([date for date, _ in exchange_rates]),
+        [value for _, value in exchange_rates],
+    )
+    return values, present
+
+
+def _multiply(
+    first: np.ndarray,
+    first_present: np.ndarray,
+    second: np.ndarray,
+    second_present: np.ndarray,
+) -> Tuple[np.ndarray, np.ndarray]:
+    present = first_present & second_present
+    values = np.empty_like(first)
+    values[present] = first[present] * second[present]
+    return values, present
+
+
+def _to_history(axis: DateAxis, values: np.ndarray, present: np.ndarray) -> History:
+    # Python objects, floats of float64 arrays and decimals of object ones.
+    values = values.tolist()
+    return [
+        (axis.dates[i], values[i]) for i in np.flatnonzero(present).tolist()
+    ]
+
+
+def _latest_per_bucket(
+    history: History, bucket: Callable[[datetime.date], Any]
+) -> History:
+    downsampled = []
+    previous_bucket = None
+    for date, value in history:
+        date_bucket = bucket(date)
+        if date_bucket != previous_bucket:
+            downsampled.append((date, value))
+            previous_bucket = date_bucket
+    return downsampled
+
+
+def _largest_triangle_three_buckets(history: History, points: int) -> History:
+    if points >= len(history) or points < 3:
+        return history
+    chronological = history[::-1]
+    x = np.array([date.toordinal() for date, _ in chronological], dtype=float)
+    y = np.array([float(value) for _, value in chronological], dtype=float)
+
+    # The first and the last points are always kept, the ones in between
+    # are split into buckets that contribute a point each.
+    edges = np.linspace(1, len(chronological) - 1, points - 1).astype(int)
+    selected = [0]
+    for i in range(points - 2):
+        start, end = edges[i], edges[i + 1]
+        if i + 2 < len(edges):
+            next_x = x[end : edges[i + 2]].mean()
+            next_y = y[end : edges[i + 2]].mean()
+        else:
+            next_x, next_y = x[-1], y[-1]
+        previous_x, previous_y = x[selected[-1]], y[selected[-1]]
+        # Doubled areas of triangles formed with the previously selected point
+        # and the average of the next bucket.
+        areas = np.abs(
+            (previous_x - next_x) * (y[start:end] - previous_y)
+            - (previous_x - x[start:end]) * (next_y - previous_y)
+        )
+        selected.append(start + int(np.argmax(areas)))
+    selected.append(len(chronological) - 1)
+    return [chronological[i] for i in reversed(selected)]
+
+
+def downsample(
+    history: History, resolution: str = DAY, points: int = LTTB_DEFAULT_POINTS
+) -> History:
+    """Reduces the number of points of a daily history.
+
+    Week and month keep the latest point of every calendar week or month.
+    LTTB keeps the given number of points, chosen with the
+    Largest-Triangle-Three-Buckets algorithm to preserve the visual shape.
+    """
+    if resolution == DAY:
+        return history
+    if resolution == WEEK:
+        return _latest_per_bucket(history, lambda date: date.isocalendar()[:2])
+    if resolution == MONTH:
+        return _latest_per_bucket(history, lambda date: (date.year, date.month))
+    if resolution == LTTB:
+        return _largest_triangle_three_buckets(history, points)
+    raise ValueError(f"unknown resolution: {resolution}")
+
+
+class PositionSeries:
+    """History of a single position computed from already loaded records."""
+
+    def __init__(
+        self,
+        axis: DateAxis,
+        quantity: decimal.Decimal,
+        transactions: TransactionRecords,
+        prices: DatedRecords,
+        exchange_rates: Optional[DatedRecords] = None,
+        numeric: str = DECIMAL,
+    ):
+        """Exchange rates of None mean that no conversion is needed."""
+        self.axis = axis
+        self.numeric = numeric
+        self.quantity = quantity
+        self.transactions = transactions
+        self.prices = prices
+        self.exchange_rates = exchange_rates
+
+        self._quantities: Optional[np.ndarray] = None
+        self._values: Optional[Tuple[np.ndarray, np.ndarray]] = None
+
+    def quantities(self) -> np.ndarray:
+        if self._quantities is None:
+            self._quantities = compute_quantities(
+                self.axis, self.quantity, self.transactions, self.numeric
+            )
+        return self._quantities
+
+    def values(self) -> Tuple[np.ndarray, np.ndarray]:
+        if self._values is None:
+            quantities = self.quantities()
+            prices, prices_present = compute_prices(
+                self.axis, self.transactions, self.prices, self.numeric
+            )
+            self._values = _multiply(
+                quantities, np.ones(self.axis.size, dtype=bool), prices, prices_present
+            )
+        return self._values
+
+    def values_account_currency(self) -> Tuple[np.ndarray, np.ndarray]:
+        values, present = self.values()
+        if self.exchange_rates is None:
+            return values, present
+        rates, rates_present = compute_exchange_rates(
+            self.axis, self.exchange_rates, numeric=self.numeric
+        )
+        return _multiply(rates, rates_present, values, present)
+
+    def quantity_history(self) -> History:
+        quantities = self.quantities()
+        return list(zip(self.axis.dates, quantities.tolist()))
+
+    def value_history(self) -> History:
+        return _to_history(self.axis, *self.values())
+
+    def value_history_in_account_currency(self) -> History:
+        return _to_history(self.axis, *self.values_account_currency())
+
+
+def load_transactions(position: "models.Position") -> TransactionRecords:
+    return list(
+        position.transactions.order_by("-executed_at").values_list(
+            "executed_at", "quantity", "price"
+        )
+    )
+
+
+def load_prices(
+    position: "models.Position", from_date: datetime.date, to_date: datetime.date
+) -> DatedRecords:
+    return list(
+        models.PriceHistory.objects.filter(
+            asset_id=position.asset_id, date__gte=from_date, date__lte=to_date
+        )
+        .order_by("-date")
+        .values_list("date", "value")
+    )
+
+
+def load_exchange_rates(
+    from_date: datetime.date,
+    to_date: datetime.date,
+    from_currency: "models.Currency",
+    to_currency: "models.Currency",
+) -> DatedRecords:
+    return exchange_rates.get_between(from_date, to_date, from_currency, to_currency)
+
+
+def position_series(
+    position: "models.Position",
+    from_date: datetime.date,
+    to_date: Optional[datetime.date] = None,
+    output_period: datetime.timedelta = ONE_DAY,
+    with_prices: bool = True,
+    in_account_currency: bool = False,
+    numeric: str = DECIMAL,
+) -> PositionSeries:
+    """Loads records of the position and prepares its series."""
+    if to_date is None:
+        to_date = datetime.date.today()
+    axis = DateAxis(from_date, to_date, output_period)
+    prices: DatedRecords = []
+    if with_prices:
+        prices = load_prices(position, from_date, to_date)
+    exchange_rates = None
+    if in_account_currency:
+        from_currency = position.asset.currency
+        to_currency = position.account.currency
+        if from_currency != to_currency:
+            exchange_rates = load_exchange_rates(
+                from_date, to_date, from_currency, to_currency
+            )
+    return PositionSeries(
+        axis,
+        position.quantity,
+        load_transactions(position),
+        prices,
+        exchange_rates,
+        numeric,
+    )
+
+
+def account_series(
+    account: "models.Account",
+    from_date: datetime.date,
+    to_date: Optional[datetime.date] = None,
+    output_period: datetime.timedelta = ONE_DAY,
+    positions: Optional[Sequence["models.Position"]] = None,
+    numeric: str = DECIMAL,
+) -> List[Tuple["models.Position", PositionSeries]]:
+    """Prepares series of positions of the account, all of them by default.
+
+    Transactions, prices and exchange rates of all positions are fetched
+    with a fixed number of queries, regardless of the number of positions.
+    """
+    if to_date is None:
+        to_date = datetime.date.today()
+    axis = DateAxis(from_date, to_date, output_period)
+
+    if positions is None:
+        positions = list(account.positions.all())
+    for position in positions:
+        # Avoid a query per position when accessing position.account.
+        position.account = account
+    if not positions:
+        return []
+    asset_ids = set(position.asset_id for position in positions)
+
+    transactions = defaultdict(list)
+    for position_id, executed_at, quantity, price in (
+        models.Transaction.objects.filter(
+            position__in=[position.pk for position in positions]
+        )
+        .order_by("-executed_at")
+        .values_list("position_id", "executed_at", "quantity", "price")
+    ):
+        transactions[position_id].append((executed_at, quantity, price))
+
+    prices = defaultdict(list)
+    for asset_id, date, value in (
+        models.PriceHistory.objects.filter(
+            asset_id__in=asset_ids, date__gte=from_date, date__lte=to_date
+        )
+        .order_by("-date")
+        .values_list("asset_id", "date", "value")
+    ):
+        prices[asset_id].append((date, value))
+
+    asset_currencies = dict(
+        models.Asset.objects.filter(id__in=asset_ids).values_list("id", "currency")
+    )
+    exchange_rates: Dict[int, List[Tuple[datetime.date, decimal.Decimal]]] = {
+        currency: []
+        for currency in set(asset_currencies.values())
+        if currency != account.currency
+    }
+    for from_currency in exchange_rates:
+        exchange_rates[from_currency] = load_exchange_rates(
+            from_date, to_date, from_currency, account.currency
+        )
+
+    return [
+        (
+            position,
+            PositionSeries(
+                axis,
+                position.quantity,
+                transactions[position.pk],
+                prices[position.asset_id],
+                exchange_rates.get(asset_currencies[position.asset_id]),
+                numeric,
+            ),
+        )
+        for position in positions
+    ]
+
+
+# Every date of the axis gets a bucket of transactions executed from that
+# date up to the next date of the axis, the latest date also gets all later
+# transactions. Transactions are summed per bucket first, by computing the
+# date of their bucket, so the axis is only joined to the sums. Running sum
+# of buckets, latest first, is the quantity to undo from the current one.
+_QUANTITY_HISTORIES_SQL = """
+WITH axis AS (
+    SELECT series::date AS date
+    FROM generate_series(
+        %(to_date)s::timestamp, %(from_date)s::timestamp, %(step)s
+    ) AS series
+),
+totals AS (
+    SELECT
+        t.position_id,
+        %(to_date)s::date - GREATEST(
+            0,
+            (
+                %(to_date)s::date - (t.executed_at AT TIME ZONE 'UTC')::date
+                + %(period)s - 1
+            ) / %(period)s
+        ) * %(period)s AS date,
+        SUM(t.quantity) AS quantity
+    FROM {transaction_table} t
+    WHERE t.position_id = ANY(%(position_ids)s) AND t.executed_at >= %(since)s
+    GROUP BY 1, 2
+),
+buckets AS (
+    SELECT p.id AS position_id, axis.date, COALESCE(totals.quantity, 0) AS quantity
+    FROM {position_table} p
+    CROSS JOIN axis
+    LEFT JOIN totals ON totals.position_id = p.id AND totals.date = axis.date
+    WHERE p.id = ANY(%(position_ids)s)
+)
+SELECT
+    buckets.position_id,
+    buckets.date,
+    p.quantity - SUM(buckets.quantity) OVER (
+        PARTITION BY buckets.position_id ORDER BY buckets.date DESC
+    )
+FROM buckets
+JOIN {position_table} p ON p.id = buckets.position_id
+ORDER BY buckets.position_id, buckets.date DESC
+"""
+
+
+def quantity_histories(
+    position_ids: Sequence[int],
+    from_date: datetime.date,
+    to_date: Optional[datetime.date] = None,
+    output_period: datetime.timedelta = ONE_DAY,
+) -> Dict[int, History]:
+    """Quantity histories of many positions computed in a single query.
+
+    Unlike the other histories it is computed by the database, transactions
+    are never loaded.
+    """
+    if to_date is None:
+        to_date = datetime.date.today()
+    axis = DateAxis(from_date, to_date, output_period)
+    histories: Dict[int, History] = {position_id: [] for position_id in position_ids}
+    if not axis.size or not histories:
+        return histories
+
+    sql = _QUANTITY_HISTORIES_SQL.format(
+        position_table=models.Position._meta.db_table,
+        transaction_table=models.Transaction._meta.db_table,
+    )
+    with connection.cursor() as cursor:
+        cursor.execute(
+            sql,
+            {
+                "from_date": from_date,
+                "to_date": to_date,
+                "step": -datetime.timedelta(days=axis.period),
+                "period": axis.period,
+                # Start of the earliest date of the axis, earlier
+                # transactions are in none of the buckets.
+                "since": datetime.datetime.combine(
+                    to_date
+                    - datetime.timedelta(
+                        days=(to_date - from_date).days // axis.period * axis.period
+                    ),
+                    datetime.time(),
+                    tzinfo=datetime.timezone.utc,
+                ),
+                "position_ids": list(histories.keys()),
+            },
+        )
+        for position_id, date, quantity in cursor.fetchall():
+            histories[position_id].append((date, quantity))
+    return histories
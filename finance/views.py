@@ -1,8 +1,26 @@
 import datetime
 from typing import Any, Dict, Type, Union
 
+from django.conf import settings
 from django.contrib.auth.models import User
-from django.db.models import Count, F, OuterRef, Q, QuerySet, Subquery
+from django.db.models import (
+    Case,
+    CharField,
+    Count,
+    DateField,
+    Exists,
+    ExpressionWrapper,
+    F,
+    OuterRef,
+    Prefetch,
+    Q,
+    QuerySet,
+    Subquery,
+    Sum,
+    Value,
+    When,
+)
+from django.db.models.functions import ExtractYear
 from django.shortcuts import get_object_or_404
 from rest_framework import (
     exceptions,
@@ -15,17 +33,32 @@ from rest_framework import (
 )
 from rest_framework.decorators import action
 from rest_framework.pagination import LimitOffsetPagination
+from rest_framework.renderers import JSONRenderer
 from rest_framework.response import Response
-
-
-from finance import accounts, gains, models, stock_exchanges, tasks, prices
+from rest_framework.reverse import reverse
+from rest_framework.settings import api_settings
+
+
+from finance import (
+    accounts,
+    exchange_rates,
+    gains,
+    imports,
+    models,
+    renderers,
+    stock_exchanges,
+    streaming,
+    tasks,
+)
 from finance.integrations import binance_parser, degiro_parser
 from finance.models import (
     AccountEvent,
     Asset,
     CurrencyExchangeRate,
     IntegrationType,
+    LatestExchangeRate,
     Lot,
+    PendingLots,
     Position,
     PriceHistory,
     Transaction,
@@ -43,13 +76,18 @@ from finance.serializers import (
     AssetSerializer,
     BinanceUploadSerializer,
     CorrectTransactionSerializer,
+    CostBasisComparisonSerializer,
+    CostBasisQuerySerializer,
     CurrencyExchangeRateSerializer,
     CurrencyQuerySerializer,
     DegiroUploadSerializer,
     FromToDatesSerializer,
+    HistoryQuerySerializer,
     LotSerializer,
     PositionSerializer,
     PositionWithQuantitiesSerializer,
+    RealizedGainsQuerySerializer,
+    RealizedGainsSerializer,
     TransactionImportSerializer,
     AssetSearchSerializer,
     TransactionSerializer,
@@ -57,8 +95,25 @@ from finance.serializers import (
 )
 
 
+HISTORY_RENDERER_CLASSES = [
+    *api_settings.DEFAULT_RENDERER_CLASSES,
+    renderers.ColumnarJSONRenderer,
+    renderers.ColumnarMessagePackRenderer,
+]
+
+
+def _history_response(request, serializer):
+    # Only JSON can be streamed.
+    if serializer.context["stream"] and isinstance(
+        request.accepted_renderer, JSONRenderer
+    ):
+        return streaming.StreamingJSONResponse(serializer.data)
+    return Response(serializer.data)
+
+
 class AccountsViewSet(viewsets.ModelViewSet):
     permission_classes = [permissions.IsAuthenticated]
+    renderer_classes = HISTORY_RENDERER_CLASSES
     serializer_class = AccountSerializer
     pagination_class = LimitOffsetPagination
     basename = "account"
@@ -74,7 +129,7 @@ class AccountsViewSet(viewsets.ModelViewSet):
     def get_serializer_context(self) -> Dict[str, Any]:
         context: Dict[str, Any] = super().get_serializer_context()
         context["request"] = self.request
-        query = FromToDatesSerializer(data=self.request.query_params)
+        query = HistoryQuerySerializer(data=self.request.query_params)
 
         if query.is_valid(raise_exception=True):
             data = query.validated_data
@@ -86,6 +141,13 @@ class AccountsViewSet(viewsets.ModelViewSet):
             context["to_date"] = self.query_data.get(
                 "to_date", datetime.date.today() + datetime.timedelta(days=1)
             )
+            context["resolution"] = self.query_data["resolution"]
+            context["points"] = self.query_data["points"]
+            context["stream"] = self.query_data["stream"]
+            context["columnar"] = (
+                self.request.accepted_renderer.format in renderers.COLUMNAR_FORMATS
+            )
+            context["delta"] = self.query_data["delta"]
         return context
 
     def get_serializer_class(
@@ -102,10 +164,10 @@ class AccountsViewSet(viewsets.ModelViewSet):
 
     def retrieve(self, request, pk=None):
         queryset = self.get_queryset()
-        queryset = queryset.prefetch_related("positions__asset")
+        queryset = queryset.prefetch_related("positions")
         account = get_object_or_404(queryset, pk=pk)
         serializer = self.get_serializer(account, context=self.get_serializer_context())
-        return Response(serializer.data)
+        return _history_response(request, serializer)
 
     def create(self, request, *args, **kwargs):
         serializer = self.get_serializer(
@@ -121,6 +183,40 @@ class AccountsViewSet(viewsets.ModelViewSet):
             serializer.data, status=status.HTTP_201_CREATED, headers=headers
         )
 
+    @action(detail=True, methods=["get"])
+    def cost_basis(self, request, pk=None):
+        """Realized gains and cost basis of positions with a cost basis method.
+
+        Computed from transactions on the fly to compare methods, lots of
+        the account stay as they are.
+        """
+        account = get_object_or_404(self.get_queryset(), pk=pk)
+        query = CostBasisQuerySerializer(data=request.query_params)
+        query.is_valid(raise_exception=True)
+        method = query.validated_data.get("method", account.cost_basis_method)
+        positions = account.positions.prefetch_related(
+            Prefetch(
+                "transactions",
+                queryset=Transaction.objects.order_by("executed_at", "id"),
+            )
+        ).order_by("id")
+        results = []
+        for position in positions:
+            matcher = gains.compare(position, method, position.transactions.all())
+            results.append(
+                {
+                    "position": position.pk,
+                    "realized_gain": matcher.realized_gain,
+                    "cost_basis": matcher.cost_basis,
+                }
+            )
+        return Response(
+            {
+                "method": models.CostBasisMethod(method).label,
+                "positions": CostBasisComparisonSerializer(results, many=True).data,
+            }
+        )
+
     def perform_update(self, serializer):
         account_repository = accounts.AccountRepository()
         try:
@@ -150,33 +246,18 @@ class PositionsView(generics.ListAPIView):
             .select_related("asset")
             .select_related("asset__exchange")
             .annotate(
-                latest_price=Subquery(
-                    PriceHistory.objects.filter(asset__positions=OuterRef("pk"))
-                    .order_by("-date")
-                    .values("value")[:1]
-                )
-            )
-            .annotate(
-                latest_price_date=Subquery(
-                    PriceHistory.objects.filter(asset__positions=OuterRef("pk"))
-                    .order_by("-date")
-                    .values("date")[:1]
-                )
-            )
-            .annotate(
+                latest_price=F("asset__latest_quote__value"),
+                latest_price_date=F("asset__latest_quote__date"),
+                # Lookup by the unique pair, there's one row per pair.
                 latest_exchange_rate=Subquery(
-                    CurrencyExchangeRate.objects.filter(
+                    LatestExchangeRate.objects.filter(
                         from_currency=OuterRef("asset__currency"),
                         to_currency=OuterRef("account__currency"),
-                        # Will get the latest rate even if it's not the same as
-                        # date at which last price was recorded.
-                        # This shouldn't make a big difference if both prices and exchange rates
-                        # are frequently recorded, but is helpful if some is missing.
-                        # date=OuterRef("latest_price_date"),
-                    )
-                    .order_by("-date")
-                    .values("value")[:1]
-                )
+                    ).values("value")
+                ),
+                lots_pending=Exists(
+                    PendingLots.objects.filter(position=OuterRef("pk"))
+                ),
             )
             .order_by("id")
         )
@@ -235,6 +316,7 @@ class PositionView(generics.RetrieveAPIView):
     model = Position
     serializer_class = PositionWithQuantitiesSerializer
     permission_classes = [permissions.IsAuthenticated]
+    renderer_classes = HISTORY_RENDERER_CLASSES
     pagination_class = LimitOffsetPagination
     queryset = Position.objects.all()
 
@@ -248,11 +330,20 @@ class PositionView(generics.RetrieveAPIView):
             .prefetch_related("transactions")
             .prefetch_related("events")
             .prefetch_related("lots")
+            .annotate(
+                lots_pending=Exists(
+                    PendingLots.objects.filter(position=OuterRef("pk"))
+                )
+            )
         )
 
+    def retrieve(self, request, *args, **kwargs):
+        serializer = self.get_serializer(self.get_object())
+        return _history_response(request, serializer)
+
     def get_serializer_context(self):
         context: Dict[str, Any] = super().get_serializer_context()
-        query = FromToDatesSerializer(data=self.request.query_params)
+        query = HistoryQuerySerializer(data=self.request.query_params)
 
         if query.is_valid(raise_exception=True):
             data = query.validated_data
@@ -264,6 +355,13 @@ class PositionView(generics.RetrieveAPIView):
             context["to_date"] = self.query_data.get(
                 "to_date", datetime.date.today() + datetime.timedelta(days=1)
             )
+            context["resolution"] = self.query_data["resolution"]
+            context["points"] = self.query_data["points"]
+            context["stream"] = self.query_data["stream"]
+            context["columnar"] = (
+                self.request.accepted_renderer.format in renderers.COLUMNAR_FORMATS
+            )
+            context["delta"] = self.query_data["delta"]
         return context
 
 
@@ -327,9 +425,7 @@ class TransactionsViewSet(viewsets.ModelViewSet):
                 }
             )
         date = arguments["executed_at"].date()
-        exchange_rate = prices.get_closest_exchange_rate(
-            date, from_currency, to_currency
-        )
+        exchange_rate = exchange_rates.get_closest(date, from_currency, to_currency)
         if exchange_rate is None:
             raise serializers.ValidationError(
                 {
@@ -346,7 +442,7 @@ class TransactionsViewSet(viewsets.ModelViewSet):
         )
         serializer.is_valid(raise_exception=True)
         assert isinstance(self.request.user, User)
-        account_repository = accounts.AccountRepository()
+        account_repository = accounts.AccountRepository(defer_lots=True)
         account = account_repository.get(
             user=self.request.user, id=serializer.validated_data["account"]
         )
@@ -389,7 +485,7 @@ class TransactionsViewSet(viewsets.ModelViewSet):
         )
         serializer.is_valid(raise_exception=True)
         assert isinstance(self.request.user, User)
-        account_repository = accounts.AccountRepository()
+        account_repository = accounts.AccountRepository(defer_lots=True)
         account = account_repository.get(
             user=self.request.user, id=serializer.validated_data["account"]
         )
@@ -422,7 +518,7 @@ class TransactionsViewSet(viewsets.ModelViewSet):
         return Response(data, status=status.HTTP_201_CREATED, headers=headers)
 
     def perform_destroy(self, instance):
-        account_repository = accounts.AccountRepository()
+        account_repository = accounts.AccountRepository(defer_lots=True)
         try:
             account_repository.delete_transaction(instance)
         except gains.SoldBeforeBought:
@@ -437,7 +533,7 @@ class TransactionsViewSet(viewsets.ModelViewSet):
             )
 
     def perform_update(self, serializer):
-        account_repository = accounts.AccountRepository()
+        account_repository = accounts.AccountRepository(defer_lots=True)
         try:
             account_repository.correct_transaction(
                 serializer.instance, serializer.validated_data
@@ -452,6 +548,8 @@ class TransactionsViewSet(viewsets.ModelViewSet):
             raise serializers.ValidationError(
                 "Can't update a transaction associated with an event, without deleting the event first."
             )
+        except accounts.DuplicateTransaction as e:
+            raise serializers.ValidationError(str(e))
 
 
 class AccountEventViewSet(
@@ -597,9 +695,82 @@ class LotViewSet(
     def get_queryset(self) -> QuerySet[Lot]:
         assert isinstance(self.request.user, User)
         user = self.request.user
-        return Lot.objects.filter(position__account__user=user).exclude(
-            sell_transaction=None
+        return (
+            Lot.objects.filter(position__account__user=user)
+            .exclude(sell_transaction=None)
+            .annotate(
+                lots_pending=Exists(
+                    PendingLots.objects.filter(position=OuterRef("position"))
+                )
+            )
+        )
+
+    @action(detail=False, methods=["get"])
+    def realized_gains(self, request):
+        """Realized gains, proceeds and cost basis of sold lots per tax year.
+
+        Grouped by the year of the sale, account and asset in the database,
+        optionally also by short and long-term holdings.
+        """
+        assert isinstance(self.request.user, User)
+        query = RealizedGainsQuerySerializer(data=request.query_params)
+        query.is_valid(raise_exception=True)
+        arguments = query.validated_data
+
+        lots = Lot.objects.filter(
+            position__account__user=self.request.user, sell_date__isnull=False
+        )
+        if "account" in arguments:
+            lots = lots.filter(position__account=arguments["account"])
+        if "year" in arguments:
+            lots = lots.filter(sell_date__year=arguments["year"])
+        lots = lots.annotate(
+            year=ExtractYear("sell_date"),
+            account=F("position__account"),
+            asset=F("position__asset"),
+            asset_symbol=F("position__asset__symbol"),
+            asset_type=F("position__asset__asset_type"),
+        )
+        groups = ["year", "account", "asset", "asset_symbol", "asset_type"]
+        if arguments["split_term"]:
+            long_term_since = ExpressionWrapper(
+                F("buy_date")
+                + datetime.timedelta(days=arguments["long_term_days"]),
+                output_field=DateField(),
+            )
+            lots = lots.annotate(
+                term=Case(
+                    When(sell_date__gt=long_term_since, then=Value("long")),
+                    default=Value("short"),
+                    output_field=CharField(),
+                )
+            )
+            groups.append("term")
+        rows = (
+            lots.values(*groups)
+            .annotate(
+                realized_gain=Sum("realized_gain_account_currency"),
+                proceeds=Sum("sell_basis_account_currency"),
+                cost_basis=Sum("cost_basis_account_currency"),
+            )
+            .order_by(*groups)
         )
+        return Response(RealizedGainsSerializer(rows, many=True).data)
+
+
+def _queued_import_response(request, transaction_import) -> Response:
+    """Response to an upload imported by a worker, polled at its location."""
+    serializer = SimpleTransactionImportSerializer(
+        instance=transaction_import, context={"request": request}
+    )
+    location = reverse(
+        "transaction-imports-detail", args=[transaction_import.pk], request=request
+    )
+    return Response(
+        status=status.HTTP_202_ACCEPTED,
+        data=serializer.data,
+        headers={"Location": location},
+    )
 
 
 class DegiroUploadViewSet(
@@ -615,7 +786,7 @@ class DegiroUploadViewSet(
         assert isinstance(self.request.user, User)
         queryset = models.TransactionImport.objects.filter(
             account__user=self.request.user, integration=IntegrationType.DEGIRO
-        )
+        ).defer("upload")
         return queryset
 
     def get_serializer_class(
@@ -650,6 +821,14 @@ class DegiroUploadViewSet(
                     "account": "Current user doesn't have access to this account or it doesn't exist."
                 }
             )
+        if arguments["transaction_file"].size > settings.SYNCHRONOUS_IMPORT_MAX_SIZE:
+            transaction_import = imports.queue(
+                account,
+                IntegrationType.DEGIRO,
+                arguments["transaction_file"],
+                import_all_assets=arguments["import_all_assets"],
+            )
+            return _queued_import_response(request, transaction_import)
         try:
             transaction_import = degiro_parser.import_transactions_from_file(
                 account,
@@ -685,7 +864,7 @@ class BinanceUploadViewSet(
         assert isinstance(self.request.user, User)
         queryset = models.TransactionImport.objects.filter(
             account__user=self.request.user, integration=IntegrationType.BINANCE_CSV
-        )
+        ).defer("upload")
         return queryset
 
     def get_serializer_class(
@@ -721,6 +900,11 @@ class BinanceUploadViewSet(
                     "account": "Current user doesn't have access to this account or it doesn't exist."
                 }
             )
+        if arguments["transaction_file"].size > settings.SYNCHRONOUS_IMPORT_MAX_SIZE:
+            transaction_import = imports.queue(
+                account, IntegrationType.BINANCE_CSV, arguments["transaction_file"]
+            )
+            return _queued_import_response(request, transaction_import)
         try:
             transaction_import = binance_parser.import_transactions_from_file(
                 account, arguments["transaction_file"]
@@ -758,7 +942,7 @@ class TransactionImportViewSet(
             .prefetch_related("event_records__event")
             .prefetch_related("records")
             )
-        return queryset
+        return queryset.defer("upload")
 
     def get_serializer_class(
         self,
@@ -768,7 +952,9 @@ class TransactionImportViewSet(
         return TransactionImportSerializer
 
     def perform_destroy(self, instance):
-        account_repository = accounts.AccountRepository(recompute_lots=False, batch_related_changes=True)
+        account_repository = accounts.AccountRepository(
+            batch_related_changes=True, defer_lots=True
+        )
         try:
             account_repository.delete_transaction_import(instance)
             account_repository.update_lots()
@@ -241,6 +241,23 @@ EOD_APIKEY = os.environ.get("EOD_APIKEY", None)
 CELERY_BROKER_URL = "redis://redis:6379"
 CELERY_RESULT_BACKEND = "redis://redis:6379"
 
+# Uploaded transaction files up to this size in bytes are imported within the
+# request, larger ones are queued and imported by a worker.
+SYNCHRONOUS_IMPORT_MAX_SIZE = int(
+    os.environ.get("SYNCHRONOUS_IMPORT_MAX_SIZE", 64 * 1024)
+)
+
+# Shared cache, e.g. for position histories. Falls back to the local memory
+# cache if redis location is not specified (e.g. in tests).
+REDIS_CACHE_URL = os.environ.get("REDIS_CACHE_URL", None)
+if REDIS_CACHE_URL:
+    CACHES = {
+        "default": {
+            "BACKEND": "django_redis.cache.RedisCache",
+            "LOCATION": REDIS_CACHE_URL,
+        }
+    }
+
 
 CELERY_BEAT_SCHEDULE = {
     "fetch_prices": {
@@ -249,6 +266,11 @@ CELERY_BEAT_SCHEDULE = {
         # Reference: https://docs.celeryproject.org/en/stable/userguide/periodic-tasks.html
         "schedule": crontab(minute="0", hour=6),
     },
+    "requeue_stale_imports": {
+        "task": "finance.tasks.requeue_stale_imports",
+        # Imports whose task was lost are queued again within IMPORT_TIMEOUT.
+        "schedule": crontab(minute="*/15"),
+    },
 }
 
 SENTRY_DSN = os.environ.get("SENTRY_DSN", None)